@@ -6,16 +6,31 @@ import pandas as pd
 
 import psx
 import mufap
+import risk
+import db_merge
+import db_query
+import db_schema
+import db_watermarks
+from query_cache import QueryCache
+from scrip_panel import ScripPanel
 
 
 class BMDatabase:
     path_db_main = pathlib.Path(__file__).parent.resolve() / "benchmarks.db"
     path_db_attach = pathlib.Path(__file__).parent.resolve() / "benchmarks_attach.db"
+    path_scrip_panel = pathlib.Path(__file__).parent.resolve() / "benchmarks_scrips"
 
-    db_cache = {}
+    db_cache = QueryCache()
+
+    scrip_panel = None
+
+    # tables replaced from the cutoff by merge_attached, with their date column
+    merge_tables = {"psx_indexes": "index_date", "psx_scrips": "close_date", "fi_rates": "bm_date"}
+    generation = None
 
     def __init__(self):
         self.conn = self.connect()
+        self.check_generation()
 
     def __enter__(self):
         return self
@@ -23,16 +38,15 @@ class BMDatabase:
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
 
-    def pd_read_sql_cached(self, qry, parse_dates=None):
-        if qry in self.db_cache:
-            return self.db_cache[qry].copy()
-        else:
-            df = pd.read_sql(qry, self.conn, parse_dates=parse_dates)
-            self.db_cache[qry] = df.copy()
-            return df
+    def pd_read_sql_cached(self, qry, params=(), parse_dates=None, copy=True):
+        return db_query.read_sql_cached(self.conn, self.db_cache, qry, params, parse_dates, copy)
+
+    def execute(self, qry, params=()):
+        return db_query.execute(self.conn, qry, params)
 
     def connect(self):
-        conn = sqlite3.connect(self.path_db_main)
+        conn = sqlite3.connect(self.path_db_main, cached_statements=db_query.cached_statements)
+        db_schema.migrate(conn, db_schema.benchmarks_migrations)
         return conn
 
     def connect_attach(self):
@@ -44,13 +58,7 @@ class BMDatabase:
         self.conn.close()
 
     def get_schema(self):
-        schema = ""
-        cursor = self.conn.cursor()
-        cursor.execute("select sql from sqlite_master")
-        for r in cursor.fetchall():
-            schema = schema + r[0] + "; \n"
-        cursor.close()
-        return schema
+        return db_schema.get_schema(self.conn)
 
     def make_attached_db(self):
         if self.path_db_attach.exists():
@@ -65,7 +73,7 @@ class BMDatabase:
         return conn_attach
     
     def get_bm_info(self):
-        df = self.pd_read_sql_cached("SELECT * FROM benchmarks;")
+        df = self.pd_read_sql_cached("SELECT * FROM benchmarks;", copy=False)
         return df
 
     def get_latest_index_date(self):
@@ -112,8 +120,7 @@ class BMDatabase:
 
         return df
 
-    def __fetch_scrips(self, start_date):
-        df = psx.fetch_scrips(start_date)
+    def __prepare_scrips(self, df):
         if df.shape[0] > 0:
             df.columns = [x.lower() for x in df.columns]
             df = df[["close_date", "symbol", "close", "ldcp", "volume"]]
@@ -121,40 +128,129 @@ class BMDatabase:
 
         return df
 
-    def update_attached(self, start_date):
+    def __fetch_scrips(self, start_date):
+        return self.__prepare_scrips(psx.fetch_scrips(start_date))
+
+    def __store_scrips(self, df, conn):
+        df = self.__prepare_scrips(df)
+        if not df.empty:
+            df.to_sql("psx_scrips", conn, if_exists="append", index=False)
+
+    def update_attached(self, start_date, starts=None):
+        # starts maps a source to the date it is fetched from, see get_update_starts
+        if starts is None:
+            starts = {}
+
         conn_attach = self.make_attached_db()
 
         print("Getting Indexes...")
-        df = self.__fetch_index(start_date)
+        df = self.__fetch_index(starts.get("psx_indexes", start_date))
         df.to_sql("psx_indexes", conn_attach, if_exists="append", index=False)
 
         print("Getting Scrips...")
-        df = self.__fetch_scrips(start_date)
-        df.to_sql("psx_scrips", conn_attach, if_exists="append", index=False)
+        psx.fetch_scrips(starts.get("psx_scrips", start_date), on_result=lambda df: self.__store_scrips(df, conn_attach))
 
         print("Getting PKRV...")
-        df = self.__fetch_pkrv(start_date)
+        df = self.__fetch_pkrv(starts.get("pkrv", start_date))
         df.to_sql("fi_rates", conn_attach, if_exists="append", index=False)
 
         print("Getting KIBOR...")
-        df = self.__fetch_kibor(start_date)
+        df = self.__fetch_kibor(starts.get("kibor", start_date))
         df.to_sql("fi_rates", conn_attach, if_exists="append", index=False)
 
         print("\nDone.")
 
         conn_attach.close()
 
-    def merge_attached(self, cutoff_date):
-        self.conn.execute(f"DELETE FROM psx_indexes WHERE index_date>='{cutoff_date.date()}';")
-        self.conn.execute(f"DELETE FROM psx_scrips WHERE close_date>='{cutoff_date.date()}';")
-        self.conn.execute(f"DELETE FROM fi_rates WHERE bm_date>='{cutoff_date.date()}';")
-        self.conn.commit()
-        self.conn.execute(f"ATTACH DATABASE '{self.path_db_attach}' AS new_db;")
-        self.conn.execute("INSERT INTO psx_indexes SELECT * FROM new_db.psx_indexes;")
-        self.conn.execute("INSERT INTO psx_scrips SELECT * FROM new_db.psx_scrips;")
-        self.conn.execute("INSERT INTO fi_rates SELECT * FROM new_db.fi_rates;")
-        self.conn.commit()
-        self.conn.execute("DETACH DATABASE new_db;")
+    def merge_attached(self, cutoff_date, shadow=False):
+        cutoff_date = cutoff_date.date()
+
+        if shadow:
+            conn_shadow = db_merge.make_shadow(self.conn, self.path_db_main)
+            try:
+                db_merge.merge(conn_shadow, self.path_db_attach, self.merge_tables, cutoff_date)
+                self.update_watermarks(conn_shadow)
+                db_merge.validate(self.conn, conn_shadow, self.path_db_attach, self.merge_tables, cutoff_date)
+                db_merge.publish(conn_shadow, self.conn)
+            finally:
+                db_merge.drop_shadow(conn_shadow, self.path_db_main)
+        else:
+            db_merge.merge(self.conn, self.path_db_attach, self.merge_tables, cutoff_date)
+            self.update_watermarks(self.conn)
+
+        self.db_cache.invalidate(*self.merge_tables)
+        self.update_scrip_panel(min(cutoff_date, (self.get_attached_start() or cutoff_date).date()))
+        db_merge.touch_generation(self.path_db_main)
+
+    def check_generation(self):
+        # another process merged, drop everything loaded from the old data
+        generation = db_merge.get_generation(self.path_db_main)
+        if generation == BMDatabase.generation:
+            return
+
+        self.db_cache.clear()
+        BMDatabase.scrip_panel = None
+        BMDatabase.generation = generation
+
+    def get_scrip_panel(self):
+        # built on first use, kept up to date by merge_attached from then on
+        self.check_generation()
+        if BMDatabase.scrip_panel is None:
+            BMDatabase.scrip_panel = ScripPanel.load(self.path_scrip_panel, self.conn)
+
+        if BMDatabase.scrip_panel is None:
+            BMDatabase.scrip_panel = ScripPanel.build(self.conn)
+            BMDatabase.scrip_panel.save(self.path_scrip_panel)
+
+        return BMDatabase.scrip_panel
+
+    def update_scrip_panel(self, cutoff_date):
+        scrip_panel = BMDatabase.scrip_panel
+        if scrip_panel is None:
+            scrip_panel = ScripPanel.load(self.path_scrip_panel)
+
+        # never built, nothing to keep up to date
+        if scrip_panel is None:
+            return
+
+        BMDatabase.scrip_panel = scrip_panel.update(self.conn, cutoff_date)
+        BMDatabase.scrip_panel.save(self.path_scrip_panel)
+
+    def get_attached_start(self):
+        return db_merge.get_first_date(self.path_db_attach, self.merge_tables)
+
+    def get_watermarks(self, source):
+        return db_watermarks.get(self.conn, source)
+
+    def get_update_starts(self):
+        # day after each source's watermark, both indexes come in one request
+        starts = {}
+        for source in ("psx_indexes", "psx_scrips", "pkrv", "kibor"):
+            source_starts = db_watermarks.get_starts(self.get_watermarks(source))
+            if source_starts:
+                starts[source] = min(source_starts.values())
+
+        return starts
+
+    def update_watermarks(self, conn):
+        # sources move to the last date merged from them
+        conn_attach = self.connect_attach()
+        df_indexes = db_query.read_sql(
+            conn_attach, "SELECT bm_id AS key, MAX(index_date) AS last_date FROM psx_indexes GROUP BY bm_id"
+        )
+        df_scrips = db_query.read_sql(conn_attach, "SELECT '' AS key, MAX(close_date) AS last_date FROM psx_scrips")
+        df_rates = db_query.read_sql(conn_attach, "SELECT bm_id, MAX(bm_date) AS last_date FROM fi_rates GROUP BY bm_id")
+        conn_attach.close()
+
+        bm_names = self.get_bm_info().set_index("bm_id")["bm_name"].str.lower()
+        df_rates["source"] = df_rates["bm_id"].map(bm_names).str.split("_").str[0]
+        df_rates = df_rates.groupby("source", as_index=False)["last_date"].max().assign(key="")
+
+        db_watermarks.put(conn, "psx_indexes", df_indexes)
+        db_watermarks.put(conn, "psx_scrips", df_scrips)
+        for source in ("pkrv", "kibor"):
+            db_watermarks.put(conn, source, df_rates[df_rates["source"] == source])
+        conn.commit()
 
     def fetch_scrips(self, start_date):
         return self.__fetch_scrips(start_date)
@@ -164,22 +260,27 @@ class BMDatabase:
         df = df[["sector_id", "sector_name"]]
         df = df.drop_duplicates()
         df.to_sql("psx_sectors", self.conn, if_exists="replace", index=False)
+        self.db_cache.invalidate("psx_sectors")
 
     def update_psx_coinfo(self):
         df = psx.fetch_co_info()
         df = df.drop(["sector_name"], axis=1)
         df.to_sql("psx_co_info", self.conn, if_exists="replace", index=False)
+        self.db_cache.invalidate("psx_co_info")
 
     def get_index_data(self, index_id, start_date=None, end_date=None, last=False):
-        qry = f"SELECT * FROM psx_indexes WHERE bm_id='{index_id}'"
+        qry = "SELECT * FROM psx_indexes WHERE bm_id=?"
+        params = [index_id]
         if end_date:
-            qry = qry + f" AND index_date<='{end_date}'"
+            qry = qry + " AND index_date<=?"
+            params.append(end_date)
         if last:
             qry = qry + " ORDER BY index_date DESC LIMIT 1"
         else:
             if start_date:
-                qry = qry + f" AND index_date>'{start_date}'  ORDER BY index_date ASC"
-        df = self.pd_read_sql_cached(qry)
+                qry = qry + " AND index_date>?  ORDER BY index_date ASC"
+                params.append(start_date)
+        df = self.pd_read_sql_cached(qry, params)
         return df
 
     def get_index_stddev(self, start_date, end_date, index_id=None):
@@ -200,18 +301,67 @@ class BMDatabase:
 
         return df[['return','ln_change']].corr().iloc[0,1]
     
-    def get_scrip_return(self, start_date, end_date, symbol=None):
-        if symbol == None:
-            qry = f"SELECT * FROM psx_scrips WHERE close_date>'{start_date}' AND close_date<='{end_date}'"
-        else:
-            qry = f"SELECT * FROM psx_scrips WHERE symbol='{symbol}' AND close_date>'{start_date}' AND close_date<='{end_date}'"
+    def get_index_history(self, index_id):
+        # dates and daily returns of the index over its whole history
+        df = self.get_index_data(index_id).sort_values("index_date", kind="stable")
+        returns = df["close"].pct_change().to_numpy(dtype=float)
+
+        return pd.Index(df["index_date"].to_numpy(dtype=str)[1:]), returns[1:]
+
+    def get_rolling_index_stats(self, index_id, window):
+        # stddev of the index's daily returns over the last window days, for
+        # every date of its history
+        key = ("rolling", index_id, window)
+        generations = self.db_cache.get_generations(("psx_indexes",))
+        df = self.db_cache.get(key)
+        if df is None:
+            dates, index_returns = self.get_index_history(index_id)
+            stddev = risk.get_rolling_stddev(index_returns[np.newaxis, :], window)[0]
+
+            df = pd.DataFrame({"index_date": dates, "stddev": stddev})
+            self.db_cache.put(key, df, ("psx_indexes",), generations)
+
+        return df
 
-        df = self.pd_read_sql_cached(qry)
-        if df.empty:
+    def get_rolling_scrip_stats(self, symbols, index_id, window):
+        # stddev of each symbol's daily log returns, and their correlation and
+        # beta against the index, over the last window days of the index, as
+        # date x symbol frames, symbols already cached are not computed again
+        generations = self.db_cache.get_generations(("psx_indexes", "psx_scrips"))
+        dates, index_returns = self.get_index_history(index_id)
+
+        stats = {symbol: self.db_cache.get(("rolling", symbol, index_id, window)) for symbol in symbols}
+        missing = [symbol for symbol, df in stats.items() if df is None]
+
+        if missing:
+            scrip_returns, scrip_dates = self.get_scrip_returns(missing, None, None)
+            pos = scrip_dates.get_indexer(dates)
+
+            returns = np.full((len(missing), len(dates)), np.nan)
+            returns[:, pos >= 0] = scrip_returns[:, pos[pos >= 0]]
+
+            stddev = risk.get_rolling_stddev(returns, window)
+            correl, beta = risk.get_rolling_correl(returns, index_returns, window)
+
+            for i, symbol in enumerate(missing):
+                df = pd.DataFrame({"stddev": stddev[i], "correl": correl[i], "beta": beta[i]}, index=dates)
+                self.db_cache.put(("rolling", symbol, index_id, window), df, ("psx_indexes", "psx_scrips"), generations)
+                stats[symbol] = df
+
+        ret = {}
+        for stat in ["stddev", "correl", "beta"]:
+            ret[stat] = pd.DataFrame({symbol: stats[symbol][stat] for symbol in symbols}, index=dates)
+            ret[stat].index.name = "index_date"
+
+        return ret
+
+    def get_scrip_return(self, start_date, end_date, symbol=None):
+        scrip_panel = self.get_scrip_panel()
+        rows = scrip_panel.select(start_date, end_date, symbol)
+        if rows.size == 0:
             return 0
-        
-        df["ln_change"] = np.log(df["close"] / df["ldcp"])
-        ret = np.exp(df.groupby("symbol")["ln_change"].sum().fillna(0)) - 1
+
+        ret = scrip_panel.get_total_returns(rows)
 
         if symbol:
             return ret[symbol]
@@ -219,82 +369,120 @@ class BMDatabase:
         return ret
 
     def get_scrip_stddev(self, symbol, start_date, end_date):
-        qry = f"SELECT * FROM psx_scrips WHERE symbol='{symbol}' AND close_date>'{start_date}' AND close_date<='{end_date}'"
-        df = self.pd_read_sql_cached(qry)
-        df["ln_change"] = np.log(df["close"] / df["ldcp"])
-        ret = df["ln_change"].std(ddof=0)
+        scrip_panel = self.get_scrip_panel()
+        rows = scrip_panel.select(start_date, end_date, symbol)
+        ret = pd.Series(scrip_panel.get_log_returns(rows)).std(ddof=0)
 
         return ret
     
     def get_scrip_daily_return(self, symbol, start_date, end_date):
-        qry = f"SELECT * FROM psx_scrips WHERE symbol='{symbol}' AND close_date>'{start_date}' AND close_date<='{end_date}'"
-        df = self.pd_read_sql_cached(qry)
-        df["ln_change"] = np.log(df["close"] / df["ldcp"])
-        ret = df[["close_date", "ln_change"]]
+        scrip_panel = self.get_scrip_panel()
+        rows = scrip_panel.select(start_date, end_date, symbol)
+        ret = pd.DataFrame({"close_date": scrip_panel.get_dates(rows), "ln_change": scrip_panel.get_log_returns(rows)})
 
         return ret
 
     def get_scrip_correl(self, symbols, start_date, end_date):
-        lst_symbols = str(symbols)[1:-1]
-        
-        qry = f"SELECT * FROM psx_scrips WHERE symbol in ({lst_symbols}) AND close_date>'{start_date}' AND close_date<='{end_date}'"
-        df = self.pd_read_sql_cached(qry)
-        df["ln_change"] = np.log(df["close"] / df["ldcp"])
-        df = df[['close_date','symbol','ln_change']]
-        df = df.pivot(columns=['symbol'], index=['close_date'])
-        df = df.fillna(0)
-        df = df.reset_index(drop=True)
-        df.columns = df.columns.droplevel()
-        ret = df.corr()
+        returns, dates = self.get_scrip_returns(symbols, start_date, end_date)
+        symbols = pd.Index(symbols, name="symbol")
+        ret = pd.DataFrame(risk.get_correl(returns), index=symbols, columns=symbols)
         return ret
     
-    def get_portfolio_stddev(self, portfolio, start_date, end_date):
-        portfolio['stddev'] = portfolio['symbol'].apply(lambda x: self.get_scrip_stddev(x, start_date, end_date))
-        portfolio['w_stddev'] = portfolio['weight'] * portfolio['stddev']
-        correls = self.get_scrip_correl(portfolio['symbol'].tolist(), start_date, end_date)
-        df_wstd = portfolio[['symbol', 'w_stddev']].set_index('symbol')
+    def get_scrip_returns(self, symbols, start_date, end_date):
+        # symbol x date matrix of daily log returns, nan where a symbol did not trade
+        return self.get_scrip_panel().get_return_matrix(symbols, start_date, end_date)
+
+    def get_scrip_period_returns(self, symbols, start_dates, end_dates):
+        # symbol x period matrix of returns, 0 where a symbol did not trade
+        scrip_panel = self.get_scrip_panel()
+        ret = pd.DataFrame(index=pd.Index(symbols, name="symbol"))
+        for i, (start_date, end_date) in enumerate(zip(start_dates, end_dates)):
+            rows = scrip_panel.select(start_date, end_date)
+            ret[i] = scrip_panel.get_total_returns(rows).reindex(ret.index).fillna(0).to_numpy()
 
-        df1 = df_wstd.transpose().dot(correls)
-        
-        return df1.dot(df_wstd).iloc[0,0]**(1/2)
+        return ret
+
+    def get_scrip_closes(self, symbols, dates):
+        # symbol x date matrix of the last close on or before each date
+        closes = self.get_scrip_panel().get_last_closes(symbols, dates)
+        return pd.DataFrame(closes, index=pd.Index(symbols, name="symbol"), columns=list(dates))
+
+    def get_index_closes(self, index_id, dates):
+        # last close on or before each date, nan before the first one
+        df = self.get_index_data(index_id, end_date=max(dates)).sort_values("index_date", kind="stable")
+        pos = np.searchsorted(df["index_date"].to_numpy(dtype=str), np.asarray(dates, dtype=str), side="right") - 1
+        closes = np.append(df["close"].to_numpy(dtype=float), np.nan)
+        return closes[np.where(pos >= 0, pos, -1)]
+
+    def get_index_returns(self, index_id, dates, start_date, end_date):
+        # daily log returns of the index on the given dates
+        df = self.get_index_data(index_id, start_date, end_date)
+        returns = np.log(df["close"] / df["close"].shift())
+
+        return pd.Series(returns.to_numpy(dtype=float), index=df["index_date"]).reindex(dates).to_numpy(dtype=float)
+
+    def get_portfolio_risk(self, portfolio, start_date, end_date, index_id=None):
+        # portfolio has symbol and weight columns, returns the volatility, the
+        # tracking error against index_id and each symbol's risk contribution
+        weights = portfolio.groupby("symbol", sort=False)["weight"].sum()
+        returns, dates = self.get_scrip_returns(weights.index, start_date, end_date)
+
+        index_returns = None
+        if index_id is not None:
+            index_returns = self.get_index_returns(index_id, dates, start_date, end_date)
+
+        res = risk.get_portfolio_risk(weights.to_numpy(dtype=float), returns, index_returns)
+
+        df = pd.DataFrame(
+            {
+                "symbol": weights.index,
+                "weight": weights.to_numpy(dtype=float),
+                "stddev": res["asset_stddev"],
+                "marginal": res["marginal"],
+                "component": res["component"],
+            }
+        )
+        df["contribution"] = df["component"] / res["stddev"]
+
+        return {"stddev": res["stddev"], "tracking_error": res["tracking_error"], "risk": df}
+
+    def get_portfolio_stddev(self, portfolio, start_date, end_date):
+        return self.get_portfolio_risk(portfolio, start_date, end_date)["stddev"]
 
     def get_scrip_avg_volume(self, symbol, start_date, end_date):
-        qry = f"SELECT avg(volume) FROM psx_scrips WHERE symbol='{symbol}' AND close_date>'{start_date}' AND close_date<='{end_date}'"
-        ret = self.conn.execute(qry)
+        scrip_panel = self.get_scrip_panel()
+        rows = scrip_panel.select(start_date, end_date, symbol)
+        # like avg(volume), missing volumes are skipped
+        volume = np.asarray(scrip_panel.volume[rows])
+        if np.isnan(volume).all():
+            return None
 
-        return ret.fetchone()[0]
+        return float(np.nanmean(volume))
 
     def get_scrip_traded_days(self, symbol, start_date, end_date):
-        qry = f"SELECT count(symbol) FROM psx_scrips WHERE symbol='{symbol}' AND close_date>'{start_date}' AND close_date<='{end_date}'"
-        ret = self.conn.execute(qry)
-
-        return ret.fetchone()[0]
+        return int(self.get_scrip_panel().select(start_date, end_date, symbol).size)
     
     def get_scrip_info(self, symbol):
-        qry = f"SELECT * FROM psx_co_info WHERE symbol='{symbol}'"
-        ret = self.conn.execute(qry)
+        qry = "SELECT * FROM psx_co_info WHERE symbol=?"
+        ret = self.execute(qry, (symbol,))
 
         return ret.fetchone()
 
     def get_scrip_data(self, symbol, start_date=None, end_date=None, last=False):
-        qry = f"SELECT * FROM psx_scrips WHERE symbol='{symbol}'"
-
-        if end_date:
-            qry = qry + f" AND close_date<='{end_date}'"
+        scrip_panel = self.get_scrip_panel()
 
         if last:
-            qry = qry + " ORDER BY close_date DESC LIMIT 1"
+            rows = scrip_panel.select(end_date=end_date, symbol=symbol)[-1:]
         else:
-            if start_date:
-                qry = qry + f" AND close_date>='{start_date}'"
+            rows = scrip_panel.select(start_date, end_date, symbol, include_start=True)
 
-        df = self.pd_read_sql_cached(qry)
+        df = scrip_panel.get_data(rows)
 
         return df
     
     def get_fi_avg(self, bm_id, start_date, end_date):
-        qry = f"SELECT avg(rate) FROM fi_rates WHERE bm_id='{bm_id}' AND bm_date>'{start_date}' AND bm_date<='{end_date}'"
-        ret = self.conn.execute(qry)
+        qry = "SELECT avg(rate) FROM fi_rates WHERE bm_id=? AND bm_date>? AND bm_date<=?"
+        ret = self.execute(qry, (bm_id, start_date, end_date))
 
         return ret.fetchone()[0]
         
@@ -302,9 +490,10 @@ class BMDatabase:
 if __name__ == "__main__":
     # start_date = datetime.date(2023, 8, 1)
     with BMDatabase() as db:
-        start_date = datetime.datetime.fromisoformat(db.get_latest_fi_date()) + datetime.timedelta(days=1)
+        starts = db.get_update_starts()
+        start_date = max(starts.values(), default=datetime.datetime.fromisoformat(db.get_latest_fi_date()) + datetime.timedelta(days=1))
         # # start_date = datetime.date(2023, 7, 1)
-        db.update_attached(start_date)
+        db.update_attached(start_date, starts)
         db.merge_attached(start_date)
         db.path_db_attach.unlink()
         
@@ -0,0 +1,246 @@
+import io
+import json
+import os
+import pathlib
+import shutil
+import sqlite3
+import tempfile
+import time
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+import db_query
+
+# deltas read from a stream stay in memory up to this size
+delta_spool_bytes = 8 * 1024 * 1024
+
+
+def merge(conn, path_attach, tables, cutoff):
+    # replaces every row from the cutoff with the attached database, tables
+    # maps each table to its date column, all of them change in one transaction
+    conn.commit()
+    db_query.execute(conn, "ATTACH DATABASE ? AS new_db;", (str(path_attach),))
+
+    try:
+        conn.execute("BEGIN")
+        for table, date_col in tables.items():
+            db_query.execute(conn, f"DELETE FROM {table} WHERE {date_col}>=?;", (cutoff,))
+            conn.execute(f"INSERT OR REPLACE INTO {table} SELECT * FROM new_db.{table};")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.execute("DETACH DATABASE new_db;")
+
+
+def get_first_date(path_attach, tables):
+    # rows older than the cutoff are merged too when a source was fetched from
+    # an earlier watermark, anything derived from them is rebuilt from here
+    conn = sqlite3.connect(path_attach)
+    try:
+        dates = [conn.execute(f"SELECT MIN({date_col}) FROM {table}").fetchone()[0] for table, date_col in tables.items()]
+    finally:
+        conn.close()
+
+    dates = [x for x in dates if x is not None]
+    if dates == []:
+        return None
+    return pd.Timestamp(min(dates)).to_pydatetime()
+
+
+def get_shadow_path(path_db):
+    path_db = pathlib.Path(path_db)
+    return path_db.with_name(f"{path_db.name}.shadow")
+
+
+def make_shadow(conn, path_db):
+    path_shadow = get_shadow_path(path_db)
+    path_shadow.unlink(missing_ok=True)
+
+    conn.commit()
+    db_query.execute(conn, "VACUUM INTO ?", (str(path_shadow),))
+
+    return sqlite3.connect(path_shadow, cached_statements=db_query.cached_statements)
+
+
+def drop_shadow(conn_shadow, path_db):
+    conn_shadow.close()
+    get_shadow_path(path_db).unlink(missing_ok=True)
+
+
+def get_key(conn, table):
+    return [r[1] for r in conn.execute(f"PRAGMA table_info({table})").fetchall() if r[5] > 0]
+
+
+def count_rows(conn, table, date_col, cutoff, before, key=None):
+    op = "<" if before else ">="
+
+    # rows replacing each other in the merge count once
+    if key:
+        qry = f"SELECT COUNT(*) FROM (SELECT DISTINCT {', '.join(key)} FROM {table} WHERE {date_col}{op}?)"
+    else:
+        qry = f"SELECT COUNT(*) FROM {table} WHERE {date_col}{op}?"
+
+    return db_query.execute(conn, qry, (cutoff,)).fetchone()[0]
+
+
+def validate(conn_live, conn_merged, path_attach, tables, cutoff):
+    res = conn_merged.execute("PRAGMA integrity_check").fetchone()[0]
+    if res != "ok":
+        raise ValueError(f"Merged database failed integrity_check: {res}")
+
+    conn_attach = sqlite3.connect(path_attach)
+    try:
+        for table, date_col in tables.items():
+            # the attached tables have no keys of their own
+            key = get_key(conn_merged, table)
+            live_before = count_rows(conn_live, table, date_col, cutoff, True)
+            merged_before = count_rows(conn_merged, table, date_col, cutoff, True)
+            merged_after = count_rows(conn_merged, table, date_col, cutoff, False)
+            attach_before = count_rows(conn_attach, table, date_col, cutoff, True, key)
+            attach_after = count_rows(conn_attach, table, date_col, cutoff, False, key)
+
+            # rows before the cutoff are kept, rows from it come from the attached database
+            if merged_after != attach_after or not live_before <= merged_before <= live_before + attach_before:
+                raise ValueError(
+                    f"Merged {table} has {merged_before} + {merged_after} rows, expected"
+                    f" {live_before} (+ up to {attach_before}) + {attach_after}"
+                )
+    finally:
+        conn_attach.close()
+
+
+def publish(conn_shadow, conn_live):
+    # copies the shadow into the live database in a single write transaction,
+    # WAL readers keep their snapshot until it commits and then see all of it
+    conn_shadow.commit()
+    conn_live.commit()
+    conn_shadow.backup(conn_live)
+
+
+def get_generation_path(path_db):
+    path_db = pathlib.Path(path_db)
+    return path_db.with_name(f"{path_db.name}.generation")
+
+
+def touch_generation(path_db):
+    # other processes compare this with what they loaded to drop their caches
+    path = get_generation_path(path_db)
+    path_tmp = path.with_name(f"{path.name}.tmp")
+    with open(path_tmp, "w") as f:
+        f.write(str(time.time_ns()))
+    os.replace(path_tmp, path)
+
+
+def get_generation(path_db):
+    try:
+        with open(get_generation_path(path_db)) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def to_days(dates, since):
+    return (dates.to_numpy().astype("datetime64[D]") - since).astype(np.int32)
+
+
+def get_decimals(values, max_decimals=8):
+    # navs and rates carry a few decimals, as scaled integers they compress far better
+    values = values[~np.isnan(values)]
+    for decimals in range(max_decimals + 1):
+        scaled = np.round(values * 10**decimals)
+        if np.abs(scaled).max(initial=0) >= 2**53:
+            return None
+        if np.array_equal(scaled / 10**decimals, values):
+            return decimals
+    return None
+
+
+def export_delta(conn, tables, since):
+    # columnar delta of every row from since, dates are day offsets from it and
+    # text columns are dictionary encoded, numpy's zip format keeps it compact
+    since = pd.Timestamp(since).to_datetime64().astype("datetime64[D]")
+    meta = {"since": str(since), "tables": {}}
+    arrays = {}
+
+    for table, date_col in tables.items():
+        df = db_query.read_sql(conn, f"SELECT * FROM {table} WHERE {date_col}>=?", (str(since),))
+        df = df.sort_values(list(df.columns), ignore_index=True)
+
+        # dates are stored as text with or without the time
+        date_fmt = "%Y-%m-%d %H:%M:%S" if df[date_col].str.len().max() > 10 else "%Y-%m-%d"
+        meta["tables"][table] = {"columns": list(df.columns), "date_col": date_col, "date_fmt": date_fmt, "decimals": {}}
+
+        for col in df.columns:
+            name = f"{table}.{col}"
+            if col == date_col:
+                arrays[name] = to_days(pd.to_datetime(df[col]), since)
+            elif not pd.api.types.is_numeric_dtype(df[col]):
+                codes, values = pd.factorize(df[col])
+                arrays[name] = codes.astype(np.int32)
+                arrays[f"{name}.values"] = values.to_numpy(dtype=str)
+            elif pd.api.types.is_float_dtype(df[col]) and not df[col].isna().any():
+                values = df[col].to_numpy(dtype=float)
+                decimals = get_decimals(values)
+                if decimals is None:
+                    arrays[name] = values
+                else:
+                    arrays[name] = np.round(values * 10**decimals).astype(np.int64)
+                    meta["tables"][table]["decimals"][col] = decimals
+            else:
+                arrays[name] = df[col].to_numpy()
+
+    f = io.BytesIO()
+    np.savez_compressed(f, meta=np.array(json.dumps(meta)), **arrays)
+    return f.getvalue()
+
+
+def read_delta(blob):
+    # blob is the bytes or a file object, returns since and a frame per table,
+    # np.load needs to seek so streams are spooled to disk past a few MB
+    if isinstance(blob, (bytes, bytearray)):
+        return parse_delta(io.BytesIO(blob))
+
+    with tempfile.SpooledTemporaryFile(max_size=delta_spool_bytes) as f:
+        shutil.copyfileobj(blob, f)
+        f.seek(0)
+        return parse_delta(f)
+
+
+def parse_delta(f):
+    # anything that is not a delta from export_delta raises ValueError
+    try:
+        arrays = np.load(f, allow_pickle=False)
+        if not isinstance(arrays, np.lib.npyio.NpzFile):
+            raise ValueError("Malformed delta: not an npz archive")
+
+        with arrays:
+            return read_delta_arrays(arrays)
+    except (zipfile.BadZipFile, KeyError, EOFError) as e:
+        raise ValueError(f"Malformed delta: {e!r}") from e
+
+
+def read_delta_arrays(arrays):
+    meta = json.loads(str(arrays["meta"]))
+    since = np.datetime64(meta["since"], "D")
+    frames = {}
+
+    for table, info in meta["tables"].items():
+        df = pd.DataFrame()
+        for col in info["columns"]:
+            name = f"{table}.{col}"
+            if col == info["date_col"]:
+                df[col] = pd.Series(since + arrays[name]).dt.strftime(info["date_fmt"])
+            elif f"{name}.values" in arrays:
+                values = np.append(arrays[f"{name}.values"].astype(object), None)
+                df[col] = values[arrays[name]]
+            elif col in info["decimals"]:
+                df[col] = arrays[name] / 10 ** info["decimals"][col]
+            else:
+                df[col] = arrays[name]
+        frames[table] = df
+
+    return pd.Timestamp(since).to_pydatetime(), frames
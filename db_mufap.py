@@ -4,19 +4,41 @@ import time
 import pathlib
 import concurrent.futures
 
+import numpy as np
 import pandas as pd
 
 import mufap
+import risk
+from db_benchmarks import BMDatabase
+from nav_matrix import NavMatrix, to_day
+import db_merge
+import db_query
+import db_schema
+import db_watermarks
+from query_cache import QueryCache
 
 
 class MFDatabase():
     path_db_main = pathlib.Path(__file__).parent.resolve() / "mufap.db"
     path_db_attach = pathlib.Path(__file__).parent.resolve() / "mufap_attach.db"
+    path_nav_matrix = pathlib.Path(__file__).parent.resolve() / "mufap_navs"
 
-    db_cache = {}
+    db_cache = QueryCache()
 
-    def __init__(self):
+    nav_matrix = None
+    nav_matrix_loaded = False
+
+    # set to a db_pool.ConnectionPool to take connections from it
+    pool = None
+
+    # tables replaced from the cutoff by merge_attached, with their date column
+    merge_tables = {"navs": "nav_date", "payouts": "payout_date"}
+    generation = None
+
+    def __init__(self, writer=False):
+        self.writer = writer
         self.conn = self.connect()
+        self.check_generation()
         # self.conn_attach = self.connect_attach()
 
     def __enter__(self):
@@ -26,16 +48,18 @@ class MFDatabase():
         self.close()
 
 
-    def pd_read_sql_cached(self, qry, parse_dates=None):
-        if qry in self.db_cache:
-            return self.db_cache[qry].copy()
-        else:
-            df = pd.read_sql(qry, self.conn, parse_dates=parse_dates)
-            self.db_cache[qry] = df.copy()
-            return df
+    def pd_read_sql_cached(self, qry, params=(), parse_dates=None, copy=True):
+        return db_query.read_sql_cached(self.conn, self.db_cache, qry, params, parse_dates, copy)
+
+    def execute(self, qry, params=()):
+        return db_query.execute(self.conn, qry, params)
     
     def connect(self):
-        conn = sqlite3.connect(self.path_db_main)
+        if self.pool is not None:
+            return self.pool.acquire(self.writer)
+
+        conn = sqlite3.connect(self.path_db_main, cached_statements=db_query.cached_statements)
+        db_schema.migrate(conn, db_schema.mufap_migrations)
         return conn
 
     def connect_attach(self):
@@ -44,7 +68,11 @@ class MFDatabase():
 
     def close(self):
         self.conn.commit()
-        self.conn.close()
+
+        if self.pool is not None:
+            self.pool.release(self.conn)
+        else:
+            self.conn.close()
 
 
     def get_latest_nav_date(self):
@@ -55,19 +83,17 @@ class MFDatabase():
         ORDER BY nav_date DESC
         LIMIT 10) WHERE date_count>=300;
         """
-        res = self.conn.execute(qry)
-        return res.fetchone()[0]
+        df = self.pd_read_sql_cached(qry, copy=False)
+        return df["nav_date"].iloc[0]
 
 
     def get_fund_id(self, fund_name):
-        cur = self.conn.cursor()
-        res = cur.execute(f"SELECT fund_id FROM funds WHERE fund_name='{fund_name}'")
+        res = self.execute("SELECT fund_id FROM funds WHERE fund_name=?", (fund_name,))
         return res.fetchone()[0]
 
 
     def get_fund_backward(self, fund_id):
-        cur = self.conn.cursor()
-        res = cur.execute(f"SELECT backward FROM funds WHERE fund_id='{fund_id}'")
+        res = self.execute("SELECT backward FROM funds WHERE fund_id=?", (fund_id,))
         return res.fetchone()[0]
 
 
@@ -82,7 +108,10 @@ class MFDatabase():
 
 
     def get_fundlist(self, with_cats=False, with_amcs=False):
-        df_funds = self.pd_read_sql_cached("SELECT * from funds", parse_dates=["inception"])
+        df_funds = self.pd_read_sql_cached("SELECT * from funds", parse_dates=["inception"], copy=False)
+
+        if not with_cats and not with_amcs:
+            return df_funds.copy()
 
         if with_cats:
             df_funds = pd.merge(df_funds, self.get_cat_list(), on="cat_id", how="left")
@@ -95,11 +124,16 @@ class MFDatabase():
 
     def get_cat_list(self, amc_id=""):
         qry = "SELECT DISTINCT categories.* FROM categories INNER JOIN funds ON categories.cat_id = funds.cat_id"
+        params = ()
 
         if amc_id != "" and amc_id != "0":
-            qry = qry + f" WHERE funds.amc_id='{amc_id}'"
+            qry = qry + " WHERE funds.amc_id=?"
+            params = (amc_id,)
+
+        df = self.pd_read_sql_cached(qry, params, copy=False)
+
+        df = df.assign(annualize=df["annualize"].astype(bool))
 
-        df = self.pd_read_sql_cached(qry)
         return df
 
 
@@ -109,10 +143,24 @@ class MFDatabase():
         if all:
             qry = "SELECT * from amcs"
 
-        df = self.pd_read_sql_cached(qry)
+        df = self.pd_read_sql_cached(qry, copy=False)
         return df
 
 
+    def get_metadata(self):
+        # what the page needs before its first request, the categories of an
+        # amc are the ones it has funds in
+        df = self.pd_read_sql_cached("SELECT DISTINCT amc_id, cat_id FROM funds", copy=False)
+        amc_cats = df.dropna().groupby("amc_id")["cat_id"].agg(sorted)
+
+        return {
+            "latest_date": self.get_latest_nav_date(),
+            "amcs": self.get_amc_list().to_dict(orient="records"),
+            "categories": self.get_cat_list()[["cat_id", "category"]].to_dict(orient="records"),
+            "amc_categories": amc_cats.to_dict(),
+        }
+
+
     def update_fundlist(self, rebuild=False):
         fund_list = mufap.mufap_funds_list()
         fund_list.columns = [
@@ -137,6 +185,7 @@ class MFDatabase():
             amc_list.to_sql("amcs", self.conn, if_exists="append", index=False)
 
             cat_list = mufap.mufap_category_list()
+            cat_list["annualize"] = mufap.mufap_cats_annualize(cat_list["category"])
             cat_list.to_sql("categories", self.conn, if_exists="append", index=False)
         else:
             df_funds = self.get_fundlist()
@@ -144,20 +193,50 @@ class MFDatabase():
             df_new = fund_list[fund_list["exists"] == False].drop(columns="exists")
             if not df_new.empty:
                 df_new.to_sql("funds", self.conn, if_exists="append", index=False)
+
+        self.db_cache.invalidate("funds", "amcs", "categories")
+        db_merge.touch_generation(self.path_db_main)
     
 
-    def update_attached(self, start_date):
+    def update_attached(self, start_date, incremental=False):
+        # incremental fetches funds behind start_date from their own watermarks
+        # and payouts only for funds with new navs
         df_funds = self.get_fundlist()
 
+        nav_starts = {}
+        payout_starts = {}
+        if incremental:
+            nav_starts = db_watermarks.get_starts(self.get_watermarks("navs"))
+            payout_starts = db_watermarks.get_starts(self.get_watermarks("payouts"))
+
         conn_attach = self.make_attached_db()
 
-        n = df_funds.shape[0]
+        print("Getting NAVs...")
+        df = self.__fetch_navs_bulk(start_date, df_funds)
+        df.to_sql("navs", conn_attach, if_exists="append", index=False)
+
+        # funds missing from the bulk reports or behind them, unless they
+        # stopped reporting, funds without any navs yet are new and fetched too
+        df_stopped = self.pd_read_sql_cached(
+            "SELECT fund_id FROM navs GROUP BY fund_id HAVING MAX(nav_date)<?", (start_date - timedelta(days=30),)
+        )
+        missing = ~df_funds["fund_id"].isin(df["fund_id"])
+        if incremental:
+            # nothing published yet for a tab is not missing, funds that failed
+            # stay behind their watermark and are fetched on their own next time
+            tabs = df_funds.loc[df_funds["fund_id"].isin(df["fund_id"]), "mufap_tab"]
+            missing = missing & df_funds["mufap_tab"].isin(tabs)
+            missing = missing | (df_funds["fund_id"].map(nav_starts) < start_date)
+        df_funds_missing = df_funds[missing & ~df_funds["fund_id"].isin(df_stopped["fund_id"])]
+
+        n = df_funds_missing.shape[0]
         i = 0
 
-        print("Getting NAVs...")
+        print(f"Getting NAVs for {n} funds missing from the bulk reports...")
         with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
             futures = {
-                executor.submit(lambda x: self.__fetch_navs(start_date, x), row):idx for (idx, row) in df_funds.iterrows()
+                executor.submit(self.__fetch_navs, min(nav_starts.get(row["fund_id"], start_date), start_date), row):idx
+                for (idx, row) in df_funds_missing.iterrows()
             }
 
             for future in concurrent.futures.as_completed(futures):
@@ -170,7 +249,7 @@ class MFDatabase():
                     
                         if backward == 1:
                             df["nav_date"] = df["nav_date"] - timedelta(days=1)
-                            df = df[df["nav_date"] >= start_date]
+                            df = df[df["nav_date"] >= min(nav_starts.get(df["fund_id"].iloc[0], start_date), start_date)]
                         
                         df.to_sql("navs", conn_attach, if_exists="append", index=False)
                 except Exception as e:
@@ -182,13 +261,18 @@ class MFDatabase():
 
         print("\nGetting Payouts...")
         df_funds_novps = df_funds[df_funds['mufap_tab']!='vps']
+        if incremental:
+            # a payout comes with its ex nav, funds without new navs have none
+            df_new = db_query.read_sql(conn_attach, "SELECT DISTINCT fund_id FROM navs")
+            df_funds_novps = df_funds_novps[df_funds_novps["fund_id"].isin(df_new["fund_id"])]
 
         n = df_funds_novps.shape[0]
         i = 1
 
         with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
             futures = {
-                executor.submit(lambda x: self.__fetch_payouts(start_date, x), row):idx for (idx, row) in df_funds_novps.iterrows()
+                executor.submit(self.__fetch_payouts, min(payout_starts.get(row["fund_id"], start_date), start_date), row):idx
+                for (idx, row) in df_funds_novps.iterrows()
             }
 
             for future in concurrent.futures.as_completed(futures):
@@ -199,7 +283,7 @@ class MFDatabase():
                         backward = df_funds[df_funds["fund_id"]==df["fund_id"].iloc[0]]["backward"].iloc[0]
                         if backward == 1:
                             df["payout_date"] = df["payout_date"] - timedelta(days=1)
-                            df = df[df["payout_date"] >= start_date]
+                            df = df[df["payout_date"] >= min(payout_starts.get(df["fund_id"].iloc[0], start_date), start_date)]
                         
                         df.to_sql("payouts", conn_attach, if_exists="append", index=False)
                         
@@ -213,14 +297,235 @@ class MFDatabase():
 
         conn_attach.close()
 
-    def merge_attached(self, cutoff_date):
-        self.conn.execute(f"DELETE FROM navs WHERE nav_date>='{cutoff_date}';")
-        self.conn.execute(f"DELETE FROM payouts WHERE payout_date>='{cutoff_date}';")
-        self.conn.execute(f"ATTACH DATABASE '{self.path_db_attach}' AS new_db;")
-        self.conn.execute("INSERT INTO navs SELECT * FROM new_db.navs;")
-        self.conn.execute("INSERT INTO payouts SELECT * FROM new_db.payouts;")
+    def merge_attached(self, cutoff_date, shadow=False):
+        # with shadow the merge runs on a copy which is validated and then
+        # published in one transaction, readers never see a half merged state
+        # funds fetched from their own watermarks add rows before the cutoff,
+        # returns are recomputed from the first of them
+        since = min(cutoff_date, self.get_attached_start() or cutoff_date)
+
+        if shadow:
+            conn_live = self.conn
+            self.conn = db_merge.make_shadow(conn_live, self.path_db_main)
+            try:
+                db_merge.merge(self.conn, self.path_db_attach, self.merge_tables, cutoff_date)
+                self.update_daily_returns(since)
+                self.update_watermarks()
+                db_merge.validate(conn_live, self.conn, self.path_db_attach, self.merge_tables, cutoff_date)
+                db_merge.publish(self.conn, conn_live)
+            finally:
+                db_merge.drop_shadow(self.conn, self.path_db_main)
+                self.conn = conn_live
+        else:
+            db_merge.merge(self.conn, self.path_db_attach, self.merge_tables, cutoff_date)
+            self.update_daily_returns(since)
+            self.update_watermarks()
+
+        self.db_cache.invalidate("navs", "payouts", "fund_daily_returns")
+        self.update_nav_matrix(since)
+        db_merge.touch_generation(self.path_db_main)
+
+    def get_attached_start(self):
+        return db_merge.get_first_date(self.path_db_attach, self.merge_tables)
+
+    def get_watermarks(self, source):
+        return db_watermarks.get(self.conn, source)
+
+    def get_update_start(self):
+        # day after the latest watermark, funds behind it are caught up from their own
+        marks = self.get_watermarks("navs")
+        if marks.empty:
+            return datetime.fromisoformat(self.get_latest_nav_date()) + timedelta(days=1)
+
+        return marks.max().to_pydatetime() + timedelta(days=1)
+
+    def update_watermarks(self):
+        # every fund with merged navs moves to its last one, its payouts were
+        # fetched up to the same date
+        conn_attach = self.connect_attach()
+        df = db_query.read_sql(conn_attach, "SELECT fund_id AS key, MAX(nav_date) AS last_date FROM navs GROUP BY fund_id")
+        conn_attach.close()
+
+        db_watermarks.put(self.conn, "navs", df)
+        db_watermarks.put(self.conn, "payouts", df)
+        self.conn.commit()
+
+    def export_delta(self, since):
+        return db_merge.export_delta(self.conn, self.merge_tables, since)
+
+    def apply_delta(self, blob, shadow=True):
+        # replaces every row from the delta's start date, applying it again is a no-op
+        since, frames = db_merge.read_delta(blob)
+
+        conn_attach = self.make_attached_db()
+        for table, df in frames.items():
+            df.to_sql(table, conn_attach, if_exists="append", index=False)
+        conn_attach.commit()
+        conn_attach.close()
+
+        try:
+            self.merge_attached(since, shadow=shadow)
+        finally:
+            self.path_db_attach.unlink()
+
+    def check_generation(self):
+        # another process merged, drop everything loaded from the old data
+        generation = db_merge.get_generation(self.path_db_main)
+        if generation == MFDatabase.generation:
+            return
+
+        self.db_cache.clear()
+        MFDatabase.nav_matrix = None
+        MFDatabase.nav_matrix_loaded = False
+        MFDatabase.generation = generation
+
+    def get_nav_matrix(self):
+        if not MFDatabase.nav_matrix_loaded:
+            MFDatabase.nav_matrix = NavMatrix.load(self.path_nav_matrix, self.conn)
+            MFDatabase.nav_matrix_loaded = True
+
+        return MFDatabase.nav_matrix
+
+    def build_nav_matrix(self):
+        MFDatabase.nav_matrix = NavMatrix.build(self.conn)
+        MFDatabase.nav_matrix.save(self.path_nav_matrix)
+        MFDatabase.nav_matrix_loaded = True
+
+    def update_nav_matrix(self, cutoff_date):
+        nav_matrix = self.get_nav_matrix()
+
+        if nav_matrix is None:
+            self.build_nav_matrix()
+        else:
+            MFDatabase.nav_matrix = nav_matrix.update(self.conn, cutoff_date)
+            MFDatabase.nav_matrix.save(self.path_nav_matrix)
+
+    def has_daily_returns(self):
+        return db_schema.table_exists(self.conn, "fund_daily_returns")
+
+    def build_daily_returns(self):
+        self.conn.execute("DROP TABLE IF EXISTS fund_daily_returns;")
+        self.conn.execute(
+            "CREATE TABLE fund_daily_returns (fund_id TEXT, nav_date TIMESTAMP, log_return REAL, tr_index REAL,"
+            " PRIMARY KEY (fund_id, nav_date)) WITHOUT ROWID;"
+        )
+        self.conn.execute("CREATE INDEX idx_fund_daily_returns_date ON fund_daily_returns (nav_date);")
+        self.update_daily_returns()
+
+    def update_daily_returns(self, cutoff_date=None):
+        # dividend adjusted daily log returns and the total return index built from
+        # them, rows from the cutoff are recomputed starting from the last row before it
+        if cutoff_date is not None and not self.has_daily_returns():
+            return self.build_daily_returns()
+
+        qry_navs = "SELECT fund_id, nav_date, nav FROM navs WHERE nav!=0"
+        qry_payouts = "SELECT fund_id, payout_date, payout, exnav FROM payouts"
+        params_navs = ()
+        params_payouts = ()
+        df_seeds = pd.DataFrame()
+
+        if cutoff_date is not None:
+            df_seeds = db_query.read_sql(
+                self.conn,
+                "SELECT r.fund_id, r.nav_date, n.nav, r.tr_index FROM"
+                " (SELECT fund_id, MAX(nav_date) AS nav_date, tr_index FROM fund_daily_returns"
+                " WHERE nav_date<? GROUP BY fund_id) AS r"
+                " INNER JOIN navs AS n ON n.fund_id=r.fund_id AND n.nav_date=r.nav_date AND n.nav!=0",
+                (cutoff_date,),
+                parse_dates=["nav_date"],
+            )
+            df_seeds = df_seeds.drop_duplicates(subset="fund_id", keep="last")
+
+            payouts_from = cutoff_date
+            if not df_seeds.empty:
+                payouts_from = min(df_seeds["nav_date"].min(), pd.Timestamp(cutoff_date))
+
+            qry_navs = qry_navs + " AND nav_date>=?"
+            qry_payouts = qry_payouts + " WHERE payout_date>?"
+            params_navs = (cutoff_date,)
+            params_payouts = (payouts_from,)
+
+        df = db_query.read_sql(self.conn, qry_navs, params_navs, parse_dates=["nav_date"])
+        df = df.assign(seed=False, tr_index=np.nan)
+        if not df_seeds.empty:
+            df = pd.concat([df_seeds.assign(seed=True), df])
+        df = df.drop_duplicates(subset=["fund_id", "nav_date"], keep="last")
+        df = df.sort_values(["fund_id", "nav_date"], ignore_index=True)
+
+        # every payout belongs to the first nav on or after it
+        df_payouts = db_query.read_sql(self.conn, qry_payouts, params_payouts, parse_dates=["payout_date"])
+        df_payouts["log_div"] = np.log((df_payouts["exnav"] + df_payouts["payout"]) / df_payouts["exnav"])
+        df_payouts = pd.merge_asof(
+            df_payouts.sort_values("payout_date"),
+            df[["fund_id", "nav_date"]].reset_index().sort_values("nav_date"),
+            left_on="payout_date",
+            right_on="nav_date",
+            by="fund_id",
+            direction="forward",
+        ).dropna(subset=["index"])
+        log_div = np.bincount(
+            df_payouts["index"].to_numpy(dtype=int),
+            weights=df_payouts["log_div"].to_numpy(dtype=float),
+            minlength=len(df),
+        )
+
+        first = df["fund_id"] != df["fund_id"].shift()
+        df["log_return"] = np.log(df["nav"] / df["nav"].shift()) + log_div
+        df.loc[first, "log_return"] = 0
+
+        # seeds start the cumulative sum at their stored index value
+        df["tr_index"] = np.exp(
+            df["log_return"].where(~df["seed"], np.log(df["tr_index"])).groupby(df["fund_id"]).cumsum()
+        )
+
+        df = df[~df["seed"]]
+        df = df.assign(nav_date=df["nav_date"].dt.strftime("%Y-%m-%d %H:%M:%S"))
+
+        if cutoff_date is not None:
+            self.execute("DELETE FROM fund_daily_returns WHERE nav_date>=?;", (cutoff_date,))
+        df[["fund_id", "nav_date", "log_return", "tr_index"]].to_sql(
+            "fund_daily_returns", self.conn, if_exists="append", index=False
+        )
         self.conn.commit()
-        self.conn.execute("DETACH DATABASE new_db;")
+
+        self.db_cache.invalidate("fund_daily_returns")
+        db_merge.touch_generation(self.path_db_main)
+
+    def __fetch_navs_bulk(self, start_date, df_funds):
+        # one report per mufap tab, with an empty fund name it lists every fund,
+        # rows are matched to funds on name and category, names shared by more
+        # than one fund can't be matched and those funds are fetched on their own
+        df_list = []
+        df_funds_cats = pd.merge(df_funds, self.get_cat_list()[["cat_id", "category"]], on="cat_id", how="left")
+
+        for mufap_tab, df_tab in df_funds_cats.groupby("mufap_tab"):
+            try:
+                df = mufap.mufap_fund_navs(start_date, mufap_tab=mufap_tab, full=True)
+            except Exception as e:
+                print(f"Error occurred for tab {mufap_tab}: {e}")
+                continue
+
+            df = df[["Fund Name", "Category", "NAV", "Validity Date"]]
+            df.columns = ["fund_name", "category", "nav", "nav_date"]
+
+            duplicated = df_tab.duplicated(subset=["fund_name", "category"], keep=False)
+            for (fund_name, category), df_dup in df_tab[duplicated].groupby(["fund_name", "category"], dropna=False):
+                print(f"Fund name {fund_name} ({category}) is shared by funds {', '.join(df_dup['fund_id'].astype(str))}")
+
+            df = pd.merge(df, df_tab.loc[~duplicated, ["fund_name", "category", "fund_id"]], on=["fund_name", "category"])
+            df_list.append(df)
+
+        if df_list == []:
+            return pd.DataFrame(columns=["fund_id", "nav", "nav_date"])
+
+        df = pd.concat(df_list)[["fund_id", "nav", "nav_date"]]
+
+        # backward funds are reported a day late
+        backward = df["fund_id"].map(df_funds.drop_duplicates(subset="fund_id").set_index("fund_id")["backward"]) == 1
+        df.loc[backward, "nav_date"] = df.loc[backward, "nav_date"] - timedelta(days=1)
+        df = df[~backward | (df["nav_date"] >= start_date)]
+
+        return df
 
     def __fetch_navs(self, start_date, row):
         # print(f"Getting {row['fund_id']}")
@@ -242,72 +547,8 @@ class MFDatabase():
         return df
 
 
-    def compute_return(self, df_funds, op_date, end_date):
-        df_navs_op = self.pd_read_sql_cached(f"SELECT * from navs WHERE nav_date='{op_date}'")
-        
-        df_navs_cl = self.pd_read_sql_cached(f"SELECT * from navs WHERE nav_date='{end_date}'")
-
-        df_funds["annualize"] = df_funds["category"].apply(mufap.mufap_cat_annualize)
-
-        df_navs_op = df_navs_op[df_navs_op["nav"] != 0]
-        df_navs_cl = df_navs_cl[df_navs_cl["nav"] != 0]
-
-        # add missing op navs
-        df_funds_missing = pd.merge(df_funds, df_navs_op, on='fund_id', how='left')
-        df_funds_missing = df_funds_missing[df_funds_missing["nav"].isna() & (df_funds_missing["inception"]<=op_date)]
-        df_funds_missing = df_funds_missing.merge(df_navs_cl, on='fund_id', how='left')
-        df_funds_missing = df_funds_missing[~df_funds_missing["nav_y"].isna()]
-        
-        df_funds_missing_eq = df_funds_missing[~df_funds_missing["annualize"]]
-        
-        if not df_funds_missing_eq.empty:
-            df_funds_missing_eq = self.get_navs_last(df_funds_missing_eq['fund_id'], op_date)
-            df_navs_op = pd.concat([df_navs_op, df_funds_missing_eq])
-
-        df_funds_missing_fi = df_funds_missing[df_funds_missing["annualize"]]
-        if not df_funds_missing_fi.empty:
-            df_funds_missing_fi["nav"] = df_funds_missing_fi['fund_id'].apply(lambda x: self.get_nav_interpolated(x, op_date))
-            df_funds_missing_fi['nav_date'] = op_date
-            df_funds_missing_fi = df_funds_missing_fi[['fund_id', 'nav_date','nav']]
-            df_navs_op = pd.concat([df_navs_op, df_funds_missing_fi])
-
-        del df_navs_op["nav_date"]
-        del df_navs_cl["nav_date"]
-
-        if not df_navs_cl.empty:
-            df = df_navs_op.merge(df_navs_cl, on="fund_id", how="inner")
-            df = df[(df["nav_x"] != 0) & (df["nav_y"] != 0)]
-
-            df_payouts = pd.read_sql(
-                f"SELECT * FROM payouts WHERE payout_date>'{op_date}' AND payout_date<='{end_date}'",
-                self.conn,
-            )
-            if df_payouts.empty:
-                df_payouts["div_factor"] = 1
-            else:
-                df_payouts["div_factor"] = (
-                    df_payouts["exnav"] + df_payouts["payout"]
-                ) / df_payouts["exnav"]
-                df_payouts = df_payouts[["fund_id", "div_factor"]]
-                df_payouts = df_payouts.groupby("fund_id").prod()
-
-            df = pd.merge(df, df_payouts, on="fund_id", how="left")
-            df["div_factor"] = df["div_factor"].fillna(1)
-            df["return"] = df["nav_y"] / df["nav_x"] * df["div_factor"] - 1
-
-            return df
-
-        else:
-            return pd.DataFrame()
-
     def get_schema(self):
-        schema = ""
-        cursor = self.conn.cursor()
-        cursor.execute('select sql from sqlite_master')
-        for r in cursor.fetchall():
-            schema = schema + r[0] + "; \n"
-        cursor.close()
-        return schema
+        return db_schema.get_schema(self.conn)
 
     def make_attached_db(self):
         if self.path_db_attach.exists():
@@ -321,98 +562,284 @@ class MFDatabase():
 
         return conn_attach
 
-    def __annualize_return(self, ret, delta_days):
-        r = 0
+    @staticmethod
+    def annualize_return(ret, delta_days):
         if delta_days > 365:
-            r = (ret + 1) ** (365 / delta_days) - 1
-        else:
-            r = ret * 365 / delta_days
-        return r
+            return (ret + 1) ** (365 / delta_days) - 1
+        return ret * 365 / delta_days
 
-    def annualize_retun(self, df, ret_col, delta_days):
-        df["annualize"] = df["category"].apply(mufap.mufap_cat_annualize)
-
-        df[ret_col] = df.apply(
-            lambda x: self.__annualize_return(x[ret_col], delta_days)
-            if x["annualize"]
-            else x[ret_col],
-            axis=1,
-        )
-        return df
-    
     def get_nav_interpolated(self, fund_id, nav_date):
-        df_nav_after = self.pd_read_sql_cached(f"SELECT * from navs WHERE fund_id='{fund_id}'" 
-                                               f" AND nav_date>'{nav_date}' AND nav!=0 ORDER BY nav_date ASC LIMIT 1", parse_dates=['nav_date'])
-
-        if df_nav_after.empty:
+        df = self.get_navs_interpolated(pd.Series([fund_id]), nav_date)
+        if df.empty:
             return None
-        
-        df_nav_before = self.pd_read_sql_cached(f"SELECT * from navs WHERE fund_id='{fund_id}'"
-                                                f" AND nav_date<'{nav_date}' AND nav!=0 ORDER BY nav_date DESC LIMIT 1", parse_dates=['nav_date'])
+        return df["nav"].iloc[0]
+
+    def get_navs_interpolated(self, df_fund_ids, nav_date):
+        nav_matrix = self.get_nav_matrix()
+        if nav_matrix is not None:
+            df = pd.DataFrame({"fund_id": df_fund_ids.tolist()})
+            df["nav"] = nav_matrix.get_navs_interpolated(df["fund_id"], nav_date)
+            return df.dropna()
+
+        fund_ids = tuple(df_fund_ids.tolist())
+
+        # nearest navs on either side of the date
+        qry = ("SELECT fund_id, nav, MAX(nav_date) AS nav_date, 'before' AS side"
+                " FROM navs"
+                " WHERE nav_date < ? AND nav != 0"
+                " AND fund_id IN ?"
+                " GROUP BY fund_id"
+                " UNION ALL"
+                " SELECT fund_id, nav, MIN(nav_date) AS nav_date, 'after' AS side"
+                " FROM navs"
+                " WHERE nav_date > ? AND nav != 0"
+                " AND fund_id IN ?"
+                " GROUP BY fund_id")
+        df = self.pd_read_sql_cached(qry, (nav_date, fund_ids, nav_date, fund_ids), parse_dates=["nav_date"], copy=False)
+
+        df_before = df[df["side"] == "before"].set_index("fund_id")
+        df_after = df[df["side"] == "after"].set_index("fund_id")
+        df = df_before[["nav", "nav_date"]].join(df_after[["nav", "nav_date"]], how="inner", rsuffix="_after")
 
-        if df_nav_before.empty:
-            return None
-        
-        df = pd.concat([df_nav_before, df_nav_after])
+        if df.empty:
+            return pd.DataFrame(columns=["fund_id", "nav"])
+
+        # a payout on the nav date after gives the cum-dividend nav
+        df_payouts = self.pd_read_sql_cached(
+            "SELECT * FROM payouts WHERE fund_id IN ? AND payout_date>? AND payout_date<=?",
+            (fund_ids, df["nav_date"].min(), df["nav_date_after"].max()),
+            parse_dates=["payout_date"],
+            copy=False,
+        )
+        df_payouts = df_payouts.assign(full_nav=df_payouts["exnav"] + df_payouts["payout"])
+        df_payouts = df_payouts.drop_duplicates(subset=["fund_id", "payout_date"])
+        df = df.reset_index().merge(
+            df_payouts[["fund_id", "payout_date", "full_nav"]],
+            how="left",
+            left_on=["fund_id", "nav_date_after"],
+            right_on=["fund_id", "payout_date"],
+        )
+        nav_after = df["full_nav"].fillna(df["nav_after"])
 
-        df_payouts = pd.read_sql(
-                f"SELECT * FROM payouts WHERE fund_id='{fund_id}' "
-                f"AND payout_date>'{df['nav_date'].min()}' AND payout_date<='{df['nav_date'].max()}'",
-                self.conn, parse_dates=['payout_date']
-            )
-        if not df_payouts.empty:
-            df_payouts['full_nav'] = df_payouts['exnav'] + df_payouts['payout']
-            df = df.merge(df_payouts[['payout_date', 'full_nav']], how='left', left_on='nav_date', right_on='payout_date')
-            df['full_nav'] = df['full_nav'].fillna(df['nav'])
-            df = df.drop(['nav','payout_date'], axis=1)
-            df = df.rename(columns={'full_nav':'nav'})
-
-        df = df.drop(['fund_id'], axis=1)
-        df = df.set_index('nav_date').asfreq('D').interpolate()
-        nav = df.loc[nav_date]
-        return nav['nav']
+        days = (pd.Timestamp(nav_date) - df["nav_date"]).dt.days
+        days_total = (df["nav_date_after"] - df["nav_date"]).dt.days
+        df["nav"] = df["nav"] + (nav_after - df["nav"]) * days / days_total
+
+        return df[["fund_id", "nav"]]
     
     def get_navs_last(self, df_fund_ids, nav_date):
-        fund_ids = str(df_fund_ids.tolist())[1:-1]
-        qry = (f"SELECT fund_id, nav, MAX(nav_date) AS max_nav_date"
-                f" FROM navs"
-                f" WHERE nav_date <= '{nav_date}' AND nav != 0"
-                f" AND fund_id IN ({fund_ids})"
-                f" GROUP BY fund_id")
-        df = self.pd_read_sql_cached(qry)
+        nav_matrix = self.get_nav_matrix()
+        if nav_matrix is not None:
+            return nav_matrix.get_navs_last(df_fund_ids, nav_date)
+
+        qry = ("SELECT fund_id, nav, MAX(nav_date) AS max_nav_date"
+                " FROM navs"
+                " WHERE nav_date <= ? AND nav != 0"
+                " AND fund_id IN ?"
+                " GROUP BY fund_id")
+        df = self.pd_read_sql_cached(qry, (nav_date, tuple(df_fund_ids.tolist())))
 
         return df
 
         
-    def get_performance(self, op_date, end_date):
-        df_funds = self.get_fundlist(with_cats=True)
+    def get_navs_missing(self, df_funds_missing, op_date):
+        # equity funds carry their last nav forward, fixed income funds are interpolated
+        df_list = []
 
-        df = self.compute_return(df_funds, op_date, end_date)
+        df_funds_missing_eq = df_funds_missing[~df_funds_missing["annualize"]]
+        if not df_funds_missing_eq.empty:
+            df = self.get_navs_last(df_funds_missing_eq["fund_id"], op_date)
+            df_list.append(df[["fund_id", "nav"]])
 
-        if df.empty:
-            return df
+        df_funds_missing_fi = df_funds_missing[df_funds_missing["annualize"]]
+        if not df_funds_missing_fi.empty:
+            df_list.append(self.get_navs_interpolated(df_funds_missing_fi["fund_id"], op_date))
 
-        df = pd.merge(df_funds, df, on="fund_id", how="left")
-        
-        delta_days = (end_date - op_date).days
-        df = self.annualize_retun(df, "return", delta_days)
-        df["return"] = round(df["return"] * 100, 2)
+        if df_list == []:
+            return pd.DataFrame(columns=["fund_id", "nav"])
+
+        return pd.concat(df_list)
+
+    def get_navs_panel(self, fund_ids, nav_dates):
+        nav_matrix = self.get_nav_matrix()
+        if nav_matrix is not None:
+            return nav_matrix.get_navs(fund_ids, nav_dates)
+
+        df = self.pd_read_sql_cached("SELECT * FROM navs WHERE nav_date IN ? AND nav!=0", (tuple(nav_dates),), copy=False)
+        df = df.pivot_table(index="fund_id", columns="nav_date", values="nav", aggfunc="last")
+        df = df.reindex(index=fund_ids, columns=[str(x) for x in nav_dates])
+
+        return df.to_numpy(dtype=float)
+
+    def get_tr_panel(self, fund_ids, nav_dates):
+        if not self.has_daily_returns():
+            return None
+
+        df = self.pd_read_sql_cached(
+            "SELECT fund_id, nav_date, tr_index FROM fund_daily_returns WHERE nav_date IN ?",
+            (tuple(nav_dates),),
+            copy=False,
+        )
+        df = df.pivot_table(index="fund_id", columns="nav_date", values="tr_index", aggfunc="last")
+        df = df.reindex(index=fund_ids, columns=[str(x) for x in nav_dates])
+
+        return df.to_numpy(dtype=float)
+
+    def get_returns_navs(self, df_funds, op_date, end_date):
+        # returns from navs and payouts, missing opening navs are filled in
+        fund_ids = pd.Index(df_funds["fund_id"])
+        inception = df_funds["inception"].to_numpy()
+
+        navs = self.get_navs_panel(fund_ids, [op_date, end_date])
+        nav_op = navs[:, 0].copy()
+        nav_cl = navs[:, 1]
+
+        missing = np.isnan(nav_op) & ~np.isnan(nav_cl) & (inception <= np.datetime64(op_date))
+        if missing.any():
+            df_navs = self.get_navs_missing(df_funds[missing], op_date)
+            df_navs = df_navs.drop_duplicates(subset="fund_id").set_index("fund_id")
+            nav_op[missing] = df_navs["nav"].reindex(fund_ids[missing]).to_numpy(dtype=float)
+
+        df_payouts = self.pd_read_sql_cached(
+            "SELECT * FROM payouts WHERE payout_date>? AND payout_date<=?",
+            (op_date, end_date),
+            copy=False,
+        )
+        pay_idx = fund_ids.get_indexer(df_payouts["fund_id"])
+        pay_log = np.log(
+            (df_payouts["exnav"] + df_payouts["payout"]) / df_payouts["exnav"]
+        ).to_numpy(dtype=float)
+        div_factor = np.exp(
+            np.bincount(pay_idx[pay_idx >= 0], weights=pay_log[pay_idx >= 0], minlength=len(fund_ids))
+        )
+
+        return nav_cl / nav_op * div_factor - 1
+
+    def get_performance(self, op_date, end_date):
+        df = self.get_performance_multi([("return", op_date, end_date)])
+
+        if df["return"].isna().all():
+            return pd.DataFrame()
 
         return df
 
     def get_performance_multi(self, dates_list):
+        # every fund, cached until the funds or navs change so that filters
+        # only slice it
+        key = ("performance", tuple(dates_list))
+        tables = ("funds", "categories", "navs", "payouts", "fund_daily_returns")
+        generations = self.db_cache.get_generations(tables)
+        df = self.db_cache.get(key)
+        if df is None:
+            df = self.__get_performance_multi(dates_list)
+            self.db_cache.put(key, df, tables, generations)
+
+        return df.copy()
+
+    def __get_performance_multi(self, dates_list):
         df_funds = self.get_fundlist(with_cats=True)
+        df_funds["annualize"] = df_funds["annualize"].eq(True)
+
+        fund_ids = pd.Index(df_funds["fund_id"])
+        annualize = df_funds["annualize"].to_numpy(dtype=bool)
+        inception = df_funds["inception"].to_numpy()
+
+        # one total return index panel for every anchor date
+        nav_dates = sorted({x for _, op_date, end_date in dates_list for x in (op_date, end_date)})
+        tr = self.get_tr_panel(fund_ids, nav_dates)
+        tr_cols = {x: i for i, x in enumerate(nav_dates)}
 
         for title, op_date, end_date in dates_list:
-            df = self.compute_return(df_funds, op_date, end_date)
-            df = df.rename(columns={'return': title})
-            df_funds = df_funds.merge(df[["fund_id", title]], on="fund_id", how="left")
-            delta_days = (end_date - op_date).days
-            df_funds = self.annualize_retun(df_funds, title, delta_days)
-            df_funds[title] = round(df_funds[title] * 100, 2)
+            if tr is None:
+                ret = self.get_returns_navs(df_funds, op_date, end_date)
+            else:
+                tr_cl = tr[:, tr_cols[end_date]]
+                ret = tr_cl / tr[:, tr_cols[op_date]] - 1
+
+                # no nav on the opening date, fall back to navs and payouts
+                missing = np.isnan(ret) & ~np.isnan(tr_cl) & (inception <= np.datetime64(op_date))
+                if missing.any():
+                    ret[missing] = self.get_returns_navs(df_funds[missing], op_date, end_date)
+
+            ret_ann = self.annualize_return(ret, (end_date - op_date).days)
+
+            df_funds[title] = np.round(np.where(annualize, ret_ann, ret) * 100, 2)
 
         return df_funds
 
+    def get_risk_metrics(self, op_date, end_date, fund_ids=None, rf_name="pkrv_1y", index_id="1"):
+        # every fund, cached until the navs change so that filters only slice it
+        key = ("risk", op_date, end_date, rf_name, index_id)
+        tables = ("navs", "payouts")
+        generations = self.db_cache.get_generations(tables)
+        df = self.db_cache.get(key)
+        if df is None:
+            df = self.__get_risk_metrics(op_date, end_date, rf_name, index_id)
+            self.db_cache.put(key, df, tables, generations)
+
+        if fund_ids is None:
+            return df.copy()
+
+        return pd.DataFrame({"fund_id": list(fund_ids)}).merge(df, on="fund_id", how="left")
+
+    def __get_risk_metrics(self, op_date, end_date, rf_name, index_id):
+        # annualized volatility, max drawdown, sharpe against the average rate of
+        # rf_name and beta to index_id for every fund, from the navs grossed up
+        # for payouts, sharpe and beta are nan without the benchmarks database
+        if self.get_nav_matrix() is None:
+            self.build_nav_matrix()
+        nav_matrix = MFDatabase.nav_matrix
+
+        fund_ids = pd.Index(nav_matrix.fund_ids)
+
+        tr = nav_matrix.get_tr_index(fund_ids, op_date, end_date)
+        returns, prev = risk.get_interval_returns(tr)
+
+        # days between the first and the last nav of each fund in the window
+        valid = ~np.isnan(tr)
+        span = (tr.shape[1] - 1 - valid[:, ::-1].argmax(axis=1)) - valid.argmax(axis=1)
+        count = (~np.isnan(returns)).sum(axis=1)
+        found = count > 0
+
+        volatility = np.full(len(fund_ids), np.nan)
+        ret = np.full(len(fund_ids), np.nan)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            volatility[found] = risk.get_stddev(returns[found]) * np.sqrt(count[found] * 365 / span[found])
+            ret[found] = np.exp(np.nansum(returns[found], axis=1)) - 1
+            ret_ann = np.where(span > 365, (ret + 1) ** (365 / span) - 1, ret * 365 / span)
+
+        rf = np.nan
+        bm_returns = np.full(returns.shape, np.nan)
+        if BMDatabase.path_db_main.exists():
+            with BMDatabase() as bm_db:
+                bms = bm_db.get_bm_info()
+                bm_ids = bms.loc[bms["bm_name"] == rf_name, "bm_id"]
+                if not bm_ids.empty:
+                    rate = bm_db.get_fi_avg(bm_ids.iloc[0], op_date, end_date)
+                    if rate is not None:
+                        rf = rate / 100
+
+                # index returns over the same days as each fund return
+                dates = pd.date_range(to_day(op_date), periods=tr.shape[1]).strftime("%Y-%m-%d")
+                if len(dates) > 0:
+                    index_log = np.log(bm_db.get_index_closes(index_id, list(dates)))
+                    bm_returns = np.where(np.isnan(returns), np.nan, index_log - index_log[prev.clip(0)])
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            sharpe = np.where(volatility > 0, (ret_ann - rf) / volatility, np.nan)
+
+        df = pd.DataFrame(
+            {
+                "fund_id": fund_ids,
+                "volatility": volatility,
+                "max_drawdown": risk.get_max_drawdown(tr),
+                "sharpe": sharpe,
+                "beta": risk.get_beta(returns, bm_returns),
+            }
+        )
+
+        return df
+
 
 if __name__ == "__main__":
 
@@ -422,8 +849,8 @@ if __name__ == "__main__":
         # db_update_fundlist(conn)
         # db_update_fundlist(conn, True)
         #db.db_make_attached_db()
-        cutoff_date = datetime(2023, 7, 22)
-        db.update_attached(cutoff_date)
+        cutoff_date = db.get_update_start()
+        db.update_attached(cutoff_date, incremental=True)
         #db.update_attached(cutoff_date)
         # db.merge_attached(cutoff_date)
         # db.path_db_attach.unlink()
@@ -0,0 +1,133 @@
+import queue
+import sqlite3
+import threading
+
+import db_query
+import db_schema
+
+
+class ConnectionPool:
+    # per process pool of read only connections and one writer, in WAL mode
+    # readers keep reading the last committed state while the writer merges
+
+    def __init__(
+        self,
+        path,
+        migrations=None,
+        size=5,
+        mmap_size=256 * 1024 * 1024,
+        cache_size=-64 * 1024,
+        busy_timeout=10000,
+    ):
+        self.path = path
+        self.migrations = migrations
+        self.size = size
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        self.busy_timeout = busy_timeout
+
+        self.readers = queue.LifoQueue()
+        self.n_readers = 0
+        self.readers_lock = threading.Lock()
+
+        self.writer = None
+        self.writer_lock = threading.Lock()
+
+    def __configure(self, conn):
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout)}")
+        conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        conn.execute(f"PRAGMA cache_size={int(self.cache_size)}")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def __make_writer(self):
+        conn = sqlite3.connect(
+            self.path,
+            check_same_thread=False,
+            cached_statements=db_query.cached_statements,
+        )
+        # WAL is stored in the database file, readers pick it up from there
+        conn.execute("PRAGMA journal_mode=WAL")
+        self.__configure(conn)
+
+        if self.migrations is not None:
+            db_schema.migrate(conn, self.migrations)
+
+        return conn
+
+    def __make_reader(self):
+        conn = sqlite3.connect(
+            f"file:{self.path}?mode=ro",
+            uri=True,
+            check_same_thread=False,
+            cached_statements=db_query.cached_statements,
+        )
+        return self.__configure(conn)
+
+    def open(self):
+        # sets up the writer and every reader up front, outside the request path
+        with self.writer_lock:
+            if self.writer is None:
+                self.writer = self.__make_writer()
+
+        with self.readers_lock:
+            while self.n_readers < self.size:
+                self.readers.put(self.__make_reader())
+                self.n_readers += 1
+
+        return self
+
+    def acquire(self, writer=False):
+        if writer:
+            self.writer_lock.acquire()
+            if self.writer is None:
+                try:
+                    self.writer = self.__make_writer()
+                except Exception:
+                    self.writer_lock.release()
+                    raise
+            return self.writer
+
+        try:
+            return self.readers.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.readers_lock:
+            make = self.n_readers < self.size
+            if make:
+                self.n_readers += 1
+
+        if not make:
+            return self.readers.get()
+
+        try:
+            return self.__make_reader()
+        except Exception:
+            with self.readers_lock:
+                self.n_readers -= 1
+            raise
+
+    def release(self, conn):
+        if conn is self.writer:
+            self.writer_lock.release()
+            return
+
+        # a reader left in a transaction would keep seeing an old snapshot
+        if conn.in_transaction:
+            conn.rollback()
+        self.readers.put(conn)
+
+    def close(self):
+        with self.writer_lock:
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+
+        with self.readers_lock:
+            while True:
+                try:
+                    self.readers.get_nowait().close()
+                except queue.Empty:
+                    break
+                self.n_readers -= 1
@@ -0,0 +1,104 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+
+# prepared statements kept per connection
+cached_statements = 512
+
+# IN lists longer than this are joined through a temp table
+max_in_params = 100
+
+
+def is_list(value):
+    return isinstance(value, (list, tuple, set, pd.Series, pd.Index, np.ndarray))
+
+
+def bind_value(value):
+    # dates are stored as text in the format str() gives them
+    if isinstance(value, datetime.date):
+        return str(value)
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def get_key(qry, params, parse_dates=None):
+    # the same query read with other parse_dates gives a different frame
+    if isinstance(parse_dates, dict):
+        parse_dates = tuple(sorted(parse_dates.items()))
+    elif is_list(parse_dates):
+        parse_dates = tuple(parse_dates)
+
+    return (
+        qry,
+        tuple(tuple(bind_value(x) for x in p) if is_list(p) else bind_value(p) for p in params),
+        parse_dates,
+    )
+
+
+def fill_temp_table(conn, table, values):
+    in_transaction = conn.in_transaction
+
+    conn.execute(f"CREATE TEMP TABLE IF NOT EXISTS {table} (value PRIMARY KEY) WITHOUT ROWID")
+    conn.execute(f"DELETE FROM temp.{table}")
+    conn.executemany(f"INSERT OR IGNORE INTO temp.{table} VALUES (?)", [(x,) for x in values])
+
+    # do not leave a transaction open that only touched the temp table
+    if not in_transaction:
+        conn.commit()
+
+
+def expand(conn, qry, params):
+    # a "?" bound to a list becomes "(?, ?, ...)", or a temp table select
+    # when the list is long, every other "?" is bound as it is
+    parts = qry.split("?")
+    if len(parts) - 1 != len(params):
+        raise ValueError(f"Query has {len(parts) - 1} parameters, {len(params)} given")
+
+    sql = parts[0]
+    values = []
+
+    for i, (param, part) in enumerate(zip(params, parts[1:])):
+        if not is_list(param):
+            sql = sql + "?"
+            values.append(bind_value(param))
+        else:
+            param = [bind_value(x) for x in param]
+            if len(param) > max_in_params:
+                fill_temp_table(conn, f"in_list_{i}", param)
+                sql = sql + f"(SELECT value FROM temp.in_list_{i})"
+            else:
+                sql = sql + "(" + ", ".join("?" * len(param)) + ")"
+                values.extend(param)
+
+        sql = sql + part
+
+    return sql, values
+
+
+def execute(conn, qry, params=()):
+    sql, values = expand(conn, qry, params)
+    return conn.execute(sql, values)
+
+
+def read_sql(conn, qry, params=(), parse_dates=None):
+    sql, values = expand(conn, qry, params)
+    return pd.read_sql(sql, conn, params=values, parse_dates=parse_dates)
+
+
+def read_sql_cached(conn, cache, qry, params=(), parse_dates=None, copy=True):
+    # copy=False hands out the cached frame itself, callers must not mutate it
+    key = get_key(qry, params, parse_dates)
+    tables = cache.get_tables(qry)
+    generations = cache.get_generations(tables)
+    df = cache.get(key)
+
+    if df is None:
+        df = read_sql(conn, qry, params, parse_dates)
+        cache.put(key, df, tables, generations)
+
+    if copy:
+        return df.copy()
+    return df
@@ -0,0 +1,187 @@
+import db_watermarks
+
+
+# tables are rebuilt clustered on their key, repeated merges then replace rows
+# instead of duplicating them
+def rebuild_table(conn, table, columns, key):
+    # columns are only used when the table does not exist yet
+    existing = conn.execute(f"PRAGMA table_info({table})").fetchall()
+    if existing:
+        columns = [(r[1], r[2]) for r in existing]
+
+    cols_def = ", ".join(f"{name} {col_type}".strip() for name, col_type in columns)
+    key_def = ", ".join(key)
+    conn.execute(f"DROP TABLE IF EXISTS {table}_new")
+    conn.execute(f"CREATE TABLE {table}_new ({cols_def}, PRIMARY KEY ({key_def})) WITHOUT ROWID")
+
+    if existing:
+        names = ", ".join(name for name, _ in columns)
+        not_null = " AND ".join(f"{x} IS NOT NULL" for x in key)
+        # the row merged last wins
+        conn.execute(
+            f"INSERT OR REPLACE INTO {table}_new ({names})"
+            f" SELECT {names} FROM {table} WHERE {not_null} ORDER BY rowid"
+        )
+        conn.execute(f"DROP TABLE {table}")
+
+    conn.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+
+def table_exists(conn, table):
+    res = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,))
+    return res.fetchone() is not None
+
+
+def mufap_keys(conn):
+    rebuild_table(
+        conn,
+        "navs",
+        [("fund_id", "TEXT"), ("nav", "REAL"), ("nav_date", "TIMESTAMP")],
+        ["fund_id", "nav_date"],
+    )
+    rebuild_table(
+        conn,
+        "payouts",
+        [("fund_id", "TEXT"), ("payout", "REAL"), ("exnav", "REAL"), ("payout_date", "TIMESTAMP")],
+        ["fund_id", "payout_date"],
+    )
+    # the fund_id key is carried by every index of a WITHOUT ROWID table
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_navs_date ON navs (nav_date, nav)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_payouts_date ON payouts (payout_date, payout, exnav)")
+
+
+def mufap_cats_annualize(conn):
+    if not table_exists(conn, "categories"):
+        return
+
+    columns = [r[1] for r in conn.execute("PRAGMA table_info(categories)").fetchall()]
+    if "annualize" not in columns:
+        conn.execute("ALTER TABLE categories ADD COLUMN annualize INTEGER")
+
+    # the rule as mufap_cats_annualize had it when this migration was added,
+    # frozen here so that later scraper changes do not change the migration
+    conn.execute(
+        "UPDATE categories SET annualize=COALESCE("
+        "instr(category, 'Income')>0 OR instr(category, 'Money Market')>0"
+        " OR instr(category, 'Fixed Rate')>0 OR instr(category, 'Debt')>0, 0)"
+    )
+
+
+def benchmarks_keys(conn):
+    rebuild_table(
+        conn,
+        "psx_scrips",
+        [("close_date", "TEXT"), ("symbol", "TEXT"), ("close", "REAL"), ("ldcp", "REAL"), ("volume", "INTEGER")],
+        ["symbol", "close_date"],
+    )
+    rebuild_table(
+        conn,
+        "psx_indexes",
+        [("index_date", "TEXT"), ("bm_id", "TEXT"), ("close", "REAL")],
+        ["bm_id", "index_date"],
+    )
+    rebuild_table(
+        conn,
+        "fi_rates",
+        [("bm_date", "TEXT"), ("rate", "REAL"), ("bm_id", "TEXT")],
+        ["bm_id", "bm_date"],
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_psx_scrips_date ON psx_scrips (close_date, close, ldcp, volume)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_psx_indexes_date ON psx_indexes (index_date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_fi_rates_date ON fi_rates (bm_date)")
+
+
+def mufap_watermarks(conn):
+    # navs and payouts have been fetched together up to each fund's last nav
+    db_watermarks.create_table(conn)
+    for source in ("navs", "payouts"):
+        conn.execute(
+            "INSERT OR IGNORE INTO watermarks (source, key, last_date)"
+            " SELECT ?, fund_id, date(MAX(nav_date)) FROM navs GROUP BY fund_id",
+            (source,),
+        )
+
+
+def benchmarks_watermarks(conn):
+    db_watermarks.create_table(conn)
+    conn.execute(
+        "INSERT OR IGNORE INTO watermarks (source, key, last_date)"
+        " SELECT 'psx_indexes', bm_id, date(MAX(index_date)) FROM psx_indexes GROUP BY bm_id"
+    )
+    conn.execute(
+        "INSERT OR IGNORE INTO watermarks (source, key, last_date)"
+        " SELECT 'psx_scrips', '', date(MAX(close_date)) FROM psx_scrips HAVING COUNT(*)>0"
+    )
+
+    if not table_exists(conn, "benchmarks"):
+        return
+
+    # pkrv and kibor come from different pages but share fi_rates
+    for source in ("pkrv", "kibor"):
+        conn.execute(
+            "INSERT OR IGNORE INTO watermarks (source, key, last_date)"
+            " SELECT ?, '', date(MAX(r.bm_date)) FROM fi_rates AS r"
+            " INNER JOIN benchmarks AS b ON b.bm_id=r.bm_id WHERE b.bm_name LIKE ? HAVING COUNT(*)>0",
+            (source, f"{source}%"),
+        )
+
+
+# migrations run in order, the list position is the schema version
+mufap_migrations = [
+    mufap_keys,
+    mufap_cats_annualize,
+    mufap_watermarks,
+]
+
+benchmarks_migrations = [
+    benchmarks_keys,
+    benchmarks_watermarks,
+]
+
+
+def get_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn, migrations):
+    version = get_version(conn)
+    if version >= len(migrations):
+        return version
+
+    # each migration commits together with its version number, the version is
+    # read again under the write lock in case another process got there first
+    for i, migration in enumerate(migrations[version:], start=version + 1):
+        conn.execute("BEGIN IMMEDIATE")
+        if get_version(conn) >= i:
+            conn.rollback()
+            continue
+
+        print(f"Migrating {migration.__name__} (schema version {i})...")
+        try:
+            migration(conn)
+            conn.execute(f"PRAGMA user_version={i}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    conn.execute("ANALYZE")
+    conn.commit()
+
+    return len(migrations)
+
+
+def get_schema(conn):
+    # plain tables without keys or indexes, used for the attached staging
+    # databases so that fetching never fails on a duplicate row
+    schema = ""
+    tables = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'"
+    ).fetchall()
+
+    for (table,) in tables:
+        columns = conn.execute(f"PRAGMA table_info({table})").fetchall()
+        cols_def = ", ".join(f"{r[1]} {r[2]}".strip() for r in columns)
+        schema = schema + f"CREATE TABLE {table} ({cols_def}); \n"
+
+    return schema
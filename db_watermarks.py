@@ -0,0 +1,33 @@
+import datetime
+
+import pandas as pd
+
+import db_query
+
+
+# last date stored for each source and key, updates fetch from the day after it
+def create_table(conn):
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS watermarks (source TEXT, key TEXT, last_date TEXT,"
+        " PRIMARY KEY (source, key)) WITHOUT ROWID"
+    )
+
+
+def get(conn, source):
+    df = db_query.read_sql(conn, "SELECT key, last_date FROM watermarks WHERE source=?", (source,))
+    return pd.Series(pd.to_datetime(df["last_date"]).to_numpy(), index=df["key"].to_numpy())
+
+
+def put(conn, source, df):
+    # df has key and last_date columns, a watermark only ever moves forward
+    df = df.dropna(subset=["last_date"])
+    conn.executemany(
+        "INSERT INTO watermarks (source, key, last_date) VALUES (?, ?, ?)"
+        " ON CONFLICT (source, key) DO UPDATE SET last_date=MAX(last_date, excluded.last_date)",
+        [(source, key, str(last_date)[:10]) for key, last_date in df[["key", "last_date"]].itertuples(index=False)],
+    )
+
+
+def get_starts(marks):
+    # day after each watermark
+    return {key: x.to_pydatetime() + datetime.timedelta(days=1) for key, x in marks.items()}
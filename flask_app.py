@@ -1,8 +1,19 @@
-from flask import Flask, render_template, request, json
+from flask import Flask, Response, render_template, request, json
 from time import sleep
 from datetime import datetime
+import gzip
+import hashlib
+import hmac
+import os
 
+import pandas as pd
+
+from db_benchmarks import BMDatabase
 from db_mufap import MFDatabase
+from db_pool import ConnectionPool
+from query_cache import QueryCache
+import db_merge
+import db_schema
 import perf
 
 
@@ -17,25 +28,88 @@ class CustomFlask(Flask):
 
 
 app = CustomFlask(__name__, static_folder="static")
-config = {"DEBUG": True}
+# merges rewrite navs and payouts, only callers sending this token may run them,
+# larger request bodies are refused with 413
+config = {
+    "DEBUG": True,
+    "MERGE_TOKEN": os.environ.get("MFPERF_MERGE_TOKEN", ""),
+    "MAX_CONTENT_LENGTH": int(os.environ.get("MFPERF_MAX_DELTA_MB", "64")) * 1024 * 1024,
+}
 app.config.from_mapping(config)
 
+# connections are opened once per process, requests borrow them
+MFDatabase.pool = ConnectionPool(MFDatabase.path_db_main, db_schema.mufap_migrations).open()
+
+# gzipped responses keyed by the normalized request and the data generation
+response_cache = QueryCache(max_bytes=32 * 1024 * 1024)
+
 
 @app.route("/")
 def home():
     return render_template("home.html")
 
 
-@app.route("/performance", methods=["POST"])
-def performance():
-    data = request.get_json()
-    end_date = datetime.fromisoformat(data["end_date"])
+def get_perf_params(data):
+    # requests asking for the same table get the same key, "0" and empty mean
+    # every category or amc and start_date only matters for custom periods
+    cat_ids = sorted(set(data.get("cat_ids", [])))
+    if "0" in cat_ids:
+        cat_ids = []
+
+    amc_id = data.get("amc_id", "")
+    if amc_id == "0":
+        amc_id = ""
+
+    start_date = ""
+    if data["period_type"] != "mufap":
+        start_date = datetime.fromisoformat(data["start_date"]).date().isoformat()
+
+    return (
+        ("period_type", "mufap" if data["period_type"] == "mufap" else "custom"),
+        ("start_date", start_date),
+        ("end_date", datetime.fromisoformat(data["end_date"]).date().isoformat()),
+        ("cat_ids", tuple(cat_ids)),
+        ("amc_id", amc_id),
+        ("with_risk", str(data.get("with_risk", False)).lower() in ["1", "true", "on"]),
+    )
+
+
+def get_page_params(data):
+    # optional server side sorting by a column name and paging, a length of 0
+    # returns every row
+    return (
+        ("start", max(int(data.get("start", 0)), 0)),
+        ("length", max(int(data.get("length", 0)), 0)),
+        ("order", data.get("order", "")),
+        ("dir", "desc" if data.get("dir", "asc") == "desc" else "asc"),
+    )
+
+
+def get_request_data():
+    if request.method == "POST":
+        return request.get_json()
+
+    data = request.args.to_dict()
+    data["cat_ids"] = request.args.getlist("cat_ids")
+    return data
 
-    if data["period_type"] == "mufap":
-        df = perf.get_performance_mufap(end_date, data["cat_ids"], data["amc_id"])
+
+def get_performance_df(params):
+    params = dict(params)
+    end_date = datetime.fromisoformat(params["end_date"])
+    cat_ids = list(params["cat_ids"])
+
+    if params["period_type"] == "mufap":
+        df = perf.get_performance_mufap(end_date, cat_ids, params["amc_id"], params["with_risk"])
     else:
-        start_date = datetime.fromisoformat(data["start_date"])
-        df = perf.get_performance_custom(start_date, end_date, data["cat_ids"], data["amc_id"])
+        start_date = datetime.fromisoformat(params["start_date"])
+        df = perf.get_performance_custom(start_date, end_date, cat_ids, params["amc_id"])
+
+    return df
+
+
+def render_performance(params):
+    df = get_performance_df(params)
 
     if not df.empty:
         html = df.to_html(
@@ -46,6 +120,101 @@ def performance():
 
     return html
 
+
+def render_performance_json(params):
+    # one array per column, missing values are null
+    df = get_performance_df(params[:-4])
+    page = dict(params[-4:])
+
+    if not df.empty:
+        for col in df.columns[2:]:
+            df[col] = pd.to_numeric(df[col], errors="coerce")
+
+    if page["order"] in df.columns:
+        df = df.sort_values(page["order"], ascending=page["dir"] == "asc", na_position="last", kind="stable")
+
+    total = len(df)
+    df = df.iloc[page["start"] : page["start"] + page["length"] if page["length"] else None]
+
+    ret = {
+        "columns": list(df.columns),
+        "data": [df[col].astype(object).where(df[col].notna(), None).tolist() for col in df.columns],
+        "total": total,
+        "start": page["start"],
+    }
+
+    return json.dumps(ret, separators=(",", ":"))
+
+
+def get_cached_response(params, render=render_performance, mimetype="text/html"):
+    # the body only changes when a database is written, so the generations and
+    # the request make the etag without rendering anything
+    key = (
+        request.path,
+        params,
+        db_merge.get_generation(MFDatabase.path_db_main),
+        db_merge.get_generation(BMDatabase.path_db_main),
+    )
+    etag = hashlib.sha1(repr(key).encode()).hexdigest()
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        body = response_cache.get(key)
+        if body is None:
+            body = gzip.compress(render(params).encode(), compresslevel=6)
+            response_cache.put(key, body)
+
+        if request.accept_encodings["gzip"]:
+            response = Response(body, mimetype=mimetype)
+            response.headers["Content-Encoding"] = "gzip"
+        else:
+            response = Response(gzip.decompress(body), mimetype=mimetype)
+
+    response.set_etag(etag)
+    response.headers["Vary"] = "Accept-Encoding"
+    response.cache_control.no_cache = True
+
+    return response
+
+
+def render_metadata(params):
+    with MFDatabase() as db:
+        return json.dumps(db.get_metadata(), separators=(",", ":"))
+
+
+def prewarm():
+    # the page opens with the metadata and the latest date's mufap view, every
+    # filter of it is then sliced from the same cached result
+    with MFDatabase() as db:
+        latest_date = db.get_latest_nav_date()
+
+    with app.test_request_context("/metadata", headers={"Accept-Encoding": "gzip"}):
+        metadata()
+
+    data = {"period_type": "mufap", "end_date": latest_date[:10]}
+    with app.test_request_context("/performance.json", headers={"Accept-Encoding": "gzip"}):
+        performance_json_response(data)
+
+
+def performance_json_response(data):
+    params = get_perf_params(data) + get_page_params(data)
+    return get_cached_response(params, render_performance_json, "application/json")
+
+
+@app.route("/performance", methods=["GET", "POST"])
+def performance():
+    return get_cached_response(get_perf_params(get_request_data()))
+
+
+@app.route("/performance.json", methods=["GET", "POST"])
+def performance_json():
+    return performance_json_response(get_request_data())
+
+@app.route("/metadata")
+def metadata():
+    return get_cached_response((), render_metadata, "application/json")
+
 @app.route("/get_data", methods=["POST"])
 def get_data():
     data = ""
@@ -65,14 +234,44 @@ def get_data():
 
     return data
 
+def check_merge_token():
+    token = request.headers.get("X-Merge-Token", "")
+    if token == "":
+        return Response("Missing merge token", status=401)
+
+    # without a configured token every merge is refused
+    expected = app.config["MERGE_TOKEN"]
+    if expected == "" or not hmac.compare_digest(token.encode(), expected.encode()):
+        return Response("Invalid merge token", status=403)
+
+    return None
+
+
 @app.route("/merge", methods=["POST"])
 def merge():
-    db = MFDatabase()
+    rejected = check_merge_token()
+    if rejected is not None:
+        return rejected
+
+    # a delta from MFDatabase.export_delta in the request body
+    if request.mimetype == "application/octet-stream":
+        try:
+            with MFDatabase(writer=True) as db:
+                db.apply_delta(request.stream)
+        except ValueError as e:
+            # not a delta, or the merged result failed validation
+            return Response(f"Rejected delta: {e}", status=400)
+        prewarm()
+
+        return "Success"
+
     data = request.get_json()
 
-    if db.path_db_attach.exists():
-        db.merge_attached(datetime.fromisoformat(data["cutoff_date"]))
-        db.path_db_attach.unlink()
+    if MFDatabase.path_db_attach.exists():
+        with MFDatabase(writer=True) as db:
+            db.merge_attached(datetime.fromisoformat(data["cutoff_date"]), shadow=True)
+        MFDatabase.path_db_attach.unlink()
+        prewarm()
 
         return "Success"
     else:
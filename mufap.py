@@ -8,22 +8,126 @@ from urllib.parse import quote
 
 import pandas as pd
 from bs4 import BeautifulSoup
+from lxml import etree
 
 import net_utils
 
+
+def mufap_industry_ttl(method, url, data):
+    # pkrv links for past years are final, the current year gets new ones daily
+    year = int(re.search(r"tab=(\d{4})", url).group(1))
+    if year < datetime.now().year:
+        return net_utils.immutable
+    return 60 * 60
+
+
+# fund, amc and category lists rarely change, a published pkrv file never does
+net_utils.add_cache_rule(r"PKRV\d{8}\.csv$", net_utils.immutable)
+net_utils.add_cache_rule(r"mufap\.com\.pk/industry\.php\?tab=\d{5}$", mufap_industry_ttl)
+net_utils.add_cache_rule(r"mufap\.com\.pk/nav-report\.php\?tab=\d+$", 12 * 60 * 60)
+
 def encode_date(dt):
     return quote(dt.strftime("%m/%d/%Y"), safe="")
 
 
-def mufap_cat_annualize(cat):
-    ann_cats = ["Income", "Money Market", "Fixed Rate", "Debt"]
+def mufap_clean_text(txt):
+    return " ".join("".join(filter(lambda x: x in string.printable, txt)).split())
+
+
+def mufap_parse_report(content, labels=("Fund Name:", "AMC:", "Category:")):
+    # one pass over a report page collecting the data table, the amc each
+    # fund is listed under and the <select> options next to each label
+    if isinstance(content, str):
+        content = content.encode()
+
+    encoding = None
+    try:
+        content.decode("utf-8")
+        encoding = "utf-8"
+    except UnicodeDecodeError:
+        pass
+
+    tables = {}
+    amc = ""
+    lst_amcs = []
+    options = {}
+
+    for _, el in etree.iterparse(io.BytesIO(content), events=("end",), html=True, recover=True, encoding=encoding):
+        if not isinstance(el.tag, str):
+            continue
+
+        if el.tag == "tr":
+            table = next(el.iterancestors("table"), None)
+            cells = [x for x in el if x.tag in ("td", "th")]
+
+            if table is not None and cells != []:
+                td_class = (cells[0].get("class") or "").split()
+
+                if "amc" in td_class:
+                    amc = mufap_clean_text("".join(cells[0].itertext()))
+                else:
+                    if "fundname" in td_class:
+                        lst_amcs.append([mufap_clean_text("".join(cells[0].itertext())), amc])
+
+                    row = []
+                    for x in cells:
+                        row.extend([" ".join("".join(x.itertext()).split())] * int(x.get("colspan") or 1))
+                    tables.setdefault(table, []).append(row)
+
+            # rows are the bulk of the page, drop them once read
+            el.clear(keep_tail=True)
+            continue
+
+        texts = [el.text] + [x.tail for x in el]
+        for label in labels:
+            if label not in options and any(x and x.strip() == label for x in texts):
+                options[label] = [(x.get("value"), "".join(x.itertext()).strip()) for x in el.iter("option")]
+
+    # the data table, the first table if there is no mydata table
+    rows = []
+    for table, table_rows in tables.items():
+        if "mydata" in (table.get("class") or "").split():
+            rows = table_rows
+            break
+        if rows == []:
+            rows = table_rows
+
+    if rows != []:
+        n = len(rows[0])
+        df_table = pd.DataFrame([(x + [None] * n)[:n] for x in rows[1:]], columns=rows[0])
+    else:
+        df_table = pd.DataFrame()
+
+    return {
+        "table": df_table,
+        "amcs": pd.DataFrame(lst_amcs, columns=["Fund Name", "amc"]),
+        "options": {k: pd.DataFrame(v, columns=["id", "value"]) for k, v in options.items()},
+    }
+
+
+def mufap_to_numeric(df, cols):
+    # report cells are text, values of 1000 or more have thousands separators
+    for col in cols:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col].astype(str).str.replace(",", "", regex=False), errors="coerce")
+    return df
+
+
+mufap_ann_cats = ["Income", "Money Market", "Fixed Rate", "Debt"]
 
-    for c in ann_cats:
+
+def mufap_cat_annualize(cat):
+    for c in mufap_ann_cats:
         if c in cat:
             return True
     return False
 
 
+def mufap_cats_annualize(cats):
+    pattern = "|".join(re.escape(x) for x in mufap_ann_cats)
+    return cats.str.contains(pattern, regex=True, na=False).astype(bool)
+
+
 def mufap_get_nav_tab(cat_id="", mufap_tab=""):
     mufap_tabs = {"funds": "01", "etf": "05", "vps": "02", "dedicated": "04"}
     # dedicated funds
@@ -49,8 +153,8 @@ def mufap_fund_navs(start_date, fund_id="", fund_cat="", mufap_tab="", full=Fals
 
     r = net_utils.get(url)
 
-    df_nav = pd.read_html(r.text)[0]
-    df_nav.columns = df_nav.iloc[0]
+    df_nav = mufap_parse_report(r.content, labels=())["table"]
+    df_nav = mufap_to_numeric(df_nav, ["NAV"])
 
     # etf
     if nav_tab == "05" or nav_tab == "02":
@@ -58,7 +162,6 @@ def mufap_fund_navs(start_date, fund_id="", fund_cat="", mufap_tab="", full=Fals
         df_nav["Type"] = "-"
 
     df_nav = mufap_nav_adjust_name(df_nav)
-    df_nav = df_nav.iloc[1:]
 
     df_nav["Validity Date"] = pd.to_datetime(
         df_nav["Validity Date"], format="%b %d, %Y", errors="coerce"
@@ -78,9 +181,9 @@ def mufap_fund_payouts(start_date, fund_id="", fund_cat=""):
 
     r = net_utils.get(url)
 
-    df = pd.read_html(r.text)[0]
-    df.columns = df.iloc[0]
-    df = df.iloc[1:][["Fund Name", "Payout (Per Unit)", "Ex-NAV", "Payout Date"]]
+    df = mufap_parse_report(r.content, labels=())["table"]
+    df = df[["Fund Name", "Payout (Per Unit)", "Ex-NAV", "Payout Date"]]
+    df = mufap_to_numeric(df, ["Payout (Per Unit)", "Ex-NAV"])
 
     df["Payout Date"] = pd.to_datetime(
         df["Payout Date"], format="%b %d, %Y", errors="coerce"
@@ -92,17 +195,11 @@ def mufap_fund_payouts(start_date, fund_id="", fund_cat=""):
 
 def mufap_nav_adjust_name(df_nav):
     df_nav["Fund Name"] = df_nav["Fund Name"].str.replace(r"\s+", " ", regex=True)
-    df_nav["Fund Name"] = df_nav.apply(
-        lambda row: row["Fund Name"] + "-" + row["Class"]
-        if row["Class"] != "-"
-        else row["Fund Name"],
-        axis=1,
+    df_nav["Fund Name"] = df_nav["Fund Name"].where(
+        df_nav["Class"] == "-", df_nav["Fund Name"] + "-" + df_nav["Class"]
     )
-    df_nav["Fund Name"] = df_nav.apply(
-        lambda row: row["Fund Name"] + "--" + row["Type"]
-        if row["Type"] != "-"
-        else row["Fund Name"],
-        axis=1,
+    df_nav["Fund Name"] = df_nav["Fund Name"].where(
+        df_nav["Type"] == "-", df_nav["Fund Name"] + "--" + df_nav["Type"]
     )
     return df_nav
 
@@ -116,14 +213,13 @@ def mufap_funds_list():
     }
 
     df_list = []
-    content = ""
+    report = None
 
     for nav_type, url in urls.items():
         r = net_utils.get(url)
 
-        df_nav = pd.read_html(r.text)[0]
-        df_nav.columns = df_nav.iloc[0]
-        df_nav = df_nav.iloc[1:]
+        report = mufap_parse_report(r.content)
+        df_nav = report["table"]
 
         if nav_type == "etf":
             df_nav = df_nav.iloc[:, :-4]
@@ -153,36 +249,11 @@ def mufap_funds_list():
             )
 
 
-        content = r.content
-
-        # build amc df
-        soup = BeautifulSoup(content, "lxml")
-        tbl = soup.find("table", class_="mydata")
-        trs = tbl.find_all("tr")
-        amc = ""
-        lst = []
-        for i in trs:
-            td = i.find("td")
-            if "amc" in td["class"]:
-                amc = "".join(
-                    filter(lambda x: x in string.printable, str(td.string).strip())
-                )
-                amc = " ".join(amc.split())
-            elif "fundname" in td["class"]:
-                fundname = "".join(
-                    filter(lambda x: x in string.printable, str(td.string).strip())
-                )
-                fundname = " ".join(fundname.split())
-                lst.append([fundname, amc])
-
-        df_amcs = pd.DataFrame(lst)
-        df_amcs.columns = ["Fund Name", "amc"]
-
-        df_amc_ids = mufap_amc_list(txt=content)
+        df_amcs = report["amcs"]
+        df_amc_ids = mufap_amc_list(report=report)
         df_amcs = pd.merge(df_amcs, df_amc_ids, on="amc", how="left")
-        # df_amcs.to_excel("df_amcs.xlsx")
 
-        df_cats = mufap_category_list(txt=content)
+        df_cats = mufap_category_list(report=report)
         df_nav = pd.merge(df_nav, df_amcs, on="Fund Name", how="left").drop_duplicates()
         df_nav = pd.merge(
             df_nav, df_cats, left_on="Category", right_on="category", how="left"
@@ -197,7 +268,7 @@ def mufap_funds_list():
     # df_nav.to_excel("df_nav.xlsx")
 
     # find fund ids
-    df_ids = mufap_options_todf("Fund Name:", txt=content)
+    df_ids = mufap_options_todf("Fund Name:", report=report)
     df_ids.columns = ["fund_id", "Fund Name"]
     # df_ids.to_excel('df_ids.xlsx')
 
@@ -242,8 +313,8 @@ def mufap_funds_list():
     return df
 
 
-def mufap_amc_list(url="https://www.mufap.com.pk/nav-report.php?tab=01", txt=None):
-    df_amc_ids = mufap_options_todf("AMC:", url=url, txt=txt)
+def mufap_amc_list(url="https://www.mufap.com.pk/nav-report.php?tab=01", txt=None, report=None):
+    df_amc_ids = mufap_options_todf("AMC:", url=url, txt=txt, report=report)
     df_amc_ids.columns = ["amc_id", "amc"]
     df_amc_ids["amc"] = df_amc_ids["amc"].apply(
         lambda x: "".join(
@@ -253,8 +324,8 @@ def mufap_amc_list(url="https://www.mufap.com.pk/nav-report.php?tab=01", txt=Non
     return df_amc_ids
 
 
-def mufap_category_list(url="https://www.mufap.com.pk/nav-report.php?tab=01", txt=None):
-    df_cat_ids = mufap_options_todf("Category:", url=url, txt=txt)
+def mufap_category_list(url="https://www.mufap.com.pk/nav-report.php?tab=01", txt=None, report=None):
+    df_cat_ids = mufap_options_todf("Category:", url=url, txt=txt, report=report)
     df_cat_ids.columns = ["cat_id", "category"]
     df_cat_ids["category"] = df_cat_ids["category"].apply(
         lambda x: "".join(
@@ -264,25 +335,14 @@ def mufap_category_list(url="https://www.mufap.com.pk/nav-report.php?tab=01", tx
     return df_cat_ids
 
 
-def mufap_options_todf(find_str, url=None, txt=None):
-    if not txt:
-        r = net_utils.get(url)
-        txt = r.content
-
-    soup = BeautifulSoup(txt, "lxml")
-    p_tag = soup.find(string=find_str).find_parent()
-    options = p_tag.find_all("option")
-
-    option_values = []
-    option_texts = []
-    for i in options:
-        value = i.get("value")
-        text = i.text.strip()
-        option_values.append(value)
-        option_texts.append(text)
-
-    data = {"id": option_values, "value": option_texts}
-    df = pd.DataFrame(data).dropna()
+def mufap_options_todf(find_str, url=None, txt=None, report=None):
+    if not report:
+        if not txt:
+            r = net_utils.get(url)
+            txt = r.content
+        report = mufap_parse_report(txt, labels=(find_str,))
+
+    df = report["options"][find_str].dropna()
     df["value"] = df["value"].str.replace(r"\s+", " ", regex=True)
 
     return df
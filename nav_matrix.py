@@ -0,0 +1,320 @@
+import json
+import os
+import pathlib
+import time
+
+import numpy as np
+import pandas as pd
+
+import db_query
+
+
+def to_day(dt):
+    return pd.Timestamp(dt).to_datetime64().astype("datetime64[D]")
+
+
+def save_snapshot(path, arrays, meta):
+    # every save writes its arrays under a new version and switches to them by
+    # replacing the metadata last, files mapped by readers are never written
+    # over and old versions are deleted once nothing holds them open
+    path = pathlib.Path(path)
+    version = str(time.time_ns())
+
+    for name, array in arrays.items():
+        path_array = path.with_name(f"{path.name}.{version}.{name}.npy")
+        path_tmp = path_array.with_suffix(".tmp")
+        with open(path_tmp, "wb") as f:
+            np.save(f, np.asarray(array))
+        os.replace(path_tmp, path_array)
+
+    path_tmp = path.with_name(f"{path.name}.json.tmp")
+    with open(path_tmp, "w") as f:
+        json.dump(dict(meta, version=version), f)
+    os.replace(path_tmp, path.with_name(f"{path.name}.json"))
+
+    for path_old in path.parent.glob(f"{path.name}.*.npy"):
+        if not path_old.name.startswith(f"{path.name}.{version}."):
+            try:
+                path_old.unlink()
+            except OSError:
+                # still mapped by a reader on windows, the next save retries
+                pass
+
+
+def load_snapshot(path, names):
+    # metadata and memory mapped arrays of the current version, None if there
+    # is no snapshot
+    path = pathlib.Path(path)
+    path_meta = path.with_name(f"{path.name}.json")
+
+    # a save can switch versions and delete the old one while it is read
+    for _ in range(2):
+        if not path_meta.exists():
+            return None
+
+        with open(path_meta) as f:
+            meta = json.load(f)
+        if "version" not in meta:
+            return None
+
+        try:
+            arrays = {
+                name: np.load(path.with_name(f"{path.name}.{meta['version']}.{name}.npy"), mmap_mode="r")
+                for name in names
+            }
+        except FileNotFoundError:
+            continue
+
+        return meta, arrays
+
+    return None
+
+
+class NavMatrix:
+    # fund x day matrices, days are offsets from start_date
+    # navs: nav on the day, nan where there is none
+    # div_factors: cumulative dividend adjustment up to and including the day
+    # last_idx / next_idx: day of the last / next available nav on or around the day
+    arrays = ["navs", "div_factors", "last_idx", "next_idx"]
+
+    def __init__(self, fund_ids, start_date, navs, div_factors, last_idx=None, next_idx=None, signature=None):
+        self.fund_ids = pd.Index(fund_ids)
+        self.start_date = to_day(start_date)
+        self.navs = navs
+        self.div_factors = div_factors
+        self.signature = signature
+
+        if last_idx is None or next_idx is None:
+            last_idx, next_idx = self.__make_idx(navs)
+
+        self.last_idx = last_idx
+        self.next_idx = next_idx
+
+    @staticmethod
+    def get_signature(conn):
+        qry = (
+            "SELECT (SELECT COUNT(*) FROM navs), (SELECT MAX(nav_date) FROM navs),"
+            " (SELECT COUNT(*) FROM payouts), (SELECT MAX(payout_date) FROM payouts)"
+        )
+        return list(conn.execute(qry).fetchone())
+
+    @staticmethod
+    def __read_navs(conn, start_date=None):
+        qry = "SELECT fund_id, nav, nav_date FROM navs WHERE nav!=0"
+        params = ()
+        if start_date:
+            qry = qry + " AND nav_date>=?"
+            params = (start_date,)
+        return db_query.read_sql(conn, qry, params, parse_dates=["nav_date"])
+
+    @staticmethod
+    def __read_payouts(conn, start_date=None):
+        qry = "SELECT fund_id, payout, exnav, payout_date FROM payouts"
+        params = ()
+        if start_date:
+            qry = qry + " WHERE payout_date>=?"
+            params = (start_date,)
+        df = db_query.read_sql(conn, qry, params, parse_dates=["payout_date"])
+        df["div_factor"] = (df["exnav"] + df["payout"]) / df["exnav"]
+        return df
+
+    @staticmethod
+    def __make_idx(navs):
+        days = np.arange(navs.shape[1], dtype=np.int32)
+        valid = ~np.isnan(navs)
+
+        last_idx = np.maximum.accumulate(np.where(valid, days, -1), axis=1).astype(np.int32)
+        next_idx = np.minimum.accumulate(
+            np.where(valid, days, navs.shape[1])[:, ::-1], axis=1
+        )[:, ::-1].astype(np.int32)
+
+        return last_idx, next_idx
+
+    @classmethod
+    def build(cls, conn):
+        signature = cls.get_signature(conn)
+        df_navs = cls.__read_navs(conn)
+        df_payouts = cls.__read_payouts(conn)
+
+        fund_ids = pd.Index(sorted(set(df_navs["fund_id"]) | set(df_payouts["fund_id"])))
+        dates = pd.concat([df_navs["nav_date"], df_payouts["payout_date"]])
+        start_date = to_day(dates.min())
+        n_days = int((to_day(dates.max()) - start_date).astype(int)) + 1
+
+        navs = np.full((len(fund_ids), n_days), np.nan)
+        day_factors = np.ones((len(fund_ids), n_days))
+        cls.__fill(navs, day_factors, fund_ids, start_date, df_navs, df_payouts)
+
+        return cls(fund_ids, start_date, navs, np.cumprod(day_factors, axis=1), signature=signature)
+
+    @staticmethod
+    def __fill(navs, day_factors, fund_ids, start_date, df_navs, df_payouts, offset=0):
+        rows = fund_ids.get_indexer(df_navs["fund_id"])
+        cols = (df_navs["nav_date"].to_numpy().astype("datetime64[D]") - start_date).astype(int) - offset
+        navs[rows, cols] = df_navs["nav"].to_numpy(dtype=float)
+
+        rows = fund_ids.get_indexer(df_payouts["fund_id"])
+        cols = (df_payouts["payout_date"].to_numpy().astype("datetime64[D]") - start_date).astype(int) - offset
+        np.multiply.at(day_factors, (rows, cols), df_payouts["div_factor"].to_numpy(dtype=float))
+
+    def update(self, conn, cutoff_date):
+        cutoff = self.day(cutoff_date)
+        if cutoff <= 0:
+            return NavMatrix.build(conn)
+
+        signature = self.get_signature(conn)
+        df_navs = self.__read_navs(conn, cutoff_date)
+        df_payouts = self.__read_payouts(conn, cutoff_date)
+
+        new_ids = pd.Index(sorted(set(df_navs["fund_id"]) | set(df_payouts["fund_id"])))
+        fund_ids = self.fund_ids.append(new_ids.difference(self.fund_ids))
+
+        n_days = cutoff
+        dates = pd.concat([df_navs["nav_date"], df_payouts["payout_date"]])
+        if not dates.empty:
+            n_days = max(n_days, self.day(dates.max()) + 1)
+
+        # keep everything before the cutoff, carry the adjustment forward to it
+        n_funds = len(self.fund_ids)
+        keep = min(cutoff, self.navs.shape[1])
+
+        navs = np.full((len(fund_ids), n_days), np.nan)
+        navs[:n_funds, :keep] = self.navs[:, :keep]
+
+        div_factors = np.ones((len(fund_ids), n_days))
+        div_factors[:n_funds, :keep] = self.div_factors[:, :keep]
+        div_factors[:n_funds, keep:cutoff] = self.div_factors[:, keep - 1 : keep]
+
+        navs_new = np.full((len(fund_ids), n_days - cutoff), np.nan)
+        day_factors = np.ones((len(fund_ids), n_days - cutoff))
+        self.__fill(navs_new, day_factors, fund_ids, self.start_date, df_navs, df_payouts, offset=cutoff)
+
+        navs[:, cutoff:] = navs_new
+        div_factors[:, cutoff:] = div_factors[:, cutoff - 1 : cutoff] * np.cumprod(day_factors, axis=1)
+
+        return NavMatrix(fund_ids, self.start_date, navs, div_factors, signature=signature)
+
+    def save(self, path):
+        meta = {
+            "fund_ids": self.fund_ids.tolist(),
+            "start_date": str(self.start_date),
+            "signature": self.signature,
+        }
+        save_snapshot(path, {name: getattr(self, name) for name in self.arrays}, meta)
+
+    @classmethod
+    def load(cls, path, conn=None):
+        snapshot = load_snapshot(path, cls.arrays)
+        if snapshot is None:
+            return None
+        meta, arrays = snapshot
+
+        # stale snapshot, the database changed without the matrix being updated
+        if conn is not None and meta["signature"] != cls.get_signature(conn):
+            return None
+
+        for name in cls.arrays:
+            if arrays[name].shape[0] != len(meta["fund_ids"]):
+                return None
+
+        return cls(meta["fund_ids"], meta["start_date"], signature=meta["signature"], **arrays)
+
+    def day(self, nav_date):
+        return int((to_day(nav_date) - self.start_date).astype(int))
+
+    def __rows_cols(self, fund_ids, nav_dates):
+        rows = self.fund_ids.get_indexer(fund_ids)
+        cols = np.array([self.day(x) for x in nav_dates], dtype=int)
+        return rows, cols
+
+    def get_navs(self, fund_ids, nav_dates):
+        rows, cols = self.__rows_cols(fund_ids, nav_dates)
+        valid = (rows[:, None] >= 0) & (cols[None, :] >= 0) & (cols[None, :] < self.navs.shape[1])
+
+        navs = np.asarray(self.navs[np.ix_(rows.clip(0), cols.clip(0, self.navs.shape[1] - 1))])
+        return np.where(valid, navs, np.nan)
+
+    def __div_factors_at(self, rows, col):
+        if col < 0:
+            return np.ones(len(rows))
+        div_factors = np.asarray(self.div_factors[rows.clip(0), min(col, self.navs.shape[1] - 1)])
+        return np.where(rows >= 0, div_factors, 1)
+
+    def get_div_factors(self, fund_ids, op_date, end_date):
+        rows = self.fund_ids.get_indexer(fund_ids)
+        return self.__div_factors_at(rows, self.day(end_date)) / self.__div_factors_at(rows, self.day(op_date))
+
+    def get_returns(self, fund_ids, op_date, end_date):
+        navs = self.get_navs(fund_ids, [op_date, end_date])
+        return navs[:, 1] / navs[:, 0] * self.get_div_factors(fund_ids, op_date, end_date) - 1
+
+    def get_tr_index(self, fund_ids, op_date, end_date):
+        # fund x day navs grossed up for payouts, every day from op_date to
+        # end_date, nan where there is no nav
+        rows = self.fund_ids.get_indexer(fund_ids)
+        first = self.day(op_date)
+        n_days = self.day(end_date) - first + 1
+        tr = np.full((len(rows), max(n_days, 0)), np.nan)
+
+        lo = max(first, 0)
+        hi = min(first + n_days, self.navs.shape[1])
+        found = np.flatnonzero(rows >= 0)
+        if hi > lo and found.size > 0:
+            tr[found, lo - first : hi - first] = np.asarray(self.navs[rows[found], lo:hi]) * np.asarray(
+                self.div_factors[rows[found], lo:hi]
+            )
+
+        return tr
+
+    def get_navs_last(self, fund_ids, nav_date):
+        rows = self.fund_ids.get_indexer(fund_ids)
+        col = min(self.day(nav_date), self.navs.shape[1] - 1)
+
+        df = pd.DataFrame({"fund_id": list(fund_ids), "row": rows})
+        df = df[df["row"] >= 0]
+        if col < 0 or df.empty:
+            return pd.DataFrame(columns=["fund_id", "nav", "max_nav_date"])
+
+        last = np.asarray(self.last_idx[df["row"], col])
+        df = df[last >= 0].copy()
+        last = last[last >= 0]
+
+        df["nav"] = np.asarray(self.navs[df["row"], last])
+        df["max_nav_date"] = (self.start_date + last).astype("datetime64[s]").astype(str)
+        df["max_nav_date"] = df["max_nav_date"].str.replace("T", " ")
+
+        return df[["fund_id", "nav", "max_nav_date"]]
+
+    def get_navs_interpolated(self, fund_ids, nav_date):
+        rows = self.fund_ids.get_indexer(fund_ids)
+        n_days = self.navs.shape[1]
+        col = self.day(nav_date)
+        navs = np.full(len(rows), np.nan)
+
+        if col <= 0 or col >= n_days - 1:
+            return navs
+
+        idx = np.flatnonzero(rows >= 0)
+        before = np.asarray(self.last_idx[rows[idx], col - 1])
+        after = np.asarray(self.next_idx[rows[idx], col + 1])
+
+        found = (before >= 0) & (after < n_days)
+        idx, before, after = idx[found], before[found], after[found]
+        rows = rows[idx]
+
+        nav_before = np.asarray(self.navs[rows, before])
+        # nav after, grossed up for payouts in between
+        nav_after = (
+            np.asarray(self.navs[rows, after])
+            * np.asarray(self.div_factors[rows, after])
+            / np.asarray(self.div_factors[rows, before])
+        )
+        navs[idx] = nav_before + (nav_after - nav_before) * (col - before) / (after - before)
+
+        return navs
+
+    def get_nav_interpolated(self, fund_id, nav_date):
+        nav = self.get_navs_interpolated([fund_id], nav_date)[0]
+        if np.isnan(nav):
+            return None
+        return nav
@@ -2,45 +2,304 @@ import requests
 
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
+from requests.structures import CaseInsensitiveDict
+from urllib.parse import urlsplit
 
+import asyncio
+import hashlib
+import json
+import os
+import pathlib
+import re
+import threading
+import time
 import concurrent.futures
 
 
-def get(url):
-    session = requests.Session()
-    retry = Retry(connect=3, backoff_factor=0.5)
-    adapter = HTTPAdapter(max_retries=retry)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
-    
-    return session.get(url)
+# pool settings, change with configure()
+pool_hosts = 10
+pool_maxsize = 5
+retries = 3
+backoff_factor = 0.5
+timeout = 60
+cache_dir = pathlib.Path(__file__).parent.resolve() / "http_cache"
 
-def threaded_get(urls, call_back=None, max_workers=5):
+session = None
+session_lock = threading.Lock()
+host_semaphores = {}
+host_rate_limiters = {}
+
+# responses are only cached for urls matching a rule, see add_cache_rule
+immutable = float("inf")
+cache_rules = []
+
+
+def make_session():
+    s = requests.Session()
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=[429, 500, 502, 503, 504],
+    )
+    # pool_block caps the open connections per host at pool_maxsize
+    adapter = HTTPAdapter(
+        pool_connections=pool_hosts,
+        pool_maxsize=pool_maxsize,
+        max_retries=retry,
+        pool_block=True,
+    )
+    s.mount('http://', adapter)
+    s.mount('https://', adapter)
+
+    return s
+
+
+def get_session():
+    global session
+    with session_lock:
+        if session is None:
+            session = make_session()
+        return session
+
+
+def configure(**kwargs):
+    global session
+    settings = ["pool_hosts", "pool_maxsize", "retries", "backoff_factor", "timeout", "cache_dir"]
+
+    with session_lock:
+        for k, v in kwargs.items():
+            if k not in settings:
+                raise ValueError(f"Unknown setting {k}")
+            globals()[k] = v
+
+        if session is not None:
+            session.close()
+            session = None
+
+
+def set_host_limit(host, max_requests):
+    with session_lock:
+        host_semaphores[host] = threading.BoundedSemaphore(max_requests)
+
+
+def set_host_rate_limit(host, rate):
+    # calls per second, cached responses do not count
+    with session_lock:
+        host_rate_limiters[host] = RateLimiter(rate)
+
+
+def get_host_semaphore(url):
+    with session_lock:
+        return host_semaphores.get(urlsplit(url).hostname)
+
+
+def get_host_rate_limiter(url):
+    with session_lock:
+        return host_rate_limiters.get(urlsplit(url).hostname)
+
+
+def send(method, url, **kwargs):
+    kwargs.setdefault("timeout", timeout)
+    semaphore = get_host_semaphore(url)
+    limiter = get_host_rate_limiter(url)
+
+    if limiter is not None:
+        limiter.wait()
+
+    if semaphore is None:
+        return get_session().request(method, url, **kwargs)
+
+    with semaphore:
+        return get_session().request(method, url, **kwargs)
+
+
+def add_cache_rule(pattern, ttl, response_ttl=None):
+    # ttl is in seconds, immutable or a function(method, url, data) returning
+    # either, None is not cached, the first rule matching the url is used,
+    # response_ttl(res, ttl) gives the ttl a fetched response is kept for
+    cache_rules.append((re.compile(pattern), ttl, response_ttl))
+
+
+def get_cache_rule(method, url, data):
+    for pattern, ttl, response_ttl in cache_rules:
+        if pattern.search(url):
+            if callable(ttl):
+                ttl = ttl(method, url, data)
+            return ttl, response_ttl
+    return None, None
+
+
+def get_cache_key(method, url, data):
+    if isinstance(data, dict):
+        data = json.dumps(data, sort_keys=True, default=str)
+    if isinstance(data, str):
+        data = data.encode()
+
+    h = hashlib.sha256(f"{method} {url}\n".encode())
+    h.update(data or b"")
+    return h.hexdigest()
+
+
+def read_cache(key):
+    path = pathlib.Path(cache_dir) / key
+    try:
+        with open(path.with_suffix(".json")) as f:
+            meta = json.load(f)
+        with open(path.with_suffix(".body"), "rb") as f:
+            body = f.read()
+    except (FileNotFoundError, ValueError):
+        return None, None
+
+    return meta, body
+
+
+def write_cache_file(path, data, mode):
+    # concurrent writers each replace the whole file
+    path_tmp = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+    with open(path_tmp, mode) as f:
+        f.write(data)
+    os.replace(path_tmp, path)
+
+
+def write_cache(key, res, meta=None, ttl=immutable):
+    path = pathlib.Path(cache_dir) / key
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    if meta is None:
+        meta = {
+            "url": res.url,
+            "headers": {k: res.headers[k] for k in ("Content-Type", "ETag", "Last-Modified") if k in res.headers},
+            "encoding": res.encoding,
+            "ttl": ttl,
+        }
+        write_cache_file(path.with_suffix(".body"), res.content, "wb")
+
+    meta["time"] = time.time()
+    write_cache_file(path.with_suffix(".json"), json.dumps(meta), "w")
+
+
+def make_response(meta, body):
+    res = requests.Response()
+    res.status_code = 200
+    res.url = meta["url"]
+    res.headers = CaseInsensitiveDict(meta["headers"])
+    res.encoding = meta["encoding"]
+    res._content = body
+    return res
+
+
+def request(method, url, **kwargs):
+    ttl, response_ttl = get_cache_rule(method, url, kwargs.get("data"))
+    if ttl is None:
+        return send(method, url, **kwargs)
+
+    key = get_cache_key(method, url, kwargs.get("data"))
+    meta, body = read_cache(key)
+
+    if meta is not None:
+        if time.time() - meta["time"] < min(ttl, meta.get("ttl", ttl)):
+            return make_response(meta, body)
+
+        # stale, the server answers 304 if it has not changed
+        headers = dict(kwargs.get("headers") or {})
+        if "ETag" in meta["headers"]:
+            headers["If-None-Match"] = meta["headers"]["ETag"]
+        if "Last-Modified" in meta["headers"]:
+            headers["If-Modified-Since"] = meta["headers"]["Last-Modified"]
+        kwargs["headers"] = headers
+
+    res = send(method, url, **kwargs)
+
+    if res.status_code == 304 and meta is not None:
+        write_cache(key, res, meta)
+        return make_response(meta, body)
+
+    if res.status_code == 200:
+        if response_ttl is not None:
+            ttl = response_ttl(res, ttl)
+        if ttl is not None:
+            write_cache(key, res, ttl=ttl)
+
+    return res
+
+
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+def threaded_get(urls, call_back=None, max_workers=5, rate_limit=None, on_result=None):
+    # rate_limit is in calls per second, on_result(url, res) is called from
+    # this thread as each call completes and the result is not kept
     ret = {}
     if not call_back:
         call_back = get
 
+    fetch = call_back
+    if rate_limit:
+        limiter = RateLimiter(rate_limit)
+
+        def fetch(url):
+            limiter.wait()
+            return call_back(url)
+
     with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
         futures = {
-            executor.submit(call_back, url):url for url in urls
+            executor.submit(fetch, url):url for url in urls
         }
 
         for future in concurrent.futures.as_completed(futures):
             url = futures[future]
             try:
                 res = future.result()
-                ret[url] = res
-                
+                if on_result:
+                    on_result(url, res)
+                else:
+                    ret[url] = res
+
             except Exception as e:
                 print(f"Error occurred for item {url}: {e}")
     return ret
-        
-
-def post(url, data=None, headers=None):
-    session = requests.Session()
-    retry = Retry(connect=3, backoff_factor=0.5)
-    adapter = HTTPAdapter(max_retries=retry)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
-    
-    return session.post(url, data=data, headers=headers)
\ No newline at end of file
+
+
+def post(url, data=None, headers=None, **kwargs):
+    return request("POST", url, data=data, headers=headers, **kwargs)
+
+
+async def aget(url, **kwargs):
+    return await asyncio.to_thread(get, url, **kwargs)
+
+async def apost(url, data=None, headers=None, **kwargs):
+    return await asyncio.to_thread(post, url, data=data, headers=headers, **kwargs)
+
+async def gather_get(urls, call_back=None, max_concurrency=5):
+    ret = {}
+    if not call_back:
+        call_back = get
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def fetch(url):
+        async with semaphore:
+            try:
+                ret[url] = await asyncio.to_thread(call_back, url)
+            except Exception as e:
+                print(f"Error occurred for item {url}: {e}")
+
+    await asyncio.gather(*[fetch(url) for url in urls])
+    return ret
@@ -2,6 +2,19 @@ from datetime import datetime, timedelta
 
 from db_mufap import MFDatabase
 
+
+def filter_funds(df, cat_ids=[], amc_id=""):
+    # "0" and empty select every category or amc
+    if cat_ids != []:
+        if not "0" in cat_ids:
+            df = df[df["cat_id"].isin(cat_ids)]
+
+    if amc_id != "" and amc_id != "0":
+        df = df[df["amc_id"] == amc_id]
+
+    return df
+
+
 def get_performance_custom(start_date, end_date, cat_ids=[], amc_id=""):
     
     with MFDatabase() as db:
@@ -10,12 +23,7 @@ def get_performance_custom(start_date, end_date, cat_ids=[], amc_id=""):
     if df.empty:
         return df
 
-    if cat_ids != []:
-        if not "0" in cat_ids:
-            df = df[df["cat_id"].isin(cat_ids)]
-
-    if amc_id != "" and amc_id != "0":
-        df = df[df["amc_id"] == amc_id]
+    df = filter_funds(df, cat_ids, amc_id)
 
     col_list = ["fund_name", "category", "return"]
     col_names = ["Fund", "Category", "Return"]
@@ -26,7 +34,7 @@ def get_performance_custom(start_date, end_date, cat_ids=[], amc_id=""):
     return df
 
 
-def get_performance_mufap(end_date, cat_ids=[], amc_id=""):
+def get_performance_mufap(end_date, cat_ids=[], amc_id="", with_risk=False):
     dates_list = [
         (
             "YTD",
@@ -43,20 +51,24 @@ def get_performance_mufap(end_date, cat_ids=[], amc_id=""):
         ("365 Days", end_date - timedelta(365), end_date),
     ]
 
+    # risk over the last year, in the same units as the returns
+    risk_cols = {"volatility": "Volatility", "max_drawdown": "Max Drawdown", "sharpe": "Sharpe", "beta": "Beta"}
+
     with MFDatabase() as db:
         df = db.get_performance_multi(dates_list)
+        if with_risk:
+            df_risk = db.get_risk_metrics(end_date - timedelta(365), end_date, df["fund_id"].drop_duplicates())
+            df_risk[["volatility", "max_drawdown"]] = df_risk[["volatility", "max_drawdown"]] * 100
+            df = df.merge(df_risk.round(2).rename(columns=risk_cols), on="fund_id", how="left")
 
-    if cat_ids != []:
-        if not "0" in cat_ids:
-            df = df[df["cat_id"].isin(cat_ids)]
-
-    if amc_id != "" and amc_id != "0":
-        df = df[df["amc_id"] == amc_id]
+    df = filter_funds(df, cat_ids, amc_id)
 
     # df = df.dropna(subset=['return'])
     ret_cols = [x[0] for x in dates_list]
     col_list = ["fund_name", "category"]
     col_list.extend(ret_cols)
+    if with_risk:
+        col_list.extend(risk_cols.values())
     # col_names = ["Fund", "Category", "Return"]
     df = df[col_list]
     df = df.rename(columns={"fund_name": "Fund", "category": "Category"})
@@ -6,37 +6,97 @@ import io
 
 import net_utils
 
-def fetch_scrips_single(dt):
-    data = {"date": ""}
-    url = "https://dps.psx.com.pk/historical"
+# fixed date market holidays as month-day, lunar holidays move every year
+# so add those dates to psx_holiday_dates, until then their empty pages are
+# only cached for psx_empty_ttl
+psx_holidays = {"02-05", "03-23", "05-01", "08-14", "12-25"}
+psx_holiday_dates = set()
 
-    data["date"] = dt.date().isoformat()
-    a = net_utils.post(url, data=data)
+psx_rate_limit = 2
+
+# days that may still be published late or corrected are rechecked after
+psx_recent_days = 5
+psx_recent_ttl = 6 * 60 * 60
+psx_empty_ttl = 24 * 60 * 60
+
+
+def psx_historical_ttl(method, url, data):
+    # a trading day's closing prices do not change once it is over
+    if not data:
+        return None
+
+    today = datetime.date.today()
+    if data.get("date", "") >= today.isoformat():
+        return None
+    if data.get("date", "") >= (today - datetime.timedelta(days=psx_recent_days)).isoformat():
+        return psx_recent_ttl
+    return net_utils.immutable
+
+
+def psx_historical_response_ttl(res, ttl):
+    # a page without prices is a holiday or a day not published yet, never kept for good
+    if psx_parse_historical(res.content).empty:
+        return min(ttl, psx_empty_ttl)
+    return ttl
+
+
+net_utils.set_host_rate_limit("dps.psx.com.pk", psx_rate_limit)
+net_utils.add_cache_rule(r"dps\.psx\.com\.pk/historical$", psx_historical_ttl, psx_historical_response_ttl)
+net_utils.add_cache_rule(r"dps\.psx\.com\.pk/download/text/listed_cmp\.lst\.Z$", 24 * 60 * 60)
+
+
+def psx_trading_days(start_date, end_date):
+    # both ends are normalized to midnight, so the end day itself is a trading day too
+    days = pd.bdate_range(start_date, end_date, inclusive="both", normalize=True)
+    days = days[
+        ~days.strftime("%m-%d").isin(psx_holidays)
+        & ~days.strftime("%Y-%m-%d").isin(psx_holiday_dates)
+    ]
+    return [x.to_pydatetime() for x in days]
+
+def psx_parse_historical(content):
+    # the day's closing prices, empty if the page has none
     try:
-        df = pd.read_html(a.content)[0]
+        df = pd.read_html(io.BytesIO(content))[0]
         if not df.empty:
             df.columns = [a for a in df.columns.to_flat_index()]
             df = df[["SYMBOL", "OPEN", "HIGH", "LOW", "CLOSE", "LDCP", "VOLUME"]]
-            df["close_date"] = data["date"]
     except:
         df = pd.DataFrame()
 
     return df
 
-def fetch_scrips(start_date=None, dt_list=None):
+def fetch_scrips_single(dt):
+    data = {"date": ""}
+    url = "https://dps.psx.com.pk/historical"
+
+    data["date"] = dt.date().isoformat()
+    a = net_utils.post(url, data=data)
+    df = psx_parse_historical(a.content)
+    if not df.empty:
+        df["close_date"] = data["date"]
+
+    return df
+
+def fetch_scrips(start_date=None, dt_list=None, on_result=None, max_workers=5):
+    # on_result(df) receives each day's frame as it arrives instead of
+    # collecting them all
     end_date = datetime.datetime.today()
     # end_date = datetime.datetime(2023, 10, 24)
 
     df_list = []
+    if not on_result:
+        on_result = df_list.append
 
     if start_date:
-        while start_date < end_date:
-            df_list.append(fetch_scrips_single(start_date))
-            start_date = start_date + datetime.timedelta(days=1)
-
-    else:
-        for i in dt_list:
-            df_list.append(fetch_scrips_single(i))
+        dt_list = psx_trading_days(start_date, end_date)
+
+    net_utils.threaded_get(
+        dt_list,
+        fetch_scrips_single,
+        max_workers=max_workers,
+        on_result=lambda dt, df: on_result(df),
+    )
 
     if df_list != []:
         df = pd.concat(df_list)
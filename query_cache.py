@@ -0,0 +1,121 @@
+import re
+import sys
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+
+class QueryCache:
+    # LRU cache bounded by the memory of the cached values, entries are
+    # tagged with the generation of every table they read from so that
+    # invalidating a table drops them, callers take the generations before
+    # reading so that a result read across an invalidation is never stored
+
+    def __init__(self, max_bytes=128 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.generations = {}
+        self.clears = 0
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def get_tables(qry):
+        tables = re.findall(r"\b(?:FROM|JOIN)\s+([\w.]+)", qry, flags=re.IGNORECASE)
+        return tuple(sorted({x.split(".")[-1].lower() for x in tables}))
+
+    @staticmethod
+    def get_size(value):
+        if isinstance(value, pd.DataFrame):
+            return int(value.memory_usage(index=True, deep=True).sum())
+        if isinstance(value, (bytes, bytearray, str)):
+            return len(value)
+        return sys.getsizeof(value)
+
+    def __generations(self, tables):
+        return (self.clears,) + tuple(self.generations.get(x, 0) for x in tables)
+
+    def get_generations(self, tables):
+        with self.lock:
+            return self.__generations(tables)
+
+    def __drop(self, key):
+        entry = self.entries.pop(key)
+        self.size -= entry["size"]
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is not None and entry["generations"] != self.__generations(entry["tables"]):
+                self.__drop(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry["value"]
+
+    def put(self, key, value, tables=(), generations=None):
+        size = self.get_size(value)
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            if generations is None:
+                generations = self.__generations(tables)
+            elif generations != self.__generations(tables):
+                # invalidated while the value was read, it may already be stale
+                return
+
+            if key in self.entries:
+                self.__drop(key)
+
+            self.entries[key] = {
+                "value": value,
+                "tables": tuple(tables),
+                "generations": generations,
+                "size": size,
+            }
+            self.size += size
+
+            while self.size > self.max_bytes:
+                self.__drop(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, *tables):
+        tables = {x.lower() for x in tables}
+
+        with self.lock:
+            for table in tables:
+                self.generations[table] = self.generations.get(table, 0) + 1
+
+            for key in [k for k, v in self.entries.items() if tables.intersection(v["tables"])]:
+                self.__drop(key)
+                self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.clears += 1
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
@@ -0,0 +1,141 @@
+import numpy as np
+
+
+# returns are asset x date matrices of daily log returns, nan where an asset
+# has no return on the date
+
+
+def get_stddev(returns):
+    # over the days each asset has a return
+    return np.sqrt(np.nanmean((returns - np.nanmean(returns, axis=1, keepdims=True)) ** 2, axis=1))
+
+
+def get_correl(returns):
+    # days an asset has no return count as no change
+    filled = np.nan_to_num(returns)
+    filled = filled - filled.mean(axis=1, keepdims=True)
+    norms = np.sqrt((filled**2).sum(axis=1))
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (filled @ filled.T) / np.outer(norms, norms)
+
+
+def get_covariance(returns):
+    stddev = get_stddev(returns)
+    return get_correl(returns) * np.outer(stddev, stddev)
+
+
+def get_portfolio_risk(weights, returns, bm_returns=None):
+    # volatility, each asset's marginal and component contribution to it, the
+    # components add up to the volatility, and the tracking error against the
+    # benchmark's returns on the same dates
+    weights = np.asarray(weights, dtype=float)
+    asset_stddev = get_stddev(returns)
+    cov = get_correl(returns) * np.outer(asset_stddev, asset_stddev)
+
+    cov_w = cov @ weights
+    stddev = np.sqrt(weights @ cov_w)
+    marginal = cov_w / stddev
+    component = weights * marginal
+
+    tracking_error = np.nan
+    if bm_returns is not None:
+        active = weights @ np.nan_to_num(returns) - bm_returns
+        active = active[~np.isnan(active)]
+        if active.size > 0:
+            tracking_error = active.std()
+
+    return {
+        "stddev": stddev,
+        "asset_stddev": asset_stddev,
+        "marginal": marginal,
+        "component": component,
+        "tracking_error": tracking_error,
+    }
+
+
+def get_window_sums(values, window):
+    # sum of each run of window values along the last axis from one cumulative
+    # sum, nan until the first window fills
+    sums = np.full(values.shape, np.nan)
+    if window < 1 or values.shape[-1] < window:
+        return sums
+
+    cumsum = np.cumsum(values, axis=-1)
+    sums[..., window - 1] = cumsum[..., window - 1]
+    sums[..., window:] = cumsum[..., window:] - cumsum[..., :-window]
+    return sums
+
+
+def get_rolling_stddev(returns, window):
+    # over the days each asset has a return in the last window days
+    count = get_window_sums((~np.isnan(returns)).astype(float), window)
+
+    # centered first, so the differences of the cumulative sums stay small
+    centered = np.nan_to_num(returns - np.nanmean(returns, axis=-1, keepdims=True))
+    sx = get_window_sums(centered, window)
+    sxx = get_window_sums(centered**2, window)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        var = sxx / count - (sx / count) ** 2
+    return np.sqrt(np.clip(var, 0, None))
+
+
+def get_rolling_correl(returns, bm_returns, window):
+    # correlation and beta of each asset against the benchmark over the last
+    # window days, days an asset has no return count as no change
+    count = get_window_sums((~np.isnan(returns)).astype(float), window)
+    x = np.nan_to_num(returns)
+    x = x - x.mean(axis=-1, keepdims=True)
+    y = bm_returns - bm_returns.mean()
+
+    sx = get_window_sums(x, window)
+    sy = get_window_sums(y, window)
+    cov = get_window_sums(x * y, window) / window - sx * sy / window**2
+    var_x = get_window_sums(x**2, window) / window - (sx / window) ** 2
+    var_y = get_window_sums(y**2, window) / window - (sy / window) ** 2
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        correl = cov / np.sqrt(np.clip(var_x, 0, None) * np.clip(var_y, 0, None))
+        beta = cov / var_y
+
+    # no return in the window, only rounding left in the variance
+    correl = np.where(count == 0, np.nan, correl)
+    beta = np.where(count == 0, 0, beta)
+    return correl, beta
+
+
+def get_interval_returns(tr):
+    # log returns between consecutive values of a total return index along the
+    # last axis, on the day of the later value, and the day of the earlier one
+    days = np.arange(tr.shape[-1])
+    valid = ~np.isnan(tr)
+    last = np.maximum.accumulate(np.where(valid, days, -1), axis=-1)
+    prev = np.concatenate([np.full(tr.shape[:-1] + (1,), -1), last[..., :-1]], axis=-1)
+
+    log_tr = np.log(tr)
+    returns = log_tr - np.take_along_axis(log_tr, prev.clip(0), axis=-1)
+    return np.where(valid & (prev >= 0), returns, np.nan), prev
+
+
+def get_max_drawdown(tr):
+    # largest fall from a running peak of a total return index, 0 or less
+    peaks = np.fmax.accumulate(tr, axis=-1)
+    drawdowns = np.where(np.isnan(tr), np.inf, tr / peaks - 1)
+    drawdowns = drawdowns.min(axis=-1)
+    return np.where(np.isinf(drawdowns), np.nan, drawdowns)
+
+
+def get_beta(returns, bm_returns):
+    # over the days both the asset and the benchmark have a return
+    valid = ~np.isnan(returns) & ~np.isnan(bm_returns)
+    count = valid.sum(axis=-1)
+    x = np.where(valid, returns, 0)
+    y = np.where(valid, bm_returns, 0)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_x = x.sum(axis=-1) / count
+        mean_y = y.sum(axis=-1) / count
+        cov = (x * y).sum(axis=-1) / count - mean_x * mean_y
+        var = (y * y).sum(axis=-1) / count - mean_y**2
+        return cov / var
@@ -0,0 +1,117 @@
+import datetime
+import sys
+import threading
+import time
+
+import net_utils
+from db_benchmarks import BMDatabase
+from db_mufap import MFDatabase
+
+
+# concurrent requests allowed per upstream host
+host_limits = {
+    "www.mufap.com.pk": 4,
+    "dps.psx.com.pk": 2,
+    "www.khistocks.com": 1,
+    "www.brecorder.com": 1,
+}
+
+
+def set_host_limits(limits=None):
+    if limits is None:
+        limits = host_limits
+
+    for host, max_requests in limits.items():
+        net_utils.set_host_limit(host, max_requests)
+
+
+def update_mufap(shadow=False):
+    # fetches every fund from the day after its watermark and merges, returns
+    # the first date merged or None when nothing new came in
+    with MFDatabase(writer=True) as db:
+        start_date = db.get_update_start()
+        if start_date.date() > datetime.date.today():
+            return None
+
+        db.update_attached(start_date, incremental=True)
+        since = db.get_attached_start()
+        if since is not None:
+            db.merge_attached(start_date, shadow=shadow)
+        db.path_db_attach.unlink()
+
+    return since
+
+
+def update_benchmarks(shadow=False):
+    with BMDatabase() as db:
+        starts = db.get_update_starts()
+        if not starts:
+            return None
+
+        # nothing is stored after the latest watermark, earlier rows are upserted
+        start_date = max(starts.values())
+        db.update_attached(start_date, starts)
+        since = db.get_attached_start()
+        if since is not None:
+            db.merge_attached(start_date, shadow=shadow)
+        db.path_db_attach.unlink()
+
+    return since
+
+
+class Scheduler:
+    # runs each job on its own interval in seconds from a background thread, a
+    # job that fails is retried on its next run
+
+    def __init__(self, jobs=None, limits=None):
+        if jobs is None:
+            jobs = [(update_mufap, 6 * 60 * 60), (update_benchmarks, 6 * 60 * 60)]
+
+        self.jobs = jobs
+        self.limits = limits
+        self.next_run = [0] * len(jobs)
+        self.results = {}
+
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def run_pending(self):
+        for i, (job, interval) in enumerate(self.jobs):
+            if time.monotonic() < self.next_run[i]:
+                continue
+
+            print(f"Running {job.__name__}...")
+            try:
+                self.results[job.__name__] = job()
+            except Exception as e:
+                print(f"Error occurred for job {job.__name__}: {e}")
+            self.next_run[i] = time.monotonic() + interval
+
+    def run(self):
+        set_host_limits(self.limits)
+        while not self.stop_event.is_set():
+            self.run_pending()
+            self.stop_event.wait(max(min(self.next_run) - time.monotonic(), 0))
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+if __name__ == "__main__":
+    # usage: python scheduler.py [interval in hours], without one every job runs once
+    if len(sys.argv) > 1:
+        interval = float(sys.argv[1]) * 60 * 60
+        Scheduler([(update_mufap, interval), (update_benchmarks, interval)]).run()
+    else:
+        set_host_limits()
+        update_mufap()
+        update_benchmarks()
@@ -0,0 +1,204 @@
+import numpy as np
+import pandas as pd
+
+import db_query
+from nav_matrix import load_snapshot, save_snapshot, to_day
+
+
+class ScripPanel:
+    # psx_scrips as columns sorted by day, so a merge only appends to them
+    # days: offset from start_date, codes: position in symbols
+    # log_return: log(close / ldcp), volume is nan where it is missing
+    arrays = ["days", "codes", "close", "ldcp", "volume", "log_return"]
+
+    def __init__(self, symbols, start_date, days, codes, close, ldcp, volume, log_return=None, signature=None):
+        self.symbols = pd.Index(symbols, dtype=object)
+        self.start_date = to_day(start_date)
+        self.days = days
+        self.codes = codes
+        self.close = close
+        self.ldcp = ldcp
+        self.volume = volume
+        self.signature = signature
+
+        if log_return is None:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                log_return = np.log(close / ldcp)
+
+        self.log_return = log_return
+
+    @staticmethod
+    def get_signature(conn):
+        qry = "SELECT COUNT(*), MAX(close_date) FROM psx_scrips"
+        return list(conn.execute(qry).fetchone())
+
+    @staticmethod
+    def __read(conn, start_date=None):
+        qry = "SELECT close_date, symbol, close, ldcp, volume FROM psx_scrips"
+        params = ()
+        if start_date:
+            qry = qry + " WHERE close_date>=?"
+            params = (start_date,)
+        return db_query.read_sql(conn, qry, params, parse_dates=["close_date"])
+
+    @staticmethod
+    def __columns(df, symbols, start_date):
+        df = df.sort_values(["close_date", "symbol"])
+        return {
+            "days": (df["close_date"].to_numpy().astype("datetime64[D]") - start_date).astype(np.int32),
+            "codes": symbols.get_indexer(df["symbol"]).astype(np.int32),
+            "close": df["close"].to_numpy(dtype=float),
+            "ldcp": df["ldcp"].to_numpy(dtype=float),
+            "volume": df["volume"].to_numpy(dtype=float),
+        }
+
+    @classmethod
+    def build(cls, conn):
+        signature = cls.get_signature(conn)
+        df = cls.__read(conn)
+
+        symbols = pd.Index(sorted(df["symbol"].unique()), dtype=object)
+        start_date = to_day(df["close_date"].min()) if not df.empty else to_day("1970-01-01")
+
+        return cls(symbols, start_date, signature=signature, **cls.__columns(df, symbols, start_date))
+
+    def update(self, conn, cutoff_date):
+        cutoff = self.day(cutoff_date)
+        if cutoff <= 0:
+            return ScripPanel.build(conn)
+
+        signature = self.get_signature(conn)
+        df = self.__read(conn, cutoff_date)
+
+        new_symbols = pd.Index(sorted(set(df["symbol"])), dtype=object)
+        symbols = self.symbols.append(new_symbols.difference(self.symbols))
+
+        # keep every row before the cutoff, the rows from it are read again
+        keep = np.searchsorted(self.days, cutoff, side="left")
+        columns = self.__columns(df, symbols, self.start_date)
+
+        for name in columns:
+            columns[name] = np.concatenate([np.asarray(getattr(self, name)[:keep]), columns[name]])
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            log_return = np.log(columns["close"][keep:] / columns["ldcp"][keep:])
+        log_return = np.concatenate([np.asarray(self.log_return[:keep]), log_return])
+
+        return ScripPanel(symbols, self.start_date, log_return=log_return, signature=signature, **columns)
+
+    def save(self, path):
+        meta = {
+            "symbols": self.symbols.tolist(),
+            "start_date": str(self.start_date),
+            "signature": self.signature,
+        }
+        save_snapshot(path, {name: getattr(self, name) for name in self.arrays}, meta)
+
+    @classmethod
+    def load(cls, path, conn=None):
+        snapshot = load_snapshot(path, cls.arrays)
+        if snapshot is None:
+            return None
+        meta, arrays = snapshot
+
+        # stale snapshot, the database changed without the panel being updated
+        if conn is not None and meta["signature"] != cls.get_signature(conn):
+            return None
+
+        for name in cls.arrays:
+            if arrays[name].shape[0] != meta["signature"][0]:
+                return None
+
+        # saved before missing volumes were kept as nan
+        if arrays["volume"].dtype.kind != "f":
+            return None
+
+        return cls(meta["symbols"], meta["start_date"], signature=meta["signature"], **arrays)
+
+    def day(self, close_date):
+        return int((to_day(close_date) - self.start_date).astype(int))
+
+    def select(self, start_date=None, end_date=None, symbol=None, include_start=False):
+        # positions of the rows after start_date, or from it with include_start,
+        # up to and including end_date
+        lo = 0
+        hi = len(self.days)
+        if start_date is not None:
+            lo = np.searchsorted(self.days, self.day(start_date), side="left" if include_start else "right")
+        if end_date is not None:
+            hi = np.searchsorted(self.days, self.day(end_date), side="right")
+
+        if symbol is None:
+            return np.arange(lo, max(lo, hi))
+
+        code = self.symbols.get_indexer([symbol])[0]
+        if code < 0:
+            return np.arange(0)
+
+        return np.flatnonzero(np.asarray(self.codes[lo:hi]) == code) + lo
+
+    def get_dates(self, rows):
+        return (self.start_date + np.asarray(self.days[rows])).astype(str)
+
+    def get_data(self, rows):
+        return pd.DataFrame(
+            {
+                "close_date": self.get_dates(rows),
+                "symbol": self.symbols[np.asarray(self.codes[rows])].to_numpy(dtype=str),
+                "close": np.asarray(self.close[rows]),
+                "ldcp": np.asarray(self.ldcp[rows]),
+                "volume": np.asarray(self.volume[rows]),
+            }
+        )
+
+    def get_log_returns(self, rows):
+        return np.asarray(self.log_return[rows])
+
+    def get_total_returns(self, rows):
+        # summed log returns per symbol of the rows, as a return
+        codes, inverse = np.unique(np.asarray(self.codes[rows]), return_inverse=True)
+        log_return = self.get_log_returns(rows)
+        sums = np.bincount(inverse, weights=np.where(np.isnan(log_return), 0, log_return), minlength=len(codes))
+
+        ret = pd.Series(sums, index=pd.Index(self.symbols[codes], name="symbol"), name="ln_change")
+        return np.exp(ret.sort_index()) - 1
+
+    def get_return_matrix(self, symbols, start_date, end_date):
+        # symbol x date matrix of the daily log returns, nan where a symbol did not trade
+        symbols = pd.Index(symbols)
+        codes = self.symbols.get_indexer(symbols)
+
+        # matrix row of every code, -1 for symbols not asked for
+        code_rows = np.full(len(self.symbols), -1)
+        code_rows[codes[codes >= 0]] = np.flatnonzero(codes >= 0)
+
+        rows = self.select(start_date, end_date)
+        sym_rows = code_rows[np.asarray(self.codes[rows])]
+        rows = rows[sym_rows >= 0]
+        sym_rows = sym_rows[sym_rows >= 0]
+
+        days, cols = np.unique(np.asarray(self.days[rows]), return_inverse=True)
+        returns = np.full((len(symbols), len(days)), np.nan)
+        returns[sym_rows, cols] = self.get_log_returns(rows)
+
+        return returns, pd.Index((self.start_date + days).astype(str))
+
+    def get_last_closes(self, symbols, dates):
+        # symbol x date matrix of the last close on or before each date, nan
+        # before a symbol's first trade
+        days = np.array([self.day(x) for x in dates], dtype=np.int64)
+        closes = np.full((len(symbols), len(days)), np.nan)
+        if days.size == 0:
+            return closes
+
+        hi = np.searchsorted(self.days, days.max(), side="right")
+        codes = np.asarray(self.codes[:hi])
+        for i, code in enumerate(self.symbols.get_indexer(pd.Index(symbols))):
+            if code < 0:
+                continue
+            rows = np.flatnonzero(codes == code)
+            pos = np.searchsorted(np.asarray(self.days[rows]), days, side="right") - 1
+            found = pos >= 0
+            closes[i, found] = np.asarray(self.close[rows[pos[found]]])
+
+        return closes
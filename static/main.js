@@ -15,16 +15,14 @@ function scrollToSelected(select_id) {
     }
 }
 
-function fetch_data(params=null) {
-    var d = [];
+function fetch_metadata() {
+    // latest date, amcs and the categories of each amc in one cached call
+    var d = {};
     $.ajax({
-        url: '/get_data',
-        method: 'POST',
-        processData: false,
+        url: '/metadata',
+        method: 'GET',
         dataType: 'json',
         async: false,
-        data: params,
-        contentType: 'application/json',
         success: function (data) {
             d = data;
         },
@@ -35,28 +33,12 @@ function fetch_data(params=null) {
     return d;
 }
 
-function fetch_categories(amcid) {
-    var req_data = JSON.stringify({ data: 'categories', amc_id: amcid });
-    var d = fetch_data(req_data);
-    return d;
-}
-
-function fetch_latest_date() {
-    var req_data = JSON.stringify({ data: 'latest_date'});
-    var d = fetch_data(req_data);
-    return d["latest_date"].substr(0,10);
-}
-
-function fetch_amcs(amcid) {
-    var req_data = JSON.stringify({ data: 'amcs' });
-    var d = fetch_data(req_data);
-    return d;
-}
-
 const app = Vue.createApp({
     data() {
-        let latest_date = fetch_latest_date();
+        let metadata = fetch_metadata();
+        let latest_date = metadata["latest_date"].substr(0,10);
         return {
+            metadata: metadata,
             end_date: latest_date,
             start_date: getDateDelta(latest_date, -1),
             selected_amc: '0',
@@ -67,10 +49,15 @@ const app = Vue.createApp({
     },
     computed: {
         categories() {
-            return fetch_categories(this.selected_amc);
+            // the categories the selected amc has funds in
+            if (this.selected_amc == '0') {
+                return this.metadata.categories;
+            }
+            const cat_ids = this.metadata.amc_categories[this.selected_amc] || [];
+            return this.metadata.categories.filter(c => cat_ids.includes(c['cat_id']));
         },
         amcs() {
-            return fetch_amcs();
+            return this.metadata.amcs;
         },
     },
     watch: {
@@ -121,19 +108,29 @@ const app = Vue.createApp({
                     jsonData[key] = value;
                 }
             });
-            var json = JSON.stringify(jsonData);
 
             $("#floatingBarsG").show();
             
+            // a get, so the browser can revalidate its copy with the etag
             $.ajax({
-                url: '/performance',
-                method: 'POST',
-                data: json,
-                processData: false,
-                contentType: 'application/json',
+                url: '/performance.json',
+                method: 'GET',
+                data: jsonData,
+                traditional: true,
+                dataType: 'json',
                 success: function (data) {
-                    $('#div-performance').html(data);
+                    $("#floatingBarsG").hide();
+                    if (data.total == 0) {
+                        $('#div-performance').html('No data');
+                        return;
+                    }
+
+                    // columns to rows, DataTables builds the row nodes from data
+                    var rows = data.data[0].map((_, i) => data.data.map(col => col[i]));
+                    $('#div-performance').html('<table id="performance" class="table table-stripped"></table>');
                     var table = $('#performance').DataTable({
+                        data: rows,
+                        columns: data.columns.map(col => ({ title: col, defaultContent: 'n/a' })),
                         paging: false,
                         order: [[2, 'desc']],
                         // dom: 'frt',
@@ -153,7 +150,6 @@ const app = Vue.createApp({
                     });
                     table.buttons().container().appendTo( '#div-performance .col-md-6:eq(0)' );
                     $('#performance_info').hide();
-                    $("#floatingBarsG").hide();
                 },
                 error: function (xhr, status, error) {
                     // Data retrieval error
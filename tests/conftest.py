@@ -0,0 +1,111 @@
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from db_benchmarks import BMDatabase
+from db_mufap import MFDatabase
+from query_cache import QueryCache
+
+
+def make_mufap_db(path, n_funds=12, start="2022-01-01", end="2023-06-30", seed=0):
+    # funds with weekday navs that skip a few days, late inceptions and payouts
+    # on nav dates, dates stored as text the way pandas writes them
+    rng = np.random.default_rng(seed)
+    conn = sqlite3.connect(path)
+
+    cats = pd.DataFrame({"cat_id": ["01", "02", "06"], "category": ["Equity", "Income", "Money Market"]})
+    amcs = pd.DataFrame({"amc_id": ["1", "2"], "amc": ["A AMC", "B AMC"]})
+    funds = pd.DataFrame({
+        "fund_id": [f"F{i:02d}" for i in range(n_funds)],
+        "fund_name": [f"Fund {i}" for i in range(n_funds)],
+        "cat_id": [cats["cat_id"].iloc[i % len(cats)] for i in range(n_funds)],
+        "inception": pd.Timestamp(start) + pd.to_timedelta(rng.integers(0, 200, n_funds) * (np.arange(n_funds) % 3 == 0), unit="D"),
+        "amc_id": [amcs["amc_id"].iloc[i % len(amcs)] for i in range(n_funds)],
+        "backward": 0,
+        "mufap_tab": "funds",
+    })
+
+    dates = pd.bdate_range(start, end)
+    navs = []
+    for fund_id, inception in zip(funds["fund_id"], funds["inception"]):
+        days = dates[dates >= inception]
+        days = days[rng.random(len(days)) > 0.1]
+        nav = 10 * np.exp(np.cumsum(rng.normal(0.0003, 0.01, len(days))))
+        navs.append(pd.DataFrame({"fund_id": fund_id, "nav": nav, "nav_date": days}))
+    navs = pd.concat(navs, ignore_index=True)
+
+    payouts = navs.sample(20, random_state=seed).rename(columns={"nav": "exnav", "nav_date": "payout_date"})
+    payouts["payout"] = (payouts["exnav"] * 0.05).round(4)
+
+    funds.to_sql("funds", conn, index=False)
+    amcs.to_sql("amcs", conn, index=False)
+    cats.to_sql("categories", conn, index=False)
+    navs.to_sql("navs", conn, index=False)
+    payouts[["fund_id", "payout", "exnav", "payout_date"]].to_sql("payouts", conn, index=False)
+    conn.commit()
+    conn.close()
+
+
+@pytest.fixture
+def mufap_db(tmp_path, monkeypatch):
+    # MFDatabase on a fresh synthetic database, with none of the class level
+    # state left over from other tests
+    path = tmp_path / "mufap.db"
+    make_mufap_db(path)
+
+    monkeypatch.setattr(MFDatabase, "path_db_main", path)
+    monkeypatch.setattr(MFDatabase, "path_db_attach", tmp_path / "mufap_attach.db")
+    monkeypatch.setattr(MFDatabase, "path_nav_matrix", tmp_path / "mufap_navs")
+    monkeypatch.setattr(MFDatabase, "db_cache", QueryCache())
+    monkeypatch.setattr(MFDatabase, "nav_matrix", None)
+    monkeypatch.setattr(MFDatabase, "nav_matrix_loaded", False)
+    monkeypatch.setattr(MFDatabase, "generation", None)
+    monkeypatch.setattr(MFDatabase, "pool", None)
+
+    return path
+
+
+def make_benchmarks_db(path, n_symbols=8, start="2022-01-03", end="2023-06-30", seed=0):
+    # symbols that skip some days and list late, a few missing volumes, an
+    # index and a rate on every weekday
+    rng = np.random.default_rng(seed)
+    conn = sqlite3.connect(path)
+
+    dates = pd.bdate_range(start, end)
+    index_close = 40000 * np.exp(np.cumsum(rng.normal(0.0002, 0.01, len(dates))))
+
+    scrips = []
+    for i in range(n_symbols):
+        # moves partly with the index
+        close = 100 * np.exp(np.cumsum(0.5 * np.diff(np.log(index_close), prepend=np.log(index_close[0])) + rng.normal(0, 0.015, len(dates))))
+        ldcp = np.r_[close[0], close[:-1]]
+        traded = (rng.random(len(dates)) > 0.15) & (dates >= dates[0] + pd.Timedelta(days=int(40 * (i % 3))))
+        volume = rng.integers(0, 10**6, len(dates)).astype(float)
+        volume[rng.random(len(dates)) < 0.05] = np.nan
+        scrips.append(pd.DataFrame({"close_date": dates.strftime("%Y-%m-%d"), "symbol": f"S{i:02d}", "close": close, "ldcp": ldcp, "volume": volume})[traded])
+    scrips = pd.concat(scrips, ignore_index=True).sample(frac=1, random_state=seed)
+
+    pd.DataFrame({"bm_id": ["1", "10"], "bm_name": ["KSE 100", "KIBOR_3M"]}).to_sql("benchmarks", conn, index=False)
+    scrips.to_sql("psx_scrips", conn, index=False)
+    pd.DataFrame({"index_date": dates.strftime("%Y-%m-%d"), "bm_id": "1", "close": index_close}).to_sql("psx_indexes", conn, index=False)
+    pd.DataFrame({"bm_date": dates.strftime("%Y-%m-%d"), "rate": 0.2, "bm_id": "10"}).to_sql("fi_rates", conn, index=False)
+    conn.commit()
+    conn.close()
+
+
+@pytest.fixture
+def benchmarks_db(tmp_path, monkeypatch):
+    # BMDatabase on a fresh synthetic database, as mufap_db
+    path = tmp_path / "benchmarks.db"
+    make_benchmarks_db(path)
+
+    monkeypatch.setattr(BMDatabase, "path_db_main", path)
+    monkeypatch.setattr(BMDatabase, "path_db_attach", tmp_path / "benchmarks_attach.db")
+    monkeypatch.setattr(BMDatabase, "path_scrip_panel", tmp_path / "benchmarks_scrips")
+    monkeypatch.setattr(BMDatabase, "db_cache", QueryCache())
+    monkeypatch.setattr(BMDatabase, "scrip_panel", None)
+    monkeypatch.setattr(BMDatabase, "generation", None)
+
+    return path
@@ -0,0 +1,83 @@
+import sqlite3
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from db_mufap import MFDatabase
+
+
+def get_tr_index(conn):
+    # each nav over the one before, grossed up for the payouts in between
+    df_navs = pd.read_sql("SELECT * FROM navs WHERE nav!=0 ORDER BY fund_id, nav_date", conn, parse_dates=["nav_date"])
+    df_payouts = pd.read_sql("SELECT * FROM payouts", conn, parse_dates=["payout_date"])
+
+    ret = {}
+    for fund_id, df in df_navs.groupby("fund_id"):
+        payouts = df_payouts[df_payouts["fund_id"] == fund_id]
+        tr = [1.0]
+        for (date_prev, nav_prev), (date, nav) in zip(df[["nav_date", "nav"]].values[:-1], df[["nav_date", "nav"]].values[1:]):
+            paid = payouts[(payouts["payout_date"] > date_prev) & (payouts["payout_date"] <= date)]
+            div_factor = ((paid["exnav"] + paid["payout"]) / paid["exnav"]).prod()
+            tr.append(tr[-1] * nav / nav_prev * div_factor)
+        ret.update({(fund_id, str(x)): y for x, y in zip(df["nav_date"], tr)})
+
+    return pd.Series(ret).sort_index()
+
+
+def read_tr_index(conn):
+    df = pd.read_sql("SELECT fund_id, nav_date, tr_index FROM fund_daily_returns", conn)
+    return df.set_index(["fund_id", "nav_date"])["tr_index"].sort_index()
+
+
+def test_build_matches_pandas(mufap_db):
+    with MFDatabase() as db:
+        db.build_daily_returns()
+        tr_index = read_tr_index(db.conn)
+        expected = get_tr_index(db.conn)
+
+    pd.testing.assert_series_equal(tr_index, expected, check_names=False, check_index_type=False)
+
+
+def test_update_equals_build(mufap_db):
+    cutoff = datetime(2023, 3, 1)
+
+    conn = sqlite3.connect(mufap_db)
+    df_navs = pd.read_sql("SELECT * FROM navs WHERE nav_date>=?", conn, params=(str(cutoff),))
+    df_payouts = pd.read_sql("SELECT * FROM payouts WHERE payout_date>=?", conn, params=(str(cutoff),))
+    conn.execute("DELETE FROM navs WHERE nav_date>=?", (str(cutoff),))
+    conn.execute("DELETE FROM payouts WHERE payout_date>=?", (str(cutoff),))
+    conn.commit()
+
+    with MFDatabase() as db:
+        db.build_daily_returns()
+
+        # the rows a merge brings in from the cutoff
+        df_navs.to_sql("navs", db.conn, if_exists="append", index=False)
+        df_payouts.to_sql("payouts", db.conn, if_exists="append", index=False)
+        db.execute("INSERT INTO payouts SELECT fund_id, 0.5, nav, nav_date FROM navs WHERE fund_id='F02' AND nav_date>='2023-04-03' LIMIT 1")
+        db.conn.commit()
+
+        db.update_daily_returns(cutoff)
+        updated = read_tr_index(db.conn)
+
+        db.build_daily_returns()
+        built = read_tr_index(db.conn)
+
+    pd.testing.assert_series_equal(updated, built)
+
+
+def test_returns_match_navs(mufap_db):
+    op_date, end_date = datetime(2022, 6, 15), datetime(2023, 3, 3)
+
+    with MFDatabase() as db:
+        df_funds = db.get_fundlist(with_cats=True)
+        ret_navs = db.get_returns_navs(df_funds, op_date, end_date)
+
+        db.build_daily_returns()
+        tr = db.get_tr_panel(pd.Index(df_funds["fund_id"]), [op_date, end_date])
+
+    ret_tr = tr[:, 1] / tr[:, 0] - 1
+    found = ~np.isnan(ret_tr)
+    assert found.any()
+    np.testing.assert_allclose(ret_tr[found], ret_navs[found])
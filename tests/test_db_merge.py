@@ -0,0 +1,93 @@
+import shutil
+import sqlite3
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+import db_merge
+from db_mufap import MFDatabase
+
+
+cutoff = datetime(2023, 5, 1)
+
+
+def attach_rows(db):
+    # navs from the cutoff revised, plus a fund that is new in the attached data
+    conn = sqlite3.connect(MFDatabase.path_db_main)
+    df_navs = pd.read_sql("SELECT * FROM navs WHERE nav_date>=?", conn, params=(str(cutoff),))
+    df_payouts = pd.read_sql("SELECT * FROM payouts WHERE payout_date>=?", conn, params=(str(cutoff),))
+    conn.close()
+
+    df_navs["nav"] = df_navs["nav"] * 1.01
+    df_new = pd.DataFrame({"fund_id": "F99", "nav": 10.0, "nav_date": ["2023-05-02 00:00:00", "2023-05-03 00:00:00"]})
+    df_navs = pd.concat([df_navs, df_new], ignore_index=True)
+
+    conn_attach = db.make_attached_db()
+    df_navs.to_sql("navs", conn_attach, if_exists="append", index=False)
+    df_payouts.to_sql("payouts", conn_attach, if_exists="append", index=False)
+    conn_attach.commit()
+    conn_attach.close()
+
+    return df_navs
+
+
+def read_table(conn, table, order):
+    return pd.read_sql(f"SELECT * FROM {table} ORDER BY {order}", conn)
+
+
+def test_shadow_merge_equals_direct_merge(mufap_db, tmp_path, monkeypatch):
+    path_direct = tmp_path / "direct.db"
+    shutil.copy(mufap_db, path_direct)
+
+    with MFDatabase(writer=True) as db:
+        before = pd.read_sql("SELECT * FROM navs WHERE nav_date<?", db.conn, params=(str(cutoff),))
+        df_attached = attach_rows(db)
+        db.merge_attached(cutoff, shadow=True)
+
+        navs = read_table(db.conn, "navs", "fund_id, nav_date")
+        daily_returns = read_table(db.conn, "fund_daily_returns", "fund_id, nav_date")
+
+    assert not db_merge.get_shadow_path(mufap_db).exists()
+    assert db_merge.get_generation(mufap_db) is not None
+
+    # rows before the cutoff are kept, rows from it are the attached ones
+    pd.testing.assert_frame_equal(
+        navs[navs["nav_date"] < str(cutoff)].reset_index(drop=True),
+        before.sort_values(["fund_id", "nav_date"], ignore_index=True),
+    )
+    pd.testing.assert_frame_equal(
+        navs[navs["nav_date"] >= str(cutoff)].reset_index(drop=True),
+        df_attached.sort_values(["fund_id", "nav_date"], ignore_index=True),
+    )
+
+    monkeypatch.setattr(MFDatabase, "path_db_main", path_direct)
+    monkeypatch.setattr(MFDatabase, "path_nav_matrix", tmp_path / "direct_navs")
+    monkeypatch.setattr(MFDatabase, "nav_matrix", None)
+    monkeypatch.setattr(MFDatabase, "nav_matrix_loaded", False)
+    with MFDatabase(writer=True) as db:
+        attach_rows(db)
+        db.merge_attached(cutoff, shadow=False)
+        pd.testing.assert_frame_equal(read_table(db.conn, "navs", "fund_id, nav_date"), navs)
+        pd.testing.assert_frame_equal(read_table(db.conn, "fund_daily_returns", "fund_id, nav_date"), daily_returns)
+
+
+def test_failed_validation_leaves_live_untouched(mufap_db, monkeypatch):
+    merge = db_merge.merge
+
+    def merge_losing_rows(conn, path_attach, tables, cutoff):
+        merge(conn, path_attach, tables, cutoff)
+        conn.execute("DELETE FROM navs WHERE nav_date<'2022-02-01'")
+
+    monkeypatch.setattr(db_merge, "merge", merge_losing_rows)
+
+    with MFDatabase(writer=True) as db:
+        navs = read_table(db.conn, "navs", "fund_id, nav_date")
+        attach_rows(db)
+
+        with pytest.raises(ValueError, match="Merged navs"):
+            db.merge_attached(cutoff, shadow=True)
+
+        pd.testing.assert_frame_equal(read_table(db.conn, "navs", "fund_id, nav_date"), navs)
+
+    assert not db_merge.get_shadow_path(mufap_db).exists()
@@ -0,0 +1,70 @@
+import sqlite3
+from datetime import date, datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import db_query
+from query_cache import QueryCache
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(":memory:")
+    df = pd.DataFrame({"id": np.arange(500), "day": pd.date_range("2023-01-01", periods=500).strftime("%Y-%m-%d")})
+    df.to_sql("t", conn, index=False)
+    yield conn
+    conn.close()
+
+
+@pytest.mark.parametrize("n", [0, 1, 5, db_query.max_in_params, db_query.max_in_params + 1, 300])
+def test_in_list_matches_formatted_sql(conn, n):
+    ids = list(range(0, 2 * n, 2))
+    values = ", ".join(str(x) for x in ids) or "NULL"
+
+    df = db_query.read_sql(conn, "SELECT * FROM t WHERE id IN ? AND day>=? ORDER BY id", (ids, "2023-01-05"))
+    expected = pd.read_sql(f"SELECT * FROM t WHERE id IN ({values}) AND day>='2023-01-05' ORDER BY id", conn)
+
+    pd.testing.assert_frame_equal(df, expected)
+    # the temp table does not leave a transaction open
+    assert not conn.in_transaction
+
+
+def test_list_types_and_dates_bind_alike(conn):
+    qry = "SELECT id FROM t WHERE id IN ? AND day<=?"
+    expected = db_query.execute(conn, qry, ([3, 4], "2023-01-05")).fetchall()
+
+    for ids in [(3, 4), np.array([3, 4]), pd.Series([3, 4]), pd.Index([3, 4]), {3, 4}]:
+        for day in ["2023-01-05", date(2023, 1, 5)]:
+            assert sorted(db_query.execute(conn, qry, (ids, day)).fetchall()) == expected
+
+    # datetimes bind in the format pandas stores them in
+    assert db_query.bind_value(datetime(2023, 1, 5)) == "2023-01-05 00:00:00"
+    assert db_query.bind_value(np.int64(3)) == 3
+
+
+def test_parameter_count_is_checked(conn):
+    with pytest.raises(ValueError):
+        db_query.execute(conn, "SELECT * FROM t WHERE id=? AND day=?", (1,))
+
+
+def test_key_separates_params_and_parse_dates():
+    qry = "SELECT * FROM t WHERE id IN ?"
+    assert db_query.get_key(qry, ([1, 2],)) == db_query.get_key(qry, (np.array([1, 2]),))
+    assert db_query.get_key(qry, ([1, 2],)) != db_query.get_key(qry, ([1, 3],))
+    assert db_query.get_key(qry, ([1, 2],)) != db_query.get_key(qry, ([1, 2],), ["day"])
+    assert db_query.get_key(qry, ([1, 2],), ["day"]) == db_query.get_key(qry, ([1, 2],), ("day",))
+
+
+def test_read_sql_cached(conn):
+    cache = QueryCache()
+    qry = "SELECT * FROM t WHERE id<?"
+
+    df = db_query.read_sql_cached(conn, cache, qry, (3,))
+    df["id"] = -1
+    assert db_query.read_sql_cached(conn, cache, qry, (3,))["id"].tolist() == [0, 1, 2]
+
+    df = db_query.read_sql_cached(conn, cache, qry, (3,), parse_dates=["day"])
+    assert pd.api.types.is_datetime64_any_dtype(df["day"])
+    assert cache.stats()["misses"] == 2
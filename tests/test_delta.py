@@ -0,0 +1,77 @@
+import io
+import shutil
+import sqlite3
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import db_merge
+from db_mufap import MFDatabase
+
+
+since = datetime(2023, 4, 1)
+
+
+def read_tables(conn, since=since):
+    return {
+        table: pd.read_sql(f"SELECT * FROM {table} WHERE {date_col}>=?", conn, params=(str(since),))
+        .sort_values(["fund_id", date_col], ignore_index=True)
+        for table, date_col in MFDatabase.merge_tables.items()
+    }
+
+
+def test_round_trip_matches_sql(mufap_db):
+    conn = sqlite3.connect(mufap_db)
+    blob = db_merge.export_delta(conn, MFDatabase.merge_tables, since)
+    expected = read_tables(conn)
+    conn.close()
+
+    for source in [blob, io.BytesIO(blob)]:
+        since_read, frames = db_merge.read_delta(source)
+        assert since_read == since
+
+        for table, df in frames.items():
+            df = df[expected[table].columns].sort_values(["fund_id", MFDatabase.merge_tables[table]], ignore_index=True)
+            pd.testing.assert_frame_equal(df, expected[table], check_dtype=False)
+
+
+def test_apply_is_idempotent(mufap_db, tmp_path, monkeypatch):
+    conn = sqlite3.connect(mufap_db)
+    blob = db_merge.export_delta(conn, MFDatabase.merge_tables, since)
+    expected = read_tables(conn, datetime(2000, 1, 1))
+    conn.close()
+
+    # a server without the delta's rows, and a stale one the delta replaces
+    path_server = tmp_path / "server.db"
+    shutil.copy(mufap_db, path_server)
+    conn = sqlite3.connect(path_server)
+    conn.execute("DELETE FROM navs WHERE nav_date>=?", (str(since),))
+    conn.execute("DELETE FROM payouts WHERE payout_date>=?", (str(since),))
+    conn.execute("INSERT INTO navs VALUES ('F00', 1.0, '2023-04-03 00:00:00')")
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(MFDatabase, "path_db_main", path_server)
+
+    for _ in range(2):
+        with MFDatabase(writer=True) as db:
+            db.apply_delta(blob)
+            tables = read_tables(db.conn, datetime(2000, 1, 1))
+
+        assert not MFDatabase.path_db_attach.exists()
+        for table, df in tables.items():
+            pd.testing.assert_frame_equal(df[expected[table].columns], expected[table])
+
+
+@pytest.mark.parametrize("blob", [b"", b"not a delta", b"PK\x03\x04" + b"\0" * 40])
+def test_malformed_raises_value_error(blob):
+    with pytest.raises(ValueError):
+        db_merge.read_delta(blob)
+
+
+def test_npz_without_meta_raises_value_error():
+    f = io.BytesIO()
+    np.savez(f, x=np.arange(3))
+    with pytest.raises(ValueError):
+        db_merge.read_delta(f.getvalue())
@@ -0,0 +1,44 @@
+from datetime import datetime
+
+import pandas as pd
+
+import mufap
+import net_utils
+
+
+class Response:
+    def __init__(self, content):
+        self.content = content
+
+
+nav_report = b"""<html><body>
+<table class="mydata">
+<tr><th>Fund Name</th><th>Category</th><th>NAV</th><th>Validity Date</th><th>Class</th><th>Type</th></tr>
+<tr><td class="amc">A AMC</td></tr>
+<tr><td class="fundname">Fund A</td><td>Equity</td><td>1,234.5678</td><td>Sep 29, 2023</td><td>-</td><td>-</td></tr>
+<tr><td class="fundname">Fund B</td><td>Income</td><td>98.7654</td><td>Sep 29, 2023</td><td>-</td><td>-</td></tr>
+</table>
+</body></html>"""
+
+payout_report = b"""<html><body>
+<table class="mydata">
+<tr><th>Fund Name</th><th>Payout (Per Unit)</th><th>Ex-NAV</th><th>Payout Date</th></tr>
+<tr><td class="fundname">Fund A</td><td>1,050.25</td><td>10,234.5</td><td>Jun 28, 2023</td></tr>
+</table>
+</body></html>"""
+
+
+def test_fund_navs_thousands(monkeypatch):
+    monkeypatch.setattr(net_utils, "get", lambda url, *args, **kwargs: Response(nav_report))
+    df = mufap.mufap_fund_navs(datetime(2023, 9, 1), mufap_tab="funds")
+
+    assert pd.api.types.is_float_dtype(df["NAV"])
+    assert df["NAV"].tolist() == [1234.5678, 98.7654]
+
+
+def test_fund_payouts_thousands(monkeypatch):
+    monkeypatch.setattr(net_utils, "get", lambda url, *args, **kwargs: Response(payout_report))
+    df = mufap.mufap_fund_payouts(datetime(2023, 1, 1))
+
+    assert df["Payout (Per Unit)"].tolist() == [1050.25]
+    assert df["Ex-NAV"].tolist() == [10234.5]
@@ -0,0 +1,111 @@
+import shutil
+import sqlite3
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from db_mufap import MFDatabase
+from nav_matrix import NavMatrix
+
+
+dates = [datetime(2022, 1, 3), datetime(2022, 6, 15), datetime(2022, 12, 31), datetime(2023, 3, 5), datetime(2023, 6, 30)]
+
+
+def assert_matrix_equal(a, b):
+    rows = a.fund_ids.get_indexer(b.fund_ids)
+    assert (rows >= 0).all()
+    assert a.start_date == b.start_date
+    for name in NavMatrix.arrays:
+        np.testing.assert_allclose(np.asarray(getattr(a, name))[rows], np.asarray(getattr(b, name)), equal_nan=True)
+
+
+def test_navs_match_sql(mufap_db):
+    with MFDatabase() as db:
+        fund_ids = db.get_fundlist()["fund_id"]
+        df_navs = db.pd_read_sql_cached("SELECT fund_id, nav_date FROM navs", parse_dates=["nav_date"])
+
+        # interpolation is only asked for funds without a nav on the day
+        missing = [fund_ids[~fund_ids.isin(df_navs.loc[df_navs["nav_date"] == x, "fund_id"])] for x in dates]
+        sql = [(db.get_navs_last(fund_ids, x), db.get_navs_interpolated(m, x)) for x, m in zip(dates, missing)]
+
+        db.build_nav_matrix()
+        for nav_date, fund_ids_missing, (sql_last, sql_interpolated) in zip(dates, missing, sql):
+            last = db.get_navs_last(fund_ids, nav_date)
+            pd.testing.assert_frame_equal(
+                last.sort_values("fund_id").reset_index(drop=True),
+                sql_last.sort_values("fund_id").reset_index(drop=True),
+                check_dtype=False,
+            )
+
+            interpolated = db.get_navs_interpolated(fund_ids_missing, nav_date)
+            pd.testing.assert_frame_equal(
+                interpolated.sort_values("fund_id").reset_index(drop=True),
+                sql_interpolated.sort_values("fund_id").reset_index(drop=True),
+                check_dtype=False,
+            )
+
+        assert sum(len(x) for _, x in sql) > 0
+
+
+def test_returns_match_pandas(mufap_db):
+    conn = sqlite3.connect(mufap_db)
+    matrix = NavMatrix.build(conn)
+    df_navs = pd.read_sql("SELECT * FROM navs", conn, parse_dates=["nav_date"])
+    df_payouts = pd.read_sql("SELECT * FROM payouts", conn, parse_dates=["payout_date"])
+    conn.close()
+
+    op_date, end_date = datetime(2022, 6, 15), datetime(2023, 3, 3)
+    navs = df_navs.pivot(index="fund_id", columns="nav_date", values="nav")
+    df_payouts = df_payouts[(df_payouts["payout_date"] > op_date) & (df_payouts["payout_date"] <= end_date)]
+    div_factors = ((df_payouts["exnav"] + df_payouts["payout"]) / df_payouts["exnav"]).groupby(df_payouts["fund_id"]).prod()
+
+    expected = navs[end_date] / navs.get(op_date, np.nan) * div_factors.reindex(navs.index).fillna(1) - 1
+    returns = matrix.get_returns(navs.index, op_date, end_date)
+
+    np.testing.assert_allclose(returns, expected.to_numpy(), equal_nan=True)
+
+
+def test_update_equals_build(mufap_db, tmp_path):
+    cutoff = datetime(2023, 3, 1)
+
+    # a fund listed after the cutoff and a payout after it
+    conn = sqlite3.connect(mufap_db)
+    days = pd.bdate_range("2023-04-03", "2023-05-31")
+    pd.DataFrame({"fund_id": "F99", "nav": np.linspace(10, 11, len(days)), "nav_date": days}).to_sql("navs", conn, index=False, if_exists="append")
+    conn.execute("INSERT INTO payouts SELECT fund_id, 0.5, nav, nav_date FROM navs WHERE fund_id='F01' AND nav_date>'2023-04-01' LIMIT 1")
+    conn.commit()
+
+    path_old = tmp_path / "old.db"
+    shutil.copy(mufap_db, path_old)
+    conn_old = sqlite3.connect(path_old)
+    conn_old.execute("DELETE FROM navs WHERE nav_date>=?", (str(cutoff),))
+    conn_old.execute("DELETE FROM payouts WHERE payout_date>=?", (str(cutoff),))
+    conn_old.commit()
+
+    updated = NavMatrix.build(conn_old).update(conn, cutoff)
+    built = NavMatrix.build(conn)
+    conn_old.close()
+    conn.close()
+
+    assert_matrix_equal(updated, built)
+    assert updated.signature == built.signature
+
+
+def test_snapshot_round_trip(mufap_db, tmp_path):
+    conn = sqlite3.connect(mufap_db)
+    path = tmp_path / "navs"
+
+    matrix = NavMatrix.build(conn)
+    matrix.save(path)
+    matrix.save(path)
+    loaded = NavMatrix.load(path, conn)
+
+    assert_matrix_equal(loaded, matrix)
+    # only the version the metadata points at is kept
+    assert len(list(tmp_path.glob("navs.*.npy"))) == len(NavMatrix.arrays)
+
+    # stale once the navs change
+    conn.execute("INSERT INTO navs VALUES ('F00', 10.0, '2023-07-03 00:00:00')")
+    assert NavMatrix.load(path, conn) is None
+    conn.close()
@@ -0,0 +1,79 @@
+import sqlite3
+
+from db_mufap import MFDatabase
+from query_cache import QueryCache
+
+
+def test_get_tables():
+    qry = "SELECT * FROM navs INNER JOIN main.Funds ON navs.fund_id=funds.fund_id LEFT JOIN payouts USING (fund_id)"
+    assert QueryCache.get_tables(qry) == ("funds", "navs", "payouts")
+
+
+def test_invalidate_drops_only_tagged_entries():
+    cache = QueryCache()
+    cache.put("navs", 1, ("navs",))
+    cache.put("funds", 2, ("funds",))
+    cache.put("both", 3, ("funds", "navs"))
+
+    cache.invalidate("NAVS")
+
+    assert cache.get("navs") is None
+    assert cache.get("both") is None
+    assert cache.get("funds") == 2
+    assert cache.stats()["invalidations"] == 2
+
+
+def test_put_drops_values_read_across_an_invalidation():
+    cache = QueryCache()
+
+    generations = cache.get_generations(("navs",))
+    cache.invalidate("navs")
+    cache.put("key", "stale", ("navs",), generations)
+    assert cache.get("key") is None
+
+    generations = cache.get_generations(("navs",))
+    cache.clear()
+    cache.put("key", "stale", ("navs",), generations)
+    assert cache.get("key") is None
+
+    generations = cache.get_generations(("navs",))
+    cache.invalidate("funds")
+    cache.put("key", "fresh", ("navs",), generations)
+    assert cache.get("key") == "fresh"
+
+
+def test_evicts_least_recently_used_by_size():
+    value = b"x" * 100
+    cache = QueryCache(max_bytes=250)
+    cache.put("a", value)
+    cache.put("b", value)
+    cache.get("a")
+    cache.put("c", value)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == value
+    assert cache.get("c") == value
+    assert cache.size <= cache.max_bytes
+
+    # larger than the whole cache, never stored
+    cache.put("d", b"x" * 300)
+    assert cache.get("d") is None
+
+
+def test_db_cache_sees_merged_rows(mufap_db):
+    qry = "SELECT COUNT(*) AS n FROM navs"
+
+    with MFDatabase() as db:
+        before = db.pd_read_sql_cached(qry)["n"].iloc[0]
+        db.execute("DELETE FROM navs WHERE nav_date>='2023-06-01'")
+        db.conn.commit()
+
+        # cached until the table is invalidated, as merge_attached does
+        assert db.pd_read_sql_cached(qry)["n"].iloc[0] == before
+        db.db_cache.invalidate("navs")
+        after = db.pd_read_sql_cached(qry)["n"].iloc[0]
+
+    conn = sqlite3.connect(mufap_db)
+    assert after == conn.execute(qry).fetchone()[0]
+    assert after < before
+    conn.close()
@@ -0,0 +1,75 @@
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from db_benchmarks import BMDatabase
+
+
+start_date, end_date = "2022-03-01", "2023-02-28"
+portfolio = pd.DataFrame({"symbol": ["S00", "S01", "S02", "S03", "S04"], "weight": [0.3, 0.25, 0.2, 0.15, 0.1]})
+
+
+def read_log_returns(conn, symbols):
+    df = pd.read_sql(
+        f"SELECT * FROM psx_scrips WHERE symbol IN ({','.join('?' * len(symbols))}) AND close_date>? AND close_date<=?",
+        conn,
+        params=(*symbols, start_date, end_date),
+    )
+    df["ln_change"] = np.log(df["close"] / df["ldcp"])
+    return df
+
+
+def get_portfolio_stddev(conn, portfolio):
+    # the per symbol stddev and pivoted correlation the queries used to compute
+    df = read_log_returns(conn, portfolio["symbol"].tolist())
+    stddev = df.groupby("symbol")["ln_change"].std(ddof=0)
+    correls = df.pivot(index="close_date", columns="symbol", values="ln_change").fillna(0).corr()
+
+    w_stddev = portfolio.set_index("symbol")["weight"] * stddev
+    return (w_stddev @ correls.loc[w_stddev.index, w_stddev.index] @ w_stddev) ** 0.5
+
+
+def test_stddev_matches_pandas(benchmarks_db):
+    conn = sqlite3.connect(benchmarks_db)
+    expected = get_portfolio_stddev(conn, portfolio)
+    conn.close()
+
+    with BMDatabase() as db:
+        res = db.get_portfolio_risk(portfolio, start_date, end_date)
+        stddev = db.get_portfolio_stddev(portfolio, start_date, end_date)
+
+    np.testing.assert_allclose(stddev, expected)
+    np.testing.assert_allclose(res["stddev"], expected)
+    np.testing.assert_allclose(res["risk"]["component"].sum(), expected)
+    np.testing.assert_allclose(res["risk"]["contribution"].sum(), 1)
+
+
+def test_repeated_symbols_add_weights(benchmarks_db):
+    repeated = pd.concat([portfolio, pd.DataFrame({"symbol": ["S00"], "weight": [0.1]})], ignore_index=True)
+    merged = portfolio.assign(weight=portfolio["weight"] + 0.1 * (portfolio["symbol"] == "S00"))
+
+    with BMDatabase() as db:
+        res = db.get_portfolio_risk(repeated, start_date, end_date)
+        expected = db.get_portfolio_risk(merged, start_date, end_date)
+
+    assert res["risk"]["symbol"].tolist() == portfolio["symbol"].tolist()
+    np.testing.assert_allclose(res["stddev"], expected["stddev"])
+
+
+def test_tracking_error_matches_pandas(benchmarks_db):
+    conn = sqlite3.connect(benchmarks_db)
+    df = read_log_returns(conn, portfolio["symbol"].tolist())
+    df_index = pd.read_sql("SELECT index_date, close FROM psx_indexes WHERE bm_id='1' AND index_date>? AND index_date<=?", conn, params=(start_date, end_date))
+    conn.close()
+
+    # days a symbol did not trade count as no change
+    returns = df.pivot(index="close_date", columns="symbol", values="ln_change").fillna(0)
+    index_returns = np.log(df_index["close"] / df_index["close"].shift())
+    active = returns @ portfolio.set_index("symbol")["weight"] - pd.Series(index_returns.to_numpy(), index=df_index["index_date"])
+    expected = active.dropna().std(ddof=0)
+
+    with BMDatabase() as db:
+        res = db.get_portfolio_risk(portfolio, start_date, end_date, index_id="1")
+
+    np.testing.assert_allclose(res["tracking_error"], expected)
@@ -0,0 +1,110 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import risk
+from db_benchmarks import BMDatabase
+from db_mufap import MFDatabase
+
+
+op_date, end_date = datetime(2022, 6, 15), datetime(2023, 6, 30)
+
+
+def test_series_stats_match_pandas():
+    rng = np.random.default_rng(0)
+    tr = np.exp(np.cumsum(rng.normal(0, 0.01, (3, 100)), axis=1))
+    tr[rng.random(tr.shape) < 0.3] = np.nan
+    tr[2] = np.nan
+    bm = np.exp(np.cumsum(rng.normal(0, 0.01, 100)))
+
+    returns, prev = risk.get_interval_returns(tr)
+    bm_returns = np.where(np.isnan(returns), np.nan, np.log(bm) - np.log(bm)[prev.clip(0)])
+    drawdown = risk.get_max_drawdown(tr)
+    beta = risk.get_beta(returns, bm_returns)
+
+    for i in range(2):
+        x = pd.Series(tr[i]).dropna()
+        expected = np.log(x).diff()
+        np.testing.assert_allclose(returns[i][x.index[1:]], expected.iloc[1:])
+        assert np.isnan(np.delete(returns[i], x.index[1:])).all()
+
+        np.testing.assert_allclose(drawdown[i], (x / x.cummax() - 1).min())
+
+        y = np.log(pd.Series(bm)[x.index]).diff()
+        np.testing.assert_allclose(beta[i], expected.cov(y, ddof=0) / y.var(ddof=0))
+
+    assert np.isnan(drawdown[2]) and np.isnan(beta[2])
+
+
+def get_risk_metrics(db, rf):
+    # from the total return index of each fund's navs in the window
+    df = db.pd_read_sql_cached("SELECT * FROM fund_daily_returns WHERE nav_date>=? AND nav_date<=?", (op_date, end_date))
+    df_index = BMDatabase().get_index_data("1", end_date=str(end_date.date()))
+    closes = df_index.set_index("index_date")["close"].reindex(pd.date_range(op_date, end_date).strftime("%Y-%m-%d")).ffill()
+
+    ret = {}
+    for fund_id, g in df.groupby("fund_id"):
+        g = g.sort_values("nav_date")
+        tr = g["tr_index"].to_numpy()
+        dates = pd.to_datetime(g["nav_date"])
+        returns = np.diff(np.log(tr))
+        if len(returns) == 0:
+            continue
+
+        span = (dates.iloc[-1] - dates.iloc[0]).days
+        volatility = returns.std() * np.sqrt(len(returns) * 365 / span)
+        total = tr[-1] / tr[0] - 1
+        ret_ann = total * 365 / span if span <= 365 else (1 + total) ** (365 / span) - 1
+
+        index_returns = np.diff(np.log(closes[dates.dt.strftime("%Y-%m-%d")].to_numpy()))
+        ok = np.isfinite(index_returns)
+        beta = np.cov(returns[ok], index_returns[ok], ddof=0)[0, 1] / index_returns[ok].var()
+
+        ret[fund_id] = {
+            "volatility": volatility,
+            "max_drawdown": (tr / np.maximum.accumulate(tr) - 1).min(),
+            "sharpe": (ret_ann - rf) / volatility,
+            "beta": beta,
+        }
+
+    return pd.DataFrame.from_dict(ret, orient="index")
+
+
+def test_metrics_match_pandas(mufap_db, benchmarks_db):
+    with MFDatabase() as db:
+        db.build_daily_returns()
+        rf = BMDatabase().get_fi_avg("10", op_date, end_date) / 100
+        expected = get_risk_metrics(db, rf)
+        df = db.get_risk_metrics(op_date, end_date, rf_name="KIBOR_3M").set_index("fund_id")
+
+    assert len(expected) > 0 and expected.notna().all().all()
+    pd.testing.assert_frame_equal(df.loc[expected.index], expected, check_names=False)
+
+
+def test_without_benchmarks(mufap_db, tmp_path, monkeypatch):
+    monkeypatch.setattr(BMDatabase, "path_db_main", tmp_path / "missing.db")
+
+    with MFDatabase() as db:
+        df = db.get_risk_metrics(op_date, end_date)
+
+    assert df["volatility"].notna().any()
+    assert df["sharpe"].isna().all() and df["beta"].isna().all()
+
+
+def test_cached_and_sliced(mufap_db, benchmarks_db):
+    with MFDatabase() as db:
+        df = db.get_risk_metrics(op_date, end_date)
+        sliced = db.get_risk_metrics(op_date, end_date, fund_ids=["F03", "NOPE", "F01"])
+
+        # a revised nav drops the cached metrics
+        db.execute("UPDATE navs SET nav=nav/2 WHERE fund_id='F01' AND nav_date=(SELECT MAX(nav_date) FROM navs WHERE fund_id='F01')")
+        db.conn.commit()
+        db.db_cache.invalidate("navs")
+        db.build_nav_matrix()
+        changed = db.get_risk_metrics(op_date, end_date, fund_ids=["F01"])
+
+    assert sliced["fund_id"].tolist() == ["F03", "NOPE", "F01"]
+    pd.testing.assert_frame_equal(sliced.iloc[[0, 2]].reset_index(drop=True), df.set_index("fund_id").loc[["F03", "F01"]].reset_index())
+    assert sliced.iloc[1, 1:].isna().all()
+    assert changed["max_drawdown"].iloc[0] < df.set_index("fund_id").loc["F01", "max_drawdown"]
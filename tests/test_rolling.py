@@ -0,0 +1,73 @@
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+import risk
+from db_benchmarks import BMDatabase
+
+
+window = 20
+symbols = ["S00", "S01", "S05", "NOPE"]
+
+
+def test_rolling_matches_pandas():
+    rng = np.random.default_rng(0)
+    returns = rng.normal(0, 0.01, (3, 200))
+    returns[rng.random(returns.shape) < 0.2] = np.nan
+    returns[2, :50] = np.nan
+    bm_returns = rng.normal(0, 0.01, 200)
+
+    stddev = risk.get_rolling_stddev(returns, window)
+    correl, beta = risk.get_rolling_correl(returns, bm_returns, window)
+
+    bm = pd.Series(bm_returns)
+    for i, x in enumerate(returns):
+        x = pd.Series(x)
+        expected = x.rolling(window, min_periods=1).std(ddof=0)
+        expected[: window - 1] = np.nan
+        np.testing.assert_allclose(stddev[i], expected, atol=1e-12)
+
+        # days without a return count as no change
+        filled = x.fillna(0).rolling(window)
+        np.testing.assert_allclose(correl[i], filled.corr(bm), atol=1e-10)
+        np.testing.assert_allclose(beta[i], filled.cov(bm) / bm.rolling(window).var(), atol=1e-10)
+
+
+def test_window_longer_than_history():
+    returns = np.ones((2, 5))
+    assert np.isnan(risk.get_rolling_stddev(returns, 10)).all()
+    assert np.isnan(risk.get_window_sums(returns, 0)).all()
+
+
+def test_stats_match_sql(benchmarks_db):
+    conn = sqlite3.connect(benchmarks_db)
+    df_index = pd.read_sql("SELECT index_date, close FROM psx_indexes WHERE bm_id='1' ORDER BY index_date", conn)
+    df = pd.read_sql("SELECT * FROM psx_scrips", conn)
+    conn.close()
+
+    index_returns = df_index.set_index("index_date")["close"].pct_change().iloc[1:]
+    df["ln_change"] = np.log(df["close"] / df["ldcp"])
+    returns = df.pivot(index="close_date", columns="symbol", values="ln_change").reindex(index_returns.index)
+
+    with BMDatabase() as db:
+        index_stats = db.get_rolling_index_stats("1", window)
+        stats = db.get_rolling_scrip_stats(symbols, "1", window)
+        # cached symbols come back the same
+        cached = db.get_rolling_scrip_stats(symbols[1:3], "1", window)
+
+    np.testing.assert_array_equal(index_stats["index_date"], index_returns.index)
+    np.testing.assert_allclose(index_stats["stddev"], index_returns.rolling(window).std(ddof=0), atol=1e-12)
+
+    for symbol in symbols:
+        x = returns[symbol] if symbol in returns else pd.Series(np.nan, index=returns.index)
+        expected = x.rolling(window, min_periods=1).std(ddof=0)
+        expected[: window - 1] = np.nan
+        np.testing.assert_allclose(stats["stddev"][symbol], expected, atol=1e-12)
+
+        filled = x.fillna(0).rolling(window)
+        np.testing.assert_allclose(stats["correl"][symbol], filled.corr(index_returns), atol=1e-10)
+        np.testing.assert_allclose(stats["beta"][symbol], filled.cov(index_returns) / index_returns.rolling(window).var(), atol=1e-10)
+
+    for stat in stats:
+        pd.testing.assert_frame_equal(cached[stat], stats[stat][symbols[1:3]])
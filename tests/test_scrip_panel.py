@@ -0,0 +1,95 @@
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from db_benchmarks import BMDatabase
+from scrip_panel import ScripPanel
+
+
+windows = [("2022-01-03", "2022-01-31"), ("2022-03-15", "2022-09-30"), ("2023-06-01", "2023-12-31"), ("2024-01-01", "2024-02-01")]
+
+
+def read_scrips(conn, qry, params):
+    df = pd.read_sql(qry, conn, params=params)
+    df["ln_change"] = np.log(df["close"] / df["ldcp"])
+    return df
+
+
+@pytest.mark.parametrize("symbol", ["S00", "S02", "NOPE"])
+@pytest.mark.parametrize("start_date, end_date", windows)
+def test_matches_sql(benchmarks_db, symbol, start_date, end_date):
+    conn = sqlite3.connect(benchmarks_db)
+    qry = "SELECT * FROM psx_scrips WHERE symbol=? AND close_date>? AND close_date<=? ORDER BY close_date"
+    df = read_scrips(conn, qry, (symbol, start_date, end_date))
+    df_all = read_scrips(conn, "SELECT * FROM psx_scrips WHERE close_date>? AND close_date<=?", (start_date, end_date))
+    df_data = pd.read_sql("SELECT * FROM psx_scrips WHERE symbol=? AND close_date>=? AND close_date<=? ORDER BY close_date", conn, params=(symbol, start_date, end_date))
+    avg_volume = conn.execute("SELECT avg(volume) FROM psx_scrips WHERE symbol=? AND close_date>? AND close_date<=?", (symbol, start_date, end_date)).fetchone()[0]
+    conn.close()
+
+    with BMDatabase() as db:
+        np.testing.assert_allclose(db.get_scrip_stddev(symbol, start_date, end_date), df["ln_change"].std(ddof=0), equal_nan=True)
+        np.testing.assert_allclose(db.get_scrip_daily_return(symbol, start_date, end_date)["ln_change"], df["ln_change"].to_numpy(dtype=float))
+        assert db.get_scrip_traded_days(symbol, start_date, end_date) == len(df)
+
+        if avg_volume is None:
+            assert db.get_scrip_avg_volume(symbol, start_date, end_date) is None
+        else:
+            np.testing.assert_allclose(db.get_scrip_avg_volume(symbol, start_date, end_date), avg_volume)
+
+        data = db.get_scrip_data(symbol, start_date, end_date)
+        pd.testing.assert_frame_equal(data[df_data.columns], df_data, check_dtype=False)
+
+        ret = db.get_scrip_return(start_date, end_date)
+        if df_all.empty:
+            assert ret == 0
+        else:
+            expected = np.exp(df_all.groupby("symbol")["ln_change"].sum()) - 1
+            pd.testing.assert_series_equal(ret, expected, check_names=False, check_index_type=False)
+
+
+def test_missing_volumes_are_skipped(benchmarks_db):
+    conn = sqlite3.connect(benchmarks_db)
+    assert conn.execute("SELECT COUNT(*) FROM psx_scrips WHERE volume IS NULL").fetchone()[0] > 0
+    conn.close()
+
+    with BMDatabase() as db:
+        panel = db.get_scrip_panel()
+        assert np.isnan(np.asarray(panel.volume)).any()
+
+
+def test_update_equals_build(benchmarks_db):
+    cutoff = "2023-03-01"
+
+    # rows from the cutoff revised, and a symbol listed after it
+    conn = sqlite3.connect(benchmarks_db)
+    df = pd.read_sql("SELECT * FROM psx_scrips WHERE close_date>=?", conn, params=(cutoff,))
+    conn.close()
+    df["close"] = df["close"] * 1.01
+    df_new = df[df["symbol"] == "S01"].assign(symbol="S99")
+
+    with BMDatabase() as db:
+        db.get_scrip_panel()
+        conn_attach = db.make_attached_db()
+        pd.concat([df, df_new]).to_sql("psx_scrips", conn_attach, if_exists="append", index=False)
+        conn_attach.commit()
+        conn_attach.close()
+
+        db.merge_attached(pd.Timestamp(cutoff).to_pydatetime())
+        updated = BMDatabase.scrip_panel
+        built = ScripPanel.build(db.conn)
+
+    # codes follow the order symbols were first seen, compare the symbols
+    np.testing.assert_array_equal(updated.symbols[np.asarray(updated.codes)], built.symbols[np.asarray(built.codes)])
+    for name in ScripPanel.arrays:
+        if name != "codes":
+            np.testing.assert_array_equal(np.asarray(getattr(updated, name)), np.asarray(getattr(built, name)))
+    assert updated.signature == built.signature
+
+    # and the saved snapshot is the updated panel
+    conn = sqlite3.connect(benchmarks_db)
+    loaded = ScripPanel.load(BMDatabase.path_scrip_panel, conn)
+    conn.close()
+    assert loaded is not None
+    np.testing.assert_array_equal(np.asarray(loaded.close), np.asarray(updated.close))
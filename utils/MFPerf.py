@@ -9,9 +9,17 @@ import sys
 sys.path.append(str(pathlib.Path(__file__).parent.parent.absolute()))
 
 import db_benchmarks
+import risk
 
 db = db_benchmarks.BMDatabase()
 
+# load the scrip panel once so every udf call slices the same arrays
+db.get_scrip_panel()
+
+
+def to_dates(dates):
+    return [str(x)[:10] for x in dates]
+
 
 @xw.func
 @xw.ret(index=False)
@@ -32,6 +40,14 @@ def get_index_close(end_date, index_id, last=False):
     else:
         return df.iloc[0][2]
 
+@xw.func
+@xw.arg("dates", ndim=1)
+@xw.ret(transpose=True)
+def get_index_closes(dates, index_id):
+    # closes for a range of dates, spilled as a column
+    ret = db.get_index_closes(index_id, to_dates(dates))
+    return ret.tolist()
+
 @xw.func
 def get_index_stddev(start_date, end_date, index_id=None):
     ret = db.get_index_stddev(start_date, end_date, index_id)
@@ -57,6 +73,52 @@ def get_scrip_correl(symbol1, symbol2, start_date, end_date):
     ret = db.get_scrip_correl([symbol1, symbol2], start_date, end_date).iloc[0,1]
     return ret
 
+@xw.func
+@xw.arg("symbols", ndim=1)
+@xw.arg("start_dates", ndim=1)
+@xw.arg("end_dates", ndim=1)
+@xw.ret(index=False, header=False)
+def get_scrip_returns(symbols, start_dates, end_dates):
+    # symbols down, one column per start and end date pair
+    ret = db.get_scrip_period_returns(symbols, to_dates(start_dates), to_dates(end_dates))
+    return ret
+
+@xw.func
+@xw.arg("symbols", ndim=1)
+@xw.ret(transpose=True)
+def get_scrip_stddevs(symbols, start_date, end_date):
+    start_date = str(start_date)[:10]
+    end_date = str(end_date)[:10]
+    returns, dates = db.get_scrip_returns(symbols, start_date, end_date)
+    ret = risk.get_stddev(returns)
+    return ret.tolist()
+
+@xw.func
+@xw.arg("symbols", ndim=1)
+@xw.ret(index=False, header=False)
+def get_scrip_correl_matrix(symbols, start_date, end_date):
+    start_date = str(start_date)[:10]
+    end_date = str(end_date)[:10]
+    ret = db.get_scrip_correl(symbols, start_date, end_date)
+    return ret
+
+@xw.func
+@xw.arg("symbols", ndim=1)
+@xw.arg("dates", ndim=1)
+@xw.ret(index=False, header=False)
+def get_scrip_closes(symbols, dates):
+    # symbols down, dates across
+    ret = db.get_scrip_closes(symbols, to_dates(dates))
+    return ret
+
+@xw.func
+@xw.arg("symbols", ndim=1)
+@xw.ret(index=True, header=True)
+def get_rolling_scrip_stats(symbols, index_id, window, stat="stddev"):
+    # dates down, symbols across, stat is stddev, correl or beta
+    ret = db.get_rolling_scrip_stats(symbols, index_id, int(window))
+    return ret[stat]
+
 @xw.func
 def get_scrip_avg_volume(symbol, start_date, end_date):
     ret = db.get_scrip_avg_volume(symbol, start_date, end_date)
@@ -76,8 +138,8 @@ def get_scrip_info(symbol, info_id):
 def get_scrip_sector(symbol):
     ret = db.get_scrip_info(symbol)
     sec_id = ret[2]
-    qry = f"SELECT sector_name FROM psx_sectors WHERE sector_id='{sec_id}'"
-    ret2 = db.conn.execute(qry)
+    qry = "SELECT sector_name FROM psx_sectors WHERE sector_id=?"
+    ret2 = db.execute(qry, (sec_id,))
     return ret2.fetchone()
 
 @xw.func
@@ -110,6 +172,23 @@ def get_portfolio_stddev(symbols, weights, start_date, end_date):
     ret = db.get_portfolio_stddev(df_portfolio, start_date, end_date)
     return ret
 
+@xw.func
+@xw.ret(index=False)
+def get_portfolio_risk(symbols, weights, start_date, end_date):
+    start_date = str(start_date)[:10]
+    end_date = str(end_date)[:10]
+    df_portfolio = pd.DataFrame({"symbol": symbols, "weight": weights})
+    ret = db.get_portfolio_risk(df_portfolio, start_date, end_date)
+    return ret["risk"]
+
+@xw.func
+def get_portfolio_tracking_error(symbols, weights, start_date, end_date, index_id):
+    start_date = str(start_date)[:10]
+    end_date = str(end_date)[:10]
+    df_portfolio = pd.DataFrame({"symbol": symbols, "weight": weights})
+    ret = db.get_portfolio_risk(df_portfolio, start_date, end_date, index_id)
+    return ret["tracking_error"]
+
 @xw.func
 def get_fi_avg(bm_name, start_date, end_date):
     bms = db.get_bm_info()
@@ -0,0 +1,75 @@
+import pathlib
+import shutil
+import sqlite3
+import sys
+import tempfile
+import timeit
+
+sys.path.append(str(pathlib.Path(__file__).parent.parent.absolute()))
+import db_schema
+from db_benchmarks import BMDatabase
+from db_mufap import MFDatabase
+
+# times the queries behind get_returns_navs and get_scrip_return on a copy of
+# each database, before and after the schema migrations
+# usage: python bench_queries.py [mufap.db] [benchmarks.db]
+
+
+def mufap_queries(conn):
+    end_date = conn.execute("SELECT MAX(nav_date) FROM navs").fetchone()[0]
+    op_date = conn.execute(
+        f"SELECT MAX(nav_date) FROM navs WHERE nav_date<=datetime('{end_date}', '-1 year')"
+    ).fetchone()[0]
+
+    return {
+        "navs on anchor dates": f"SELECT * FROM navs WHERE nav_date IN ('{op_date}', '{end_date}') AND nav!=0",
+        "payouts in period": f"SELECT * FROM payouts WHERE payout_date>'{op_date}' AND payout_date<='{end_date}'",
+        "fund history": f"SELECT * FROM navs WHERE fund_id=(SELECT MIN(fund_id) FROM navs) AND nav_date>'{op_date}'",
+    }
+
+
+def benchmarks_queries(conn):
+    end_date = conn.execute("SELECT MAX(close_date) FROM psx_scrips").fetchone()[0]
+    op_date = conn.execute(f"SELECT date('{end_date}', '-1 month')").fetchone()[0]
+    symbol = conn.execute("SELECT MIN(symbol) FROM psx_scrips").fetchone()[0]
+
+    return {
+        "scrips in period": f"SELECT * FROM psx_scrips WHERE close_date>'{op_date}' AND close_date<='{end_date}'",
+        "scrip in period": f"SELECT * FROM psx_scrips WHERE symbol='{symbol}' AND close_date>'{op_date}' AND close_date<='{end_date}'",
+        "index history": f"SELECT * FROM psx_indexes WHERE bm_id='1' AND index_date>'{op_date}' ORDER BY index_date ASC",
+    }
+
+
+def time_queries(conn, queries, number=5):
+    ret = {}
+    for name, qry in queries.items():
+        ret[name] = timeit.timeit(lambda: conn.execute(qry).fetchall(), number=number) / number
+    return ret
+
+
+def bench(path_db, get_queries, migrations):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path_copy = pathlib.Path(tmp_dir) / path_db.name
+        shutil.copy(path_db, path_copy)
+
+        conn = sqlite3.connect(path_copy)
+        queries = get_queries(conn)
+        before = time_queries(conn, queries)
+
+        db_schema.migrate(conn, migrations)
+        after = time_queries(conn, queries)
+
+        print(f"\n{path_db.name}")
+        for name, qry in queries.items():
+            plan = " / ".join(r[-1] for r in conn.execute(f"EXPLAIN QUERY PLAN {qry}").fetchall())
+            print(f"{name}: {before[name] * 1000:.2f} ms -> {after[name] * 1000:.2f} ms ({plan})")
+
+        conn.close()
+
+
+if __name__ == "__main__":
+    path_mufap = pathlib.Path(sys.argv[1]) if len(sys.argv) > 1 else MFDatabase.path_db_main
+    path_benchmarks = pathlib.Path(sys.argv[2]) if len(sys.argv) > 2 else BMDatabase.path_db_main
+
+    bench(path_mufap, mufap_queries, db_schema.mufap_migrations)
+    bench(path_benchmarks, benchmarks_queries, db_schema.benchmarks_migrations)
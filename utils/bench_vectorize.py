@@ -0,0 +1,87 @@
+import timeit
+import pathlib
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(str(pathlib.Path(__file__).parent.parent.absolute()))
+import mufap
+from db_mufap import MFDatabase
+
+# row-wise versions replaced by the vectorized ones, kept here as the baseline
+
+
+def rowwise_nav_adjust_name(df_nav):
+    df_nav["Fund Name"] = df_nav["Fund Name"].str.replace(r"\s+", " ", regex=True)
+    df_nav["Fund Name"] = df_nav.apply(
+        lambda row: row["Fund Name"] + "-" + row["Class"]
+        if row["Class"] != "-"
+        else row["Fund Name"],
+        axis=1,
+    )
+    df_nav["Fund Name"] = df_nav.apply(
+        lambda row: row["Fund Name"] + "--" + row["Type"]
+        if row["Type"] != "-"
+        else row["Fund Name"],
+        axis=1,
+    )
+    return df_nav
+
+
+def rowwise_annualize_return(df, ret_col, delta_days):
+    def annualize(ret):
+        if delta_days > 365:
+            return (ret + 1) ** (365 / delta_days) - 1
+        return ret * 365 / delta_days
+
+    df["annualize"] = df["category"].apply(mufap.mufap_cat_annualize)
+    df[ret_col] = df.apply(
+        lambda x: annualize(x[ret_col]) if x["annualize"] else x[ret_col],
+        axis=1,
+    )
+    return df
+
+
+def vectorized_annualize_return(df, ret_col, delta_days):
+    # the annualization __get_performance_multi applies to every window
+    annualize = mufap.mufap_cats_annualize(df["category"])
+    df["annualize"] = annualize
+    df[ret_col] = np.where(annualize, MFDatabase.annualize_return(df[ret_col], delta_days), df[ret_col])
+    return df
+
+
+def make_funds(n=2000):
+    rng = np.random.default_rng(0)
+    categories = ["Equity", "Income", "Money Market", "Fixed Rate / Return", "Balanced", "Islamic Debt"]
+
+    return pd.DataFrame({
+        "Fund Name": [f"Fund  {i}   Name" for i in range(n)],
+        "Class": rng.choice(["-", "A", "B"], n),
+        "Type": rng.choice(["-", "Growth", "Income"], n),
+        "category": rng.choice(categories, n),
+        "return": rng.normal(0, 0.05, n),
+    })
+
+
+def bench(name, func_old, func_new, df, number=20):
+    res_old = func_old(df.copy())
+    res_new = func_new(df.copy())
+    pd.testing.assert_frame_equal(res_old, res_new, check_dtype=False)
+
+    t_old = timeit.timeit(lambda: func_old(df.copy()), number=number) / number
+    t_new = timeit.timeit(lambda: func_new(df.copy()), number=number) / number
+    print(f"{name}: {t_old * 1000:.2f} ms -> {t_new * 1000:.2f} ms ({t_old / t_new:.0f}x)")
+
+
+if __name__ == "__main__":
+    df = make_funds()
+
+    bench("mufap_nav_adjust_name", rowwise_nav_adjust_name, mufap.mufap_nav_adjust_name, df)
+    for delta_days in [30, 730]:
+        bench(
+            f"annualize_return ({delta_days} days)",
+            lambda x: rowwise_annualize_return(x, "return", delta_days),
+            lambda x: vectorized_annualize_return(x, "return", delta_days),
+            df,
+        )
@@ -42,9 +42,10 @@ def fetch_index_weights():
 
 db = db_benchmarks.BMDatabase()
 
-start_date = datetime.datetime.fromisoformat(db.get_latest_fi_date()) + datetime.timedelta(days=1)
+starts = db.get_update_starts()
+start_date = max(starts.values(), default=datetime.datetime.fromisoformat(db.get_latest_fi_date()) + datetime.timedelta(days=1))
 # # start_date = datetime.date(2023, 7, 1)
-db.update_attached(start_date)
+db.update_attached(start_date, starts)
 db.merge_attached(start_date)
 db.path_db_attach.unlink()
 